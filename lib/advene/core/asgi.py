@@ -0,0 +1,306 @@
+#
+# Advene: Annotate Digital Videos, Exchange on the NEt
+# Copyright (C) 2025 Olivier Aubert <contact@olivieraubert.net>
+#
+# Advene is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# Advene is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Advene; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+#
+"""Advene asynchronous (ASGI) http server.
+
+This is an alternative to the CherryPy-based L{advene.core.webcherry}
+server, meant for headless use with many concurrent clients. It
+exposes a subset of the webcherry URL tree:
+
+  - C{/packages/alias/TALES_PATH} : raw display of TALES expressions
+  - C{/media/snapshot/alias/position} : snapshots
+  - C{/media/current}, C{/media/play}, C{/media/pause},
+    C{/media/stop}, C{/media/resume} : player control
+  - C{/action/name} : invocation of ECA actions
+  - C{/events} : Server-Sent Events stream of the controller
+    events. The optional C{events} parameter is a comma-separated
+    list of event names to receive.
+
+Element rendering and snapshot access are done in a worker thread
+pool, so that the asyncio loop is never blocked and can keep serving
+long-lived event streams.
+
+The server is selected by setting C{config.data.webserver['engine']}
+to C{asgi} (or using the C{--webserver-engine asgi} command-line
+option). It uses uvicorn, which must be installed.
+"""
+
+import logging
+logger = logging.getLogger(__name__)
+
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import json
+import threading
+import urllib.parse
+
+from gettext import gettext as _
+
+import advene.core.config as config
+from advene.core.eventstream import AsyncSubscription, format_sse, KEEPALIVE_DELAY
+from advene.model.exception import AdveneException
+from advene.util.tools import image_type
+
+class HTTPError(Exception):
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+        self.message = message
+
+class AdveneASGIApp:
+    """ASGI application serving Advene data.
+
+    @ivar controller: the controller
+    @ivar executor: the worker pool used for rendering
+    """
+    def __init__(self, controller, workers=4):
+        self.controller = controller
+        self.executor = ThreadPoolExecutor(max_workers=workers,
+                                           thread_name_prefix="advene-asgi")
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            return await self.lifespan(receive, send)
+        if scope['type'] != 'http':
+            return
+
+        path = [ urllib.parse.unquote(c) for c in scope['path'].split('/') if c ]
+        query = dict(urllib.parse.parse_qsl(scope['query_string'].decode('latin-1')))
+        try:
+            if not path:
+                await self.respond(send, 200, json.dumps({ 'packages': list(self.controller.packages) }),
+                                   'application/json')
+            elif path[0] == 'events':
+                await self.stream_events(receive, send, query)
+            elif path[0] == 'packages' and len(path) >= 2:
+                contenttype, body = await self.run(self.render_element, path[1], "/".join(path[2:]), query)
+                await self.respond(send, 200, body, contenttype)
+            elif path[0] == 'media' and len(path) >= 2:
+                await self.handle_media(send, path[1:], query)
+            elif path[0] == 'action' and len(path) == 2:
+                self.invoke_action(path[1], query)
+                await self.respond(send, 204, b'')
+            else:
+                raise HTTPError(404, _("Unknown path %s") % scope['path'])
+        except HTTPError as e:
+            await self.respond(send, e.status, e.message, 'text/plain')
+        except Exception as e:
+            logger.error("Error while handling %s", scope['path'], exc_info=True)
+            await self.respond(send, 500, str(e), 'text/plain')
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({ 'type': 'lifespan.startup.complete' })
+            elif message['type'] == 'lifespan.shutdown':
+                self.executor.shutdown(wait=False)
+                await send({ 'type': 'lifespan.shutdown.complete' })
+                return
+
+    async def run(self, method, *args):
+        """Execute method in the worker pool.
+        """
+        return await asyncio.get_running_loop().run_in_executor(self.executor, method, *args)
+
+    async def respond(self, send, status, body, contenttype=None, headers=None):
+        if isinstance(body, str):
+            body = body.encode('utf-8')
+            if contenttype and contenttype.startswith('text/') and 'charset' not in contenttype:
+                contenttype += '; charset=utf-8'
+        h = [ (k.encode('latin-1'), v.encode('latin-1')) for (k, v) in (headers or []) ]
+        if contenttype:
+            h.append( (b'content-type', contenttype.encode('latin-1')) )
+        if status == 200 and not any(k == b'cache-control' for (k, v) in h):
+            h.append( (b'cache-control', b'max-age=0') )
+        await send({ 'type': 'http.response.start',
+                     'status': status,
+                     'headers': h })
+        await send({ 'type': 'http.response.body',
+                     'body': body })
+
+    def get_package(self, alias):
+        try:
+            return self.controller.packages[alias]
+        except KeyError:
+            raise HTTPError(404, _("Unknown package alias %s") % alias) from None
+
+    def render_element(self, alias, tales, query):
+        """Render the element defined by the TALES expression.
+
+        This is the equivalent of the webcherry raw display mode. It
+        is executed in the worker pool.
+
+        @return: a (contenttype, body) tuple
+        """
+        p = self.get_package(alias)
+        if tales == "":
+            expr = "here"
+        elif tales.startswith('options'):
+            expr = tales
+        else:
+            expr = "here/%s" % tales
+
+        with self.controller.model_lock.reader():
+            context = self.controller.build_context(here=p, alias=alias)
+            context.pushLocals()
+            context.setLocal('request', query)
+            context.setLocal('view', p)
+            try:
+                objet = context.evaluateValue(expr)
+                if hasattr(objet, 'view') and callable(objet.view):
+                    context = self.controller.build_context(here=objet, alias=alias)
+                    context.pushLocals()
+                    context.setLocal('request', query)
+                    context.setLocal('view', objet)
+                    objet = objet.view(context=context)
+            except AdveneException as e:
+                raise HTTPError(400, _("Invalid TALES expression %(expr)s: %(error)s") % { 'expr': tales,
+                                                                                          'error': str(e.args[0]) }) from None
+
+            contenttype = getattr(objet, 'contenttype', None) or getattr(objet, 'mimetype', None)
+            if hasattr(objet, 'mimetype') and hasattr(objet, 'data'):
+                # Content object
+                body = objet.data
+            elif isinstance(objet, (str, bytes)):
+                body = objet
+            else:
+                try:
+                    body = bytes(objet)
+                except TypeError:
+                    body = str(objet)
+        if isinstance(body, bytes) and image_type(body):
+            contenttype = image_type(body)
+        return contenttype or 'text/plain', body
+
+    async def handle_media(self, send, path, query):
+        c = self.controller
+        command = path[0]
+        if command == 'snapshot' and len(path) == 3:
+            p = self.get_package(path[1])
+            try:
+                position = int(path[2])
+            except ValueError:
+                raise HTTPError(400, _("Invalid position %s") % path[2]) from None
+            snapshot = await self.run(lambda: c.get_snapshot(position, media=p.media))
+            headers = []
+            if not snapshot.is_default:
+                headers.append( ('cache-control', 'public, max-age=31536000, immutable') )
+            body = await self.run(bytes, snapshot)
+            await self.respond(send, 200, body, snapshot.contenttype, headers)
+        elif command == 'current':
+            await self.respond(send, 200, c.player.get_uri() or 'N/C', 'text/plain')
+        elif command in ('play', 'pause', 'stop', 'resume'):
+            if command == 'play':
+                try:
+                    position = int(query.get('position', 0))
+                except ValueError:
+                    raise HTTPError(400, _("Invalid position %s") % query['position']) from None
+                c.queue_action(c.update_status, 'start', position)
+            else:
+                c.queue_action(c.update_status, command)
+            await self.respond(send, 204, b'')
+        else:
+            raise HTTPError(404, _("Unknown media command %s") % command)
+
+    def invoke_action(self, name, query):
+        catalog = self.controller.event_handler.catalog
+        try:
+            ra = catalog.get_action(name)
+        except KeyError:
+            raise HTTPError(404, _("Unknown action %s") % name) from None
+        missing = [ p for p in ra.parameters if p not in query ]
+        if missing:
+            raise HTTPError(400, _("Missing parameter(s): %s") % ", ".join(missing))
+        self.controller.queue_registered_action(ra, query)
+
+    async def wait_disconnect(self, receive):
+        while True:
+            message = await receive()
+            if message['type'] == 'http.disconnect':
+                return
+
+    async def stream_events(self, receive, send, query):
+        """Send the controller events as a Server-Sent Events stream.
+        """
+        events = [ e for e in query.get('events', '').split(',') if e ]
+        subscription = self.controller.event_broadcaster.subscribe(
+            AsyncSubscription(asyncio.get_running_loop(), events=events))
+        disconnected = asyncio.ensure_future(self.wait_disconnect(receive))
+        try:
+            await send({ 'type': 'http.response.start',
+                         'status': 200,
+                         'headers': [ (b'content-type', b'text/event-stream; charset=utf-8'),
+                                      (b'cache-control', b'no-cache') ] })
+            while not disconnected.done():
+                event = await subscription.get(timeout=KEEPALIVE_DELAY)
+                if event is None:
+                    data = ": keepalive\n\n"
+                else:
+                    data = format_sse(event)
+                await send({ 'type': 'http.response.body',
+                             'body': data.encode('utf-8'),
+                             'more_body': True })
+        except OSError:
+            # Client disconnected
+            pass
+        finally:
+            self.controller.event_broadcaster.unsubscribe(subscription)
+            disconnected.cancel()
+
+class AdveneASGIServer:
+    """Asynchronous HTTP Server for the Advene framework.
+
+    It provides the same interface as
+    L{advene.core.webcherry.AdveneWebServer}, and runs the
+    L{AdveneASGIApp} with uvicorn in a dedicated thread.
+
+    @ivar urlbase: the base URL for this server
+    @type urlbase: string
+    """
+    def __init__(self, controller=None, port=1234):
+        import uvicorn
+
+        self.controller = controller
+        self.urlbase = "http://localhost:%d/" % port
+        self.displaymode = 'raw'
+        self.app = AdveneASGIApp(controller,
+                                 workers=config.data.webserver.get('workers', 4))
+        self.server = uvicorn.Server(uvicorn.Config(self.app,
+                                                    host='127.0.0.1',
+                                                    port=port,
+                                                    log_level='warning',
+                                                    lifespan='on'))
+        # The server does not run in the main thread.
+        self.server.install_signal_handlers = lambda: None
+        self.thread = None
+
+    def start(self):
+        """Start the webserver.
+        """
+        self.thread = threading.Thread(target=self.server.run, name="Advene ASGI webserver", daemon=True)
+        self.thread.start()
+        return True
+
+    def stop(self):
+        """Stop the webserver.
+        """
+        self.server.should_exit = True
+
+    def is_running(self):
+        return self.thread is not None and self.thread.is_alive() and self.server.started
@@ -378,6 +378,12 @@ class Config:
             # Name of audio device for gstrecorder
             'audio-record-device': 'default',
             'record-video': True,
+            # Build a keyframe index of local media files, used for
+            # frame stepping and snapshots
+            'keyframe-index': True,
+            # Delay (in ms) between real player position queries. The
+            # position is interpolated in between. 0 to always query.
+            'position-query-interval': 250,
             }
 
         self.webserver = {
@@ -387,8 +393,18 @@ class Config:
             'mode': True,
             # 'navigation' or 'raw'
             'displaymode': 'raw',
-            # engine: simple (for SimpleHTTPServer) or cherrypy (for CherryPy)
-            'engine': 'simple',
+            # engine: cherrypy (for CherryPy, with the navigation
+            # interface) or asgi (asyncio-based headless server,
+            # requires uvicorn)
+            'engine': 'cherrypy',
+            # Size of the worker pool used by the asgi engine for rendering
+            'workers': 4,
+            # Maximum number of rendered /packages responses kept in
+            # the response cache. 0 disables the cache.
+            'cache-size': 256,
+            # Maximum number of simultaneous /events clients for the
+            # cherrypy engine (each one holds a server thread)
+            'event-clients': 4,
             }
 
         # Global context options
@@ -620,6 +636,10 @@ class Config:
                             type=int, default=None, metavar="WEBSERVER_MODE",
                             help="0: deactivated ; 1: threaded mode.")
 
+        parser.add_argument("--webserver-engine", dest="engine", action="store",
+                            choices=("cherrypy", "asgi"), default=None,
+                            help="Webserver engine (default cherrypy).")
+
         parser.add_argument("-f", "--filter",
                             dest="filter",
                             action="store",
@@ -653,6 +673,8 @@ class Config:
             self.webserver['port'] = self.options.port
         if self.options.mode is not None:
             self.webserver['mode'] = self.options.mode
+        if self.options.engine is not None:
+            self.webserver['engine'] = self.options.engine
 
         if self.options.player is not None:
             self.player['plugin']=self.options.player
@@ -32,6 +32,7 @@ import logging
 logger = logging.getLogger(__name__)
 
 import atexit
+import functools
 from gi.repository import GObject
 import html
 import inspect
@@ -46,7 +47,6 @@ import shlex
 import sys
 import time
 from urllib.parse import urljoin, parse_qsl
-from urllib.request import urlopen
 import urllib.parse
 import urllib.error
 import webbrowser
@@ -61,6 +61,9 @@ from gettext import gettext as _
 import advene.core.plugin
 from advene.core.mediacontrol import PlayerFactory
 from advene.core.imagecache import ImageCache
+from advene.core.corpus import CorpusIndex, parse_package_list
+from advene.core.eventstream import EventBroadcaster
+from advene.core.representation import RepresentationEngine
 import advene.core.idgenerator
 
 from advene.rules.elements import RuleSet, RegisteredAction, SimpleQuery, Quicksearch
@@ -83,7 +86,8 @@ from advene.util.website_export import WebsiteExporter
 import advene.model.tal.context
 
 import advene.util.helper as helper
-from advene.util.tools import unescape_string
+import advene.util.mediainfo as mediainfo
+from advene.util.tools import unescape_string, RWLock, next_revision
 import advene.util.importer
 from advene.util.exporter import get_exporter, register_exporter, init_templateexporters
 import xml.etree.ElementTree as ET
@@ -115,6 +119,18 @@ def _advene_excepthook(type, value, tracebk, thread=None):
     old_excepthook(type, value, tracebk)
 sys.excepthook = _advene_excepthook
 
+def model_modification(method):
+    """Decorator for controller methods which modify the model.
+
+    The method is executed with the model writer lock held (see
+    L{AdveneController.modifying_model}).
+    """
+    @functools.wraps(method)
+    def wrapper(self, *args, **kw):
+        with self.modifying_model():
+            return method(self, *args, **kw)
+    return wrapper
+
 class MessageHandler(logging.Handler):
     def __init__(self, level=logging.NOTSET, controller=None):
         super(MessageHandler, self).__init__(level)
@@ -128,23 +144,43 @@ class MessageHandler(logging.Handler):
 
 class GlobalPackage:
     """Wrapper to access all packages loaded data.
+
+    Element lists and the L{CorpusIndex} are cached, and rebuilt when
+    the set of loaded packages or their revision changes.
     """
     def __init__(self, controller):
         self.controller = controller
         self._title = "corpus"
+        self._signature = None
+        self._cache = {}
+
+    def _cached(self, name, build):
+        """Return the cached value for name, building it if necessary.
+        """
+        signature = tuple( (a, id(p), getattr(p, '_revision', 0))
+                           for (a, p) in self.package_dict.items() )
+        if signature != self._signature:
+            self._cache = {}
+            self._signature = signature
+        try:
+            return self._cache[name]
+        except KeyError:
+            value = self._cache[name] = build()
+            return value
+
+    @property
+    def index(self):
+        """The L{CorpusIndex} of loaded packages.
+        """
+        return self._cached('index',
+                            lambda: CorpusIndex.from_packages(self.package_dict,
+                                                              title=self.controller.get_title))
 
     def annotation_types_by_title_stats(self):
-        at_titles = list(set(self.controller.get_title(at)
-                             for at in self.annotationTypes))
-        rows = [ [ "package_alias", *at_titles ] ]
-        for (a, p) in self.package_dict.items():
-            # Build a mapping dictionary
-            title2at = dict( (self.controller.get_title(at), at)
-                              for at in p.annotationTypes )
-            counts = [ (len(title2at[title].annotations) if title2at.get(title) else None)
-                       for title in at_titles ]
-            rows.append([ a, *counts ])
-        return rows
+        return self.index.annotation_types_by_title_stats()
+
+    def statistics(self):
+        return self.index.statistics()
 
     @property
     def title(self):
@@ -174,35 +210,30 @@ class GlobalPackage:
                      for a, p in self.controller.packages.items()
                      if a != 'advene' )
 
+    def _elements(self, name):
+        return self._cached(name,
+                            lambda: tuple(itertools.chain.from_iterable(getattr(p, name)
+                                                                        for p in self.package_list)))
+
     @property
     def annotations(self):
-        for p in self.package_list:
-            for a in p.annotations:
-                yield a
+        return self._elements('annotations')
 
     @property
     def relations(self):
-        for p in self.package_list:
-            for r in p.relations:
-                yield r
+        return self._elements('relations')
 
     @property
     def annotationTypes(self):
-        for p in self.package_list:
-            for at in p.annotationTypes:
-                yield at
+        return self._elements('annotationTypes')
 
     @property
     def relationTypes(self):
-        for p in self.package_list:
-            for rt in p.relationTypes:
-                yield rt
+        return self._elements('relationTypes')
 
     @property
     def schemas(self):
-        for p in self.package_list:
-            for s in p.schemas:
-                yield s
+        return self._elements('schemas')
 
 class AdveneController:
     """AdveneController class.
@@ -227,6 +258,7 @@ class AdveneController:
       - L{imagecache} : the associated imagecache
       - L{_idgenerator} : the associated idgenerator
       - L{_modified} : boolean
+      - L{_revision} : revision number, updated on every modifying event
 
     @ivar active_annotations: the currently active annotations.
     @type active_annotations: list
@@ -255,8 +287,20 @@ class AdveneController:
 
     @ivar gui: the embedding GUI (may be None)
     @type gui: AdveneGUI
+
+    @ivar model_lock: readers-writer lock for concurrent model access
+    @type model_lock: advene.util.tools.RWLock
+
+    @ivar context_templates: template contexts used by build_context
+    @type context_templates: dict
+
+    @ivar representation: cache for element titles and colors
+    @type representation: advene.core.representation.RepresentationEngine
     """
 
+    # Maximum delay (in s) for execute_in_mainloop
+    MAINLOOP_TIMEOUT = 30
+
     def __init__ (self, args=None):
         """Initializes player and other attributes.
         """
@@ -279,6 +323,9 @@ class AdveneController:
         # Imagecache indexed by media
         self.imagecache = {}
 
+        # Template contexts used by build_context, indexed by (alias, baseurl)
+        self.context_templates = {}
+
         # Unknown arguments (neither a package nor a video file)
         self.unknown_args = []
 
@@ -341,8 +388,17 @@ class AdveneController:
 
         # Event handler initialization
         self.event_handler = advene.rules.ecaengine.ECAEngine (controller=self)
+        # Dispatcher of events to external (web) subscribers
+        self.event_broadcaster = EventBroadcaster(self)
+        # Cache for element titles and colors
+        self.representation = RepresentationEngine(self)
         self.modifying_events = self.event_handler.catalog.modifying_events
         self.event_queue = []
+        self.event_queue_lock = threading.Lock()
+        # Readers-writer lock protecting the model from concurrent
+        # access by the webserver threads. Model modifications are
+        # done with the writer lock held (see modifying_model).
+        self.model_lock = RWLock()
         self.tracers=[]
 
         # Load default actions
@@ -431,9 +487,62 @@ class AdveneController:
         the main application thread. This can prevent problems when
         running in a GUI environment.
         """
-        self.event_queue.append( (method, args, kw) )
+        with self.event_queue_lock:
+            self.event_queue.append( (method, args, kw) )
         return True
 
+    def modifying_model(self):
+        """Return a context manager for model modifications.
+
+        Code modifying the model outside of execute_in_mainloop (GUI
+        callbacks, importers...) must be enclosed in it, so that the
+        webserver threads do not read the model while it is being
+        modified. It should be held only for the modification itself,
+        since readers are blocked meanwhile. It is reentrant.
+
+        Usage::
+
+          with controller.modifying_model():
+              annotation.fragment.end = position
+        """
+        return self.model_lock.writer()
+
+    def execute_in_mainloop(self, method, *args, **kw):
+        """Execute an action in the application mainloop and return its result.
+
+        This is meant to be used from other threads (typically the
+        webserver threads) for model modifications: the action is
+        queued, so that it is serialized with other modifications, and
+        executed with the model writer lock held. The calling thread
+        waits for its completion. Exceptions are propagated to the
+        caller.
+
+        If the action is not executed within MAINLOOP_TIMEOUT seconds,
+        it is cancelled and a TimeoutError is raised.
+        """
+        if threading.current_thread() is threading.main_thread():
+            with self.modifying_model():
+                return method(*args, **kw)
+        done = threading.Event()
+        result = {}
+        def wrapper():
+            if result.get('cancelled'):
+                return
+            try:
+                with self.modifying_model():
+                    result['value'] = method(*args, **kw)
+            except BaseException as e:
+                result['exception'] = e
+            finally:
+                done.set()
+        self.queue_action(wrapper)
+        if not done.wait(self.MAINLOOP_TIMEOUT):
+            result['cancelled'] = True
+            raise TimeoutError(_("The application mainloop did not process the action"))
+        if 'exception' in result:
+            raise result['exception']
+        return result.get('value')
+
     def queue_registered_action(self, ra, parameters):
         """Queue a registered action for execution.
         """
@@ -449,8 +558,11 @@ class AdveneController:
         events can generate new notification.
         """
         # Dump the pending events into a local queue
-        ev=self.event_queue[:]
-        self.event_queue=[]
+        with self.event_queue_lock:
+            ev=self.event_queue
+            self.event_queue=[]
+        if not ev:
+            return True
 
         # Now we can process the events
         for (method, args, kw) in ev:
@@ -836,21 +948,34 @@ class AdveneController:
     def build_context(self, here=None, alias=None, baseurl=None):
         """Build a context object with additional information.
 
-        The information is cached if no additional parameter (alias,
-        baseurl) is specified.
+        Contexts are derived from a template context (one for each
+        alias/baseurl combination), which holds the options, globals
+        and method table. Templates are rebuilt when the current
+        package, its imagecache, the player or the global methods
+        change, or when invalidate_context_templates is called.
         """
         if here is None:
             here=self.package
-        if alias is None and baseurl is None:
-            try:
-                c = here._cached_context
-                c.restore()
-                return c
-            except AttributeError:
-                pass
+        key = (alias, baseurl)
+        signature = (id(self.package),
+                     id(getattr(self.package, 'imagecache', None)),
+                     id(self.player),
+                     len(config.data.global_methods))
+        # Take a reference on the dict, so that a concurrent
+        # invalidation does not get overwritten with a stale template.
+        templates = self.context_templates
+        template = templates.get(key)
+        if template is None or template.signature != signature:
+            template = templates[key] = self.build_context_template(alias, baseurl)
+            template.signature = signature
+        return template.derive(here)
+
+    def build_context_template(self, alias=None, baseurl=None):
+        """Build a template context for build_context.
+        """
         if baseurl is None:
             baseurl=self.get_default_url(root=True, alias=alias)
-        c=advene.model.tal.context.AdveneContext(here,
+        c=advene.model.tal.context.AdveneContext(None,
                                                  options={
                                                      'package_url': baseurl,
                                                      'snapshot': self.package.imagecache,
@@ -865,10 +990,16 @@ class AdveneController:
         c.addGlobal('player', self.player)
         for name, method in config.data.global_methods.items():
             c.addMethod(name, method)
-        # Preserve a copy of globals/locals for later restoring
-        c.checkpoint()
         return c
 
+    def invalidate_context_templates(self):
+        """Discard the template contexts used by build_context.
+
+        It must be called when data referenced by the contexts
+        (aliases, urls) is modified.
+        """
+        self.context_templates = {}
+
     def busy_port_info(self):
         """Display the processes using the webserver port.
         """
@@ -982,7 +1113,15 @@ class AdveneController:
 
         self.player.check_player()
 
-        if config.data.webserver['mode'] and AdveneWebServer is not None:
+        if config.data.webserver['mode'] and config.data.webserver['engine'] == 'asgi':
+            try:
+                from advene.core.asgi import AdveneASGIServer
+                self.server = AdveneASGIServer(controller=self, port=config.data.webserver['port'])
+                self.server.start()
+            except ImportError:
+                logger.error(_("The asgi webserver engine requires uvicorn. Deactivating web server."))
+                self.server = None
+        elif config.data.webserver['mode'] and AdveneWebServer is not None:
             try:
                 self.server = AdveneWebServer(controller=self, port=config.data.webserver['port'])
                 serverthread = threading.Thread (target=self.server.start)
@@ -993,8 +1132,11 @@ class AdveneController:
                     self.busy_port_info()
                 logger.info(_("Deactivating web server"))
                 self.server = None
+        # Package URLs depend on the server
+        self.invalidate_context_templates()
         return True
 
+    @model_modification
     def create_annotation(self, position, type, duration=None, content=None):
         position=int(position)
         if position > self.cached_duration:
@@ -1073,13 +1215,17 @@ class AdveneController:
             el_name=event_name.lower().replace('create','').replace('editend','').replace('delete', '')
             el=kw[el_name]
             p=el.ownerPackage
-            p._modified = True
-            if event_name.endswith('Delete'):
-                # We removed an element, so remove its id from the _idgenerator set
-                p._idgenerator.remove(el.id)
-            elif event_name.endswith('Create'):
-                # We created an element. Make sure its id is registered in the _idgenerator
-                p._idgenerator.add(el.id)
+            with self.modifying_model():
+                p._modified = True
+                p._revision = next_revision()
+                if event_name.endswith('Delete'):
+                    # We removed an element, so remove its id from the _idgenerator set
+                    p._idgenerator.remove(el.id)
+                elif event_name.endswith('Create'):
+                    # We created an element. Make sure its id is registered in the _idgenerator
+                    p._idgenerator.add(el.id)
+
+        self.representation.update_for_event(event_name, kw)
 
         if 'immediate' in kw:
             self.event_handler.notify(event_name, *param, **kw)
@@ -1196,26 +1342,7 @@ class AdveneController:
                 if not r:
                     r=element.id
                 return cleanup(r)
-
-            expr=element.type.getMetaData(config.data.namespace, "representation")
-            if expr is None or expr == '' or re.match(r'^\s+', expr):
-                r=element.content.data
-                if element.content.mimetype == 'image/svg+xml':
-                    return "SVG graphics"
-                elif not element.content.isTextual():
-                    return "Data"
-                if not r:
-                    r=element.id
-                return cleanup(r)
-            else:
-                c=self.build_context(here=element)
-                try:
-                    r=c.evaluateValue(expr)
-                except AdveneTalesException:
-                    r=element.content.data
-                if not r:
-                    r=element.id
-                return cleanup(r)
+            return trim_size(self.representation.get_title(element))
         if isinstance(element, RelationType):
             arrow = helper.chars.arrow_to
             return arrow + str(cleanup(element.title))
@@ -1464,9 +1591,16 @@ class AdveneController:
         video_info['framerate'] = framerate
         package.imagecache.video_info = video_info
 
+        # Check the stored checksum, if it is already known for this file
+        stored = package.getMetaData(config.data.namespace, "media_checksum")
+        computed = mediainfo.get(uri).get('checksum') if uri else None
+        if stored and computed and stored != computed:
+            logger.warning("The %s checksum does not match the information that was stored in the package.", uri)
+
         # Update package title and description if necessary
         self.update_package_title()
 
+    @model_modification
     def delete_element (self, el, immediate_notify=False, batch=None, undone=False):
         """Delete an element from its package.
 
@@ -1525,6 +1659,7 @@ class AdveneController:
             self.notify('ResourceDelete', resource=el, immediate=immediate_notify, undone=undone)
         return True
 
+    @model_modification
     def transmute_annotation(self, annotation, annotationType, delete=False, position=None, notify=True):
         """Transmute an annotation to a new type.
 
@@ -1617,6 +1752,7 @@ class AdveneController:
 
         return an
 
+    @model_modification
     def offset_element(self, el, offset, batch_id=None):
         """Offset (by time) the specified element.
 
@@ -1657,6 +1793,7 @@ class AdveneController:
             for e in el:
                 self.offset_element(e, offset, batch_id)
 
+    @model_modification
     def quick_completion_fill_annotation(self, annotation, index):
         """Quickly edit an annotation by using a completion at the given index.
 
@@ -1695,6 +1832,7 @@ class AdveneController:
         self.notify('EditSessionEnd', element=annotation)
         return True
 
+    @model_modification
     def duplicate_annotation(self, annotation):
         """Duplicate an annotation.
         """
@@ -1713,6 +1851,7 @@ class AdveneController:
         self.notify("AnnotationCreate", annotation=an, comment="Duplicate annotation")
         return an
 
+    @model_modification
     def split_annotation(self, annotation, position):
         """Split an annotation at the given position
         """
@@ -1743,6 +1882,7 @@ class AdveneController:
         self.notify("AnnotationCreate", annotation=an, comment="Split annotation")
         return an
 
+    @model_modification
     def merge_annotations(self, s, d, extend_bounds=False):
         """Merge annotation s into annotation d.
         """
@@ -1908,7 +2048,6 @@ class AdveneController:
             return None
         return metadata.get(val, {}).get('color', None)
 
-    STATIC_STRING_RE = re.compile('string:[^$]*')
     def get_element_color(self, element, metadata='color'):
         """Return the color for the given element.
 
@@ -1923,63 +2062,10 @@ class AdveneController:
         If not defined (or evaluating to None), it will try to use the
         'color' metadata of the container (annotation-type for
         annotations, schema for types).
-        """
 
-        def shortcut_evaluateValue(element, expr):
-            """Optimized version of evaluateValue
-
-            Common expressions (static strings, here/tag_color
-            expression) are evaluated without using the AdveneContext.
-            """
-            val = None
-
-            if not expr:
-                return None
-
-            if self.STATIC_STRING_RE.match(expr):
-                # Static value.
-                return expr[7:]
-
-            if expr == u'here/tag_color':
-                return self.get_tag_color_for_element(element)
-
-            if val is None:
-                # Previous shortcuts did not work. Go the slow way
-                # through a AdveneContext evaluation
-                logger.debug("unoptimized evaluation - %s", expr)
-                c = self.build_context(here=element)
-                try:
-                    val = c.evaluateValue(expr)
-                except Exception:
-                    logger.debug("Exception in color evaluation for %s", exc_info=True)
-                    val = None
-            return val
-
-        # First try the 'color' metadata from the element itself.
-        color = None
-        try:
-            expr = element.getMetaData(config.data.namespace, metadata)
-        except AttributeError:
-            return None
-        if expr:
-            color = shortcut_evaluateValue(element, expr)
-
-        if not color:
-            # Not found in element. Try item_color from the container.
-            if hasattr(element, 'type'):
-                container=element.type
-            elif hasattr(element, 'schema'):
-                container=element.schema
-            else:
-                container=None
-            if container:
-                expr = container.getMetaData(config.data.namespace, 'item_color')
-                if expr:
-                    color = shortcut_evaluateValue(element, expr)
-                if not color:
-                    # Really not found. So use the container color.
-                    color = self.get_element_color(container)
-        return color
+        Results are cached by the representation engine.
+        """
+        return self.representation.get_color(element, metadata)
 
     def load_package (self, uri=None, alias=None, activate=True, template=None):
         """Load a package.
@@ -2010,22 +2096,11 @@ class AdveneController:
             self.package.date = self.get_timestamp()
         elif uri.lower().endswith('.apl'):
             # Advene package list. Parse it and call 'load_package' for each package
-            def tag(i):
-                return ET.QName(config.data.namespace, i)
-
-            tree = ET.parse(urlopen(uri))
-            root = tree.getroot()
-            if root.tag != tag('package-list'):
-                raise Exception('Invalid XML element for session: ' + root.tag)
             default_alias=None
-            for node in root:
-                if node.tag == tag('package'):
-                    u=node.attrib['uri']
-                    a=node.attrib['alias']
-                    d='default' in node.attrib
-                    self.load_package(u, a, activate=False)
-                    if d:
-                        default_alias = a
+            for (u, a, d) in parse_package_list(uri):
+                self.load_package(u, a, activate=False)
+                if d:
+                    default_alias = a
                 if not default_alias:
                     # If no default package was specified, use the last one
                     default_alias = a
@@ -2069,6 +2144,7 @@ class AdveneController:
         self.set_default_media(self.package.getMedia(), self.package)
         self.package._idgenerator = advene.core.idgenerator.Generator(self.package)
         self.package._modified = False
+        self.package._revision = next_revision()
 
         # State dictionary
         self.package.state = DefaultDict(default=0)
@@ -2153,6 +2229,7 @@ class AdveneController:
             self.unregister_package('new_pkg')
         self.packages[alias] = package
         self.aliases[package] = alias
+        self.invalidate_context_templates()
 
     def unregister_package (self, alias):
         """Remove a package from the loaded packages lists.
@@ -2164,6 +2241,7 @@ class AdveneController:
         p = self.packages[alias]
         del self.aliases[p]
         del self.packages[alias]
+        self.invalidate_context_templates()
         if self.package == p:
             packages = [ a for a in self.packages.keys() if a != 'advene' ]
             # There should be at least 1 key
@@ -2177,6 +2255,7 @@ class AdveneController:
     def activate_package(self, alias=None):
         """Activate the package.
         """
+        self.invalidate_context_templates()
         if alias:
             self.package = self.packages[alias]
             self.current_alias = alias
@@ -2710,6 +2789,7 @@ class AdveneController:
         p = self.player
 
         pos=self.position_update ()
+        self.event_broadcaster.update_position(pos)
 
         if pos < self.last_position or pos > self.last_position + 1000:
             # We did a seek compared to the last time (backward, or
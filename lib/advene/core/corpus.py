@@ -0,0 +1,315 @@
+#
+# Advene: Annotate Digital Videos, Exchange on the NEt
+# Copyright (C) 2025 Olivier Aubert <contact@olivieraubert.net>
+#
+# Advene is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# Advene is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Advene; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+#
+"""Corpus index.
+
+A corpus is a set of packages, either loaded together in the
+controller (see L{advene.core.controller.GlobalPackage}) or given as
+a package list (.apl file) or list of package URIs.
+
+This module builds a read-only merged index of the corpus data
+(annotation types by title, annotation counts and durations), which
+answers corpus statistics without iterating over the package
+bundles. It is built either from loaded packages
+(L{CorpusIndex.from_packages}) or from package URIs
+(L{CorpusIndex.from_uris}). In the latter case, packages are loaded
+concurrently in worker processes, which only send back a summary of
+their content. Packages opened in the controller are still loaded
+one by one in the main process, since model elements cannot be
+passed between processes.
+
+It can also be used from the command line::
+
+  python3 -m advene.core.corpus [-j WORKERS] [-o stats.csv] corpus.apl
+"""
+
+import logging
+logger = logging.getLogger(__name__)
+
+from gettext import gettext as _
+
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import multiprocessing
+import os
+import re
+import sys
+from urllib.request import urlopen
+import xml.etree.ElementTree as ET
+
+if __name__ == '__main__':
+    # Do not let the config module parse our options
+    saved_args = sys.argv[1:]
+    sys.argv = [ sys.argv[0] ]
+
+import advene.core.config as config
+from advene.model.package import Package
+import advene.util.helper as helper
+
+def default_title(element):
+    """Return the title of an element, without a controller.
+    """
+    title = element.title or element.id
+    i = title.find('\n')
+    if i > 0:
+        title = title[:i]
+    return title
+
+def alias_from_uri(uri):
+    """Return a package alias generated from its URI.
+
+    This is the alias that the controller generates when loading a
+    package without an explicit alias.
+    """
+    alias, ext = os.path.splitext(os.path.basename(uri))
+    return re.sub('[^a-zA-Z0-9_]', '_', alias)
+
+def parse_package_list(uri):
+    """Parse an Advene package list (.apl).
+
+    @return: a list of (uri, alias, default) tuples
+    """
+    def tag(i):
+        return ET.QName(config.data.namespace, i)
+
+    tree = ET.parse(urlopen(uri))
+    root = tree.getroot()
+    if root.tag != tag('package-list'):
+        raise Exception('Invalid XML element for session: ' + root.tag)
+    return [ (node.attrib['uri'], node.attrib['alias'], 'default' in node.attrib)
+             for node in root
+             if node.tag == tag('package') ]
+
+def package_summary(package, alias=None, title=None):
+    """Return a summary of the package content.
+
+    The summary only contains basic data types, so that it can be
+    sent back from a worker process. Annotations are iterated only
+    once.
+
+    @param package: the package
+    @param alias: the package alias
+    @param title: a method returning the title of an element
+    @return: a dict
+    """
+    if title is None:
+        title = default_title
+    types = {}
+    for at in package.annotationTypes:
+        types[at.id] = { 'id': at.id,
+                         'title': title(at),
+                         'count': 0,
+                         'duration': 0,
+                         'begin': None,
+                         'end': None }
+    for a in package.annotations:
+        t = types.get(a.type.id)
+        if t is None:
+            continue
+        begin = a.fragment.begin
+        end = a.fragment.end
+        t['count'] += 1
+        t['duration'] += end - begin
+        if t['begin'] is None or begin < t['begin']:
+            t['begin'] = begin
+        if t['end'] is None or end > t['end']:
+            t['end'] = end
+    relation_types = {}
+    for rt in package.relationTypes:
+        relation_types[rt.id] = { 'id': rt.id,
+                                  'title': title(rt),
+                                  'count': 0 }
+    for r in package.relations:
+        t = relation_types.get(r.type.id)
+        if t is not None:
+            t['count'] += 1
+    duration = package.getMetaData(config.data.namespace, "duration")
+    try:
+        duration = int(float(duration))
+    except (TypeError, ValueError):
+        duration = None
+    return { 'alias': alias or alias_from_uri(package.uri),
+             'uri': package.uri,
+             'title': package.title or "",
+             'media': package.getMetaData(config.data.namespace, "mediafile") or "",
+             'duration': duration,
+             'annotation_count': sum(t['count'] for t in types.values()),
+             'relation_count': sum(t['count'] for t in relation_types.values()),
+             'annotation_types': list(types.values()),
+             'relation_types': list(relation_types.values()) }
+
+def summarize_uri(uri, alias=None):
+    """Load the package and return its summary.
+
+    This is executed in worker processes. Errors are returned in the
+    C{error} key of the summary.
+    """
+    try:
+        package = Package(uri=helper.path2uri(uri))
+    except Exception as e:
+        logger.error("Cannot load package %s", uri, exc_info=True)
+        return { 'alias': alias or alias_from_uri(uri),
+                 'uri': uri,
+                 'error': str(e) }
+    summary = package_summary(package, alias)
+    package.close()
+    return summary
+
+class CorpusIndex:
+    """Read-only merged index of corpus data.
+
+    @ivar packages: the package summaries, indexed by alias
+    @ivar errors: the summaries of packages which could not be loaded, indexed by alias
+    @ivar types_by_title: the annotation type summaries, indexed by type title, then package alias
+    @ivar relation_types_by_title: the relation type summaries, indexed by type title, then package alias
+    """
+    def __init__(self, summaries):
+        self.packages = {}
+        self.errors = {}
+        self.types_by_title = {}
+        self.relation_types_by_title = {}
+        for s in summaries:
+            if 'error' in s:
+                self.errors[s['alias']] = s
+                continue
+            alias = s['alias']
+            self.packages[alias] = s
+            for t in s['annotation_types']:
+                self.types_by_title.setdefault(t['title'], {})[alias] = t
+            for t in s['relation_types']:
+                self.relation_types_by_title.setdefault(t['title'], {})[alias] = t
+
+    @classmethod
+    def from_packages(cls, packages, title=None):
+        """Build the index from loaded packages.
+
+        @param packages: a dict of packages, indexed by alias
+        @param title: a method returning the title of an element
+        """
+        return cls(package_summary(p, alias, title) for (alias, p) in packages.items())
+
+    @classmethod
+    def from_uris(cls, uris, workers=None, callback=None):
+        """Build the index by loading packages in worker processes.
+
+        @param uris: a list of package URIs, or of (uri, alias) tuples
+        @param workers: the number of worker processes (default: number of CPUs)
+        @param callback: a method with signature (progress, message). If it returns False, the loading is canceled.
+        """
+        uris = [ (u, None) if isinstance(u, str) else tuple(u[:2]) for u in uris ]
+        if not uris:
+            return cls([])
+        summaries = {}
+        # Use the spawn method, since fork is unsafe when the GUI is running
+        with ProcessPoolExecutor(max_workers=workers,
+                                 mp_context=multiprocessing.get_context('spawn')) as executor:
+            futures = dict( (executor.submit(summarize_uri, uri, alias), i)
+                            for (i, (uri, alias)) in enumerate(uris) )
+            for n, future in enumerate(as_completed(futures)):
+                s = summaries[futures[future]] = future.result()
+                if callback is not None and callback(n / len(uris), _("Loaded %s") % s['uri']) is False:
+                    for f in futures:
+                        f.cancel()
+                    break
+        # Keep the package order
+        return cls(summaries[i] for i in sorted(summaries))
+
+    @classmethod
+    def from_package_list(cls, uri, workers=None, callback=None):
+        """Build the index from an Advene package list (.apl).
+        """
+        return cls.from_uris([ (u, a) for (u, a, d) in parse_package_list(uri) ],
+                             workers=workers, callback=callback)
+
+    def annotation_types_by_title_stats(self):
+        """Return the annotation counts for each package and annotation type title.
+
+        The first row is the header (package_alias and type titles),
+        the following ones hold the counts for each package (None if
+        the package has no such type).
+        """
+        titles = list(self.types_by_title)
+        rows = [ [ "package_alias", *titles ] ]
+        for alias in self.packages:
+            counts = [ (self.types_by_title[title][alias]['count']
+                        if alias in self.types_by_title[title] else None)
+                       for title in titles ]
+            rows.append([ alias, *counts ])
+        return rows
+
+    def annotation_count(self, title=None):
+        """Return the number of annotations, optionally restricted to a type title.
+        """
+        if title is None:
+            return sum(s['annotation_count'] for s in self.packages.values())
+        return sum(t['count'] for t in self.types_by_title.get(title, {}).values())
+
+    def annotation_duration(self, title=None):
+        """Return the total duration of annotations, optionally restricted to a type title.
+        """
+        if title is None:
+            return sum(t['duration']
+                       for s in self.packages.values()
+                       for t in s['annotation_types'])
+        return sum(t['duration'] for t in self.types_by_title.get(title, {}).values())
+
+    def packages_with_type(self, title):
+        """Return the aliases of the packages which define a type with the given title.
+        """
+        return list(self.types_by_title.get(title, {}))
+
+    def statistics(self):
+        """Return global statistics about the corpus.
+
+        @return: a dict
+        """
+        return { 'packages': len(self.packages),
+                 'errors': len(self.errors),
+                 'annotations': self.annotation_count(),
+                 'relations': sum(s['relation_count'] for s in self.packages.values()),
+                 'annotation_types': len(self.types_by_title),
+                 'relation_types': len(self.relation_types_by_title),
+                 'duration': sum(s['duration'] or 0 for s in self.packages.values()),
+                 'annotation_duration': self.annotation_duration() }
+
+if __name__ == '__main__':
+    import argparse
+    import csv
+
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description="Corpus statistics")
+    parser.add_argument('-j', '--workers', type=int, default=None,
+                        help="Number of worker processes")
+    parser.add_argument('-o', '--output', default=None,
+                        help="CSV output file for annotation type statistics")
+    parser.add_argument('packages', nargs='+',
+                        help="Package list (.apl) or packages")
+    args = parser.parse_args(saved_args)
+
+    if len(args.packages) == 1 and args.packages[0].lower().endswith('.apl'):
+        index = CorpusIndex.from_package_list(helper.path2uri(args.packages[0]), workers=args.workers)
+    else:
+        index = CorpusIndex.from_uris(args.packages, workers=args.workers)
+    for alias, s in index.errors.items():
+        logger.error("Cannot load %s: %s", s['uri'], s['error'])
+    for k, v in index.statistics().items():
+        print("%s: %s" % (k, v))
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8', newline='') as f:
+            csv.writer(f).writerows(index.annotation_types_by_title_stats())
+    else:
+        csv.writer(sys.stdout).writerows(index.annotation_types_by_title_stats())
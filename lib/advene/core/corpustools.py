@@ -108,7 +108,16 @@ class ProxyController:
         return c
 
 def corpus_website_export(controller, destination):
+    """Export the packages loaded in the controller as websites.
 
+    Packages are exported one after the other, since they are the
+    in-memory (possibly modified) packages of the controller. The
+    pages of each package are rendered in parallel by the
+    WebsiteExporter. To export saved packages in worker processes,
+    use L{advene.util.batchexport} with the WebsiteExporter.
+
+    @return: the filename of the corpus table of contents
+    """
     def log(*p):
         controller.log(*p)
 
@@ -0,0 +1,241 @@
+#
+# Advene: Annotate Digital Videos, Exchange on the NEt
+# Copyright (C) 2025 Olivier Aubert <contact@olivieraubert.net>
+#
+# Advene is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# Advene is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Advene; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+#
+"""Event stream module.
+
+This module dispatches the controller events (as notified to the
+ECAEngine) to external subscribers, typically web clients connected
+through Server-Sent Events.
+
+Each subscriber gets its own bounded queue, so that a slow client
+cannot slow down the application nor make the memory grow: when the
+queue is full, the oldest events are dropped, and the client is
+informed through an C{EventsDropped} event so that it can resync.
+
+Frequent events (position updates, seeks) are coalesced: if an event
+of the same name is still waiting in the queue, it is replaced by the
+new one instead of being appended, so that a slow client only gets
+the latest value.
+
+Besides the ECA events, the broadcaster emits C{PositionUpdate}
+events with the current player position, so that clients can follow
+the playback without polling.
+"""
+
+import logging
+logger = logging.getLogger(__name__)
+
+import asyncio
+import collections
+import json
+import threading
+import time
+
+from advene.model.annotation import Annotation, Relation
+from advene.model.package import Package
+
+# Delay (in s) between keepalive messages on idle event streams
+KEEPALIVE_DELAY = 15
+
+# Events for which only the latest pending occurrence is kept
+COALESCED_EVENTS = set(('PositionUpdate', 'PlayerSeek', 'DurationUpdate', 'EventsDropped'))
+
+def serialize_event(event_name, parameters):
+    """Convert event parameters into a JSON-serializable dict.
+
+    Model elements are replaced by their id (with additional time
+    information for annotations). Other non-scalar values (contexts,
+    views...) are ignored.
+    """
+    data = { 'event': event_name,
+             'timestamp': time.time() }
+    for k, v in parameters.items():
+        if isinstance(v, Annotation):
+            data[k] = { 'id': v.id,
+                        'type': v.type.id,
+                        'begin': v.fragment.begin,
+                        'end': v.fragment.end }
+        elif isinstance(v, Relation):
+            data[k] = { 'id': v.id,
+                        'type': v.type.id,
+                        'members': [ a.id for a in v.members ] }
+        elif isinstance(v, Package):
+            data[k] = v.uri
+        elif v is None or isinstance(v, (str, int, float, bool)):
+            data[k] = v
+        elif isinstance(getattr(v, 'id', None), str):
+            data[k] = v.id
+    return data
+
+def format_sse(event):
+    """Format a serialized event as a Server-Sent Events message.
+    """
+    return "event: %s\ndata: %s\n\n" % (event['event'], json.dumps(event, ensure_ascii=False))
+
+class Subscription:
+    """Bounded event queue for a subscriber.
+
+    This class is meant to be consumed from a thread, through the
+    blocking get() method.
+
+    @ivar events: the set of accepted event names (None for all events)
+    @ivar dropped: the number of events dropped because the queue was full
+    """
+    def __init__(self, events=None, size=100):
+        self.events = set(events) if events else None
+        self.size = size
+        # The queue holds 1-element lists, so that the pending
+        # holder of a coalesced event can be identified.
+        self.queue = collections.deque()
+        self.pending = {}
+        self.dropped = 0
+        self._cond = threading.Condition()
+
+    def accepts(self, event_name):
+        return (self.events is None
+                or event_name in self.events
+                or event_name == 'EventsDropped')
+
+    def _enqueue(self, event):
+        # Must be called with self._cond held
+        name = event['event']
+        if name in COALESCED_EVENTS:
+            stale = self.pending.get(name)
+            if stale is not None:
+                # Drop the pending event, and queue the new one at
+                # the tail, so that events keep their order.
+                for i, h in enumerate(self.queue):
+                    if h is stale:
+                        del self.queue[i]
+                        break
+            holder = [ event ]
+            self.pending[name] = holder
+        else:
+            holder = [ event ]
+        self.queue.append(holder)
+
+    def _popleft(self):
+        # Must be called with self._cond held
+        holder = self.queue.popleft()
+        event = holder[0]
+        if self.pending.get(event['event']) is holder:
+            del self.pending[event['event']]
+        return event
+
+    def _append(self, event):
+        with self._cond:
+            self._enqueue(event)
+            if len(self.queue) > self.size:
+                self._popleft()
+                self.dropped += 1
+                self._enqueue({ 'event': 'EventsDropped',
+                                'timestamp': event['timestamp'],
+                                'dropped': self.dropped })
+            self._cond.notify()
+
+    def put(self, event):
+        self._append(event)
+
+    def pop(self):
+        """Return the next event, or None if the queue is empty.
+        """
+        with self._cond:
+            if self.queue:
+                return self._popleft()
+            return None
+
+    def get(self, timeout=None):
+        """Return the next event.
+
+        Wait at most timeout seconds, and return None if no event
+        was available.
+        """
+        with self._cond:
+            if not self.queue:
+                self._cond.wait(timeout)
+        return self.pop()
+
+class AsyncSubscription(Subscription):
+    """Bounded event queue for a subscriber running in an asyncio loop.
+    """
+    def __init__(self, loop, events=None, size=100):
+        super().__init__(events, size)
+        self.loop = loop
+        self._ready = asyncio.Event()
+
+    def put(self, event):
+        self._append(event)
+        try:
+            self.loop.call_soon_threadsafe(self._ready.set)
+        except RuntimeError:
+            # The loop is closed.
+            pass
+
+    async def get(self, timeout=None):
+        if not self.queue:
+            self._ready.clear()
+            try:
+                await asyncio.wait_for(self._ready.wait(), timeout)
+            except asyncio.TimeoutError:
+                return None
+        return self.pop()
+
+class EventBroadcaster:
+    """Dispatch controller events to subscriptions.
+
+    The broadcaster registers itself as an ECAEngine listener, and
+    serializes each event once for all the matching subscriptions.
+
+    @ivar last_position: the last position sent in a PositionUpdate event
+    """
+    def __init__(self, controller):
+        self.controller = controller
+        self.subscriptions = []
+        self.last_position = None
+        self._lock = threading.Lock()
+        controller.event_handler.register_listener(self.dispatch)
+
+    def subscribe(self, subscription):
+        with self._lock:
+            self.subscriptions = self.subscriptions + [ subscription ]
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            self.subscriptions = [ s for s in self.subscriptions if s is not subscription ]
+
+    def dispatch(self, event_name, parameters):
+        # self.subscriptions is replaced (never modified in place),
+        # so it can be safely iterated without the lock.
+        targets = [ s for s in self.subscriptions if s.accepts(event_name) ]
+        if not targets:
+            return
+        event = serialize_event(event_name, parameters)
+        for s in targets:
+            s.put(event)
+
+    def update_position(self, position):
+        """Emit a PositionUpdate event if the position changed.
+
+        It is called from the controller update loop, so it returns
+        immediately if no subscription is interested.
+        """
+        if position == self.last_position or not self.subscriptions:
+            return
+        self.last_position = position
+        self.dispatch('PositionUpdate', { 'position': position })
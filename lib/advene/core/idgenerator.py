@@ -51,7 +51,7 @@ class Generator:
 
     def __init__(self, package=None):
         self.last_used={}
-        self.existing=[]
+        self.existing=set()
         for k in self.prefix:
             self.last_used[k]=0
         if package is not None:
@@ -65,15 +65,12 @@ class Generator:
     def add(self, id_):
         """Add a new known id.
         """
-        self.existing.append(id_)
+        self.existing.add(id_)
 
     def remove(self, id_):
         """Remove an id from the existing set.
         """
-        try:
-            self.existing.remove(id_)
-        except ValueError:
-            pass
+        self.existing.discard(id_)
 
     def init(self, package):
         """Initialize the indexes for the given package."""
@@ -89,7 +86,7 @@ class Generator:
                          package.annotationTypes, package.relationTypes,
                          package.views, package.queries):
             for i in elements.ids():
-                self.existing.append(i)
+                self.existing.add(i)
                 m = re_id.match(i)
                 if m:
                     n = int(m.group(2))
@@ -0,0 +1,323 @@
+#
+# Advene: Annotate Digital Videos, Exchange on the NEt
+# Copyright (C) 2025 Olivier Aubert <contact@olivieraubert.net>
+#
+# Advene is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# Advene is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Advene; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+#
+"""Representation engine.
+
+This module computes and caches the titles and colors of elements,
+as defined by the C{representation}, C{item_color} and C{color}
+metadata of the elements and their types.
+
+Expressions are compiled once: static strings and the common
+C{here/tag_color} expression are evaluated without TALES, and the
+type metadata is read only once per type. Results are cached per
+element, and invalidated when the element, its type or the package
+is modified.
+
+Results of arbitrary TALES expressions may depend on other elements
+(relations, other annotations...), so they are invalidated when any
+annotation or relation is modified.
+"""
+
+import logging
+logger = logging.getLogger(__name__)
+
+import re
+
+import advene.core.config as config
+from advene.model.tal.context import AdveneTalesException
+
+# Expressions that denote static strings
+STATIC_STRING_RE = re.compile(r'string:[^$]*', re.DOTALL)
+
+# Representation expressions that denote the default (content) representation
+DEFAULT_REPRESENTATION_RE = re.compile(r'^\s+')
+
+# Events which invalidate all cached values
+GLOBAL_INVALIDATION_EVENTS = set((
+    'PackageLoad',
+    'PackageActivate',
+    'PackageEditEnd',
+    'SchemaEditEnd',
+    'SchemaDelete',
+    'AnnotationTypeEditEnd',
+    'AnnotationTypeDelete',
+    'RelationTypeEditEnd',
+    'RelationTypeDelete',
+    'TagUpdate',
+))
+
+# Events which invalidate the cached values of a single element,
+# with the name of the element parameter
+ELEMENT_INVALIDATION_EVENTS = {
+    'AnnotationEditEnd': 'annotation',
+    'AnnotationDelete': 'annotation',
+    'RelationEditEnd': 'relation',
+    'RelationDelete': 'relation',
+}
+
+# Events which invalidate the values computed by TALES expressions
+DEPENDENT_INVALIDATION_EVENTS = set(ELEMENT_INVALIDATION_EVENTS).union((
+    'AnnotationCreate',
+    'RelationCreate',
+))
+
+# Marker for missing cache values (None is a valid color)
+_missing = object()
+
+class CompiledExpression:
+    """A compiled representation or color expression.
+
+    @ivar expr: the source expression
+    @ivar static: the value for static expressions
+    @ivar kind: 'static', 'tag_color' or 'tales'
+    @ivar local: True if the value depends only on the element itself
+    """
+    def __init__(self, expr):
+        self.expr = expr
+        self.static = None
+        if STATIC_STRING_RE.fullmatch(expr):
+            self.kind = 'static'
+            self.static = expr[7:]
+        elif expr == 'here/tag_color':
+            self.kind = 'tag_color'
+        else:
+            self.kind = 'tales'
+        self.local = self.kind != 'tales'
+
+    def evaluate(self, controller, element, context=None):
+        """Evaluate the expression for the given element.
+
+        Exceptions raised by TALES evaluation are propagated.
+
+        @param context: an optional context to reuse (for batch evaluation)
+        """
+        if self.kind == 'static':
+            return self.static
+        elif self.kind == 'tag_color':
+            return controller.get_tag_color_for_element(element)
+        if context is None:
+            context = controller.build_context(here=element)
+        else:
+            context.globals['here'] = element
+        return context.evaluateValue(self.expr)
+
+class RepresentationEngine:
+    """Compute and cache element titles and colors.
+
+    @ivar controller: the controller
+    @ivar titles: the cached titles, indexed by element
+    @ivar colors: the cached colors, indexed by (element, metadata)
+    """
+    def __init__(self, controller):
+        self.controller = controller
+        # Compiled expressions, indexed by expression
+        self.compiled = {}
+        # Compiled type metadata, indexed by (type, metadata name)
+        self.type_expressions = {}
+        self.titles = {}
+        self.colors = {}
+        # Keys of the cached values which depend on other elements,
+        # as (cache, key) tuples
+        self.dependent = set()
+        # Names of the color metadata used as keys in self.colors
+        self.color_metadata = set(('color',))
+
+    def clear(self):
+        """Invalidate all cached values.
+        """
+        self.type_expressions = {}
+        self.titles = {}
+        self.colors = {}
+        self.dependent = set()
+
+    def invalidate(self, element):
+        """Invalidate the cached values for the given element.
+        """
+        self.titles.pop(element, None)
+        for metadata in self.color_metadata:
+            self.colors.pop((element, metadata), None)
+
+    def invalidate_dependent(self):
+        """Invalidate the cached values which depend on other elements.
+        """
+        for cache, key in self.dependent:
+            getattr(self, cache).pop(key, None)
+        self.dependent = set()
+
+    def update_for_event(self, event_name, parameters):
+        """Invalidate cached values according to the event.
+
+        It is called by the controller for every notified event.
+        """
+        if event_name in GLOBAL_INVALIDATION_EVENTS:
+            self.clear()
+            return
+        name = ELEMENT_INVALIDATION_EVENTS.get(event_name)
+        if name is not None:
+            self.invalidate(parameters.get(name))
+        if event_name in DEPENDENT_INVALIDATION_EVENTS:
+            self.invalidate_dependent()
+
+    def compile(self, expr):
+        """Return the CompiledExpression for expr, or None if expr is empty.
+        """
+        if not expr:
+            return None
+        try:
+            return self.compiled[expr]
+        except KeyError:
+            c = self.compiled[expr] = CompiledExpression(expr)
+            return c
+
+    def type_expression(self, container, metadata):
+        """Return the compiled metadata expression for the given container.
+
+        For the representation metadata, None denotes the default
+        (content) representation.
+        """
+        key = (container, metadata)
+        try:
+            return self.type_expressions[key]
+        except KeyError:
+            pass
+        expr = container.getMetaData(config.data.namespace, metadata)
+        if metadata == 'representation' and expr and DEFAULT_REPRESENTATION_RE.match(expr):
+            expr = None
+        c = self.type_expressions[key] = self.compile(expr)
+        return c
+
+    def _store(self, cache, key, value, local):
+        getattr(self, cache)[key] = value
+        if not local:
+            self.dependent.add((cache, key))
+
+    def get_title(self, element, context=None):
+        """Return the title of an annotation or relation.
+
+        The returned title is the first line of the representation,
+        not trimmed.
+
+        @param context: an optional context to reuse (for batch evaluation)
+        """
+        title = self.titles.get(element, _missing)
+        if title is not _missing:
+            return title
+        compiled = self.type_expression(element.type, 'representation')
+        if compiled is None:
+            local = True
+            if element.content.mimetype == 'image/svg+xml':
+                title = "SVG graphics"
+            elif not element.content.isTextual():
+                title = "Data"
+            else:
+                title = element.content.data
+        else:
+            local = compiled.local
+            try:
+                title = compiled.evaluate(self.controller, element, context)
+            except AdveneTalesException:
+                title = element.content.data
+        if not title:
+            title = element.id
+        if not isinstance(title, str):
+            title = str(title)
+        i = title.find('\n')
+        if i > 0:
+            title = title[:i]
+        self._store('titles', element, title, local)
+        return title
+
+    def _evaluate_color(self, element, compiled, context):
+        if compiled is None:
+            return None
+        if compiled.kind == 'tales':
+            logger.debug("unoptimized evaluation - %s", compiled.expr)
+        try:
+            return compiled.evaluate(self.controller, element, context)
+        except Exception:
+            logger.debug("Exception in color evaluation for %s", compiled.expr, exc_info=True)
+            return None
+
+    def get_color(self, element, metadata='color', context=None):
+        """Return the color for the given element.
+
+        See L{advene.core.controller.AdveneController.get_element_color}
+        for the semantics.
+
+        @param context: an optional context to reuse (for batch evaluation)
+        """
+        key = (element, metadata)
+        color = self.colors.get(key, _missing)
+        if color is not _missing:
+            return color
+
+        # First try the metadata from the element itself.
+        try:
+            expr = element.getMetaData(config.data.namespace, metadata)
+        except AttributeError:
+            return None
+        self.color_metadata.add(metadata)
+        compiled = self.compile(expr)
+        local = compiled is None or compiled.local
+        color = self._evaluate_color(element, compiled, context)
+
+        if not color:
+            # Not found in element. Try item_color from the container.
+            if hasattr(element, 'type'):
+                container = element.type
+            elif hasattr(element, 'schema'):
+                container = element.schema
+            else:
+                container = None
+            if container:
+                compiled = self.type_expression(container, 'item_color')
+                if compiled is not None:
+                    local = local and compiled.local
+                    color = self._evaluate_color(element, compiled, context)
+                if not color:
+                    # Really not found. So use the container color.
+                    color = self.get_color(container)
+                    local = local and ('colors', (container, 'color')) not in self.dependent
+        self._store('colors', key, color, local)
+        return color
+
+    def get_titles(self, elements):
+        """Return the titles for a list of annotations or relations.
+
+        A single context is used for all TALES evaluations.
+        """
+        context = None
+        res = []
+        for element in elements:
+            if context is None and element not in self.titles:
+                context = self.controller.build_context(here=element)
+            res.append(self.get_title(element, context))
+        return res
+
+    def get_colors(self, elements, metadata='color'):
+        """Return the colors for a list of elements.
+
+        A single context is used for all TALES evaluations.
+        """
+        context = None
+        res = []
+        for element in elements:
+            if context is None and (element, metadata) not in self.colors:
+                context = self.controller.build_context(here=element)
+            res.append(self.get_color(element, metadata, context))
+        return res
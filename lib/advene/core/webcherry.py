@@ -43,10 +43,19 @@ import re
 import urllib.request, urllib.parse, urllib.error
 import html
 import socket
+import hashlib
+import bisect
+import importlib
+import json
+import math
+import threading
+import time
+from collections import OrderedDict
 
 from gettext import gettext as _
 
 import cherrypy
+from cherrypy.lib import cptools, httputil
 
 if int(cherrypy.__version__.split('.')[0]) < 3:
     raise Exception("The webserver requires version 3.0 of CherryPy at least.")
@@ -56,14 +65,133 @@ from advene.model.annotation import Annotation, Relation
 from advene.model.view import View
 from advene.model.resources import Resources
 from advene.model.exception import AdveneException
+from advene.core.eventstream import Subscription, format_sse, KEEPALIVE_DELAY
 import advene.util.helper as helper
-from advene.util.tools import image_type
+from advene.util.tools import image_type, next_revision
 
 import simpletal.simpleTAL
 import simpletal.simpleTALES as simpleTALES
 
 
 DEBUG=True
+
+# Root symbols whose value does not depend only on the package
+# content. A TALES evaluation using one of them cannot be cached.
+VOLATILE_ROOTS = set(('player', 'controller', 'packages', 'corpus', 'context', 'event'))
+
+class CachedResponse:
+    """A rendered response, with its cache validators.
+    """
+    def __init__(self, body, contenttype):
+        self.body = body
+        self.contenttype = contenttype
+        self.etag = '"%s"' % hashlib.sha1(body).hexdigest()
+        self.last_modified = httputil.HTTPDate(time.time())
+
+class ResponseCache:
+    """LRU cache of rendered /packages responses.
+
+    Entries are keyed on the package alias and uri, the package
+    revision (a process-wide serial number, updated by the controller
+    on load and on every modifying event), the TALES path, the query
+    and the display mode. Outdated entries are thus never returned,
+    and are discarded when the cache is full.
+    """
+    def __init__(self, size=256):
+        self.size = size
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def key(self, alias, package, tales, query, displaymode):
+        return (alias,
+                package.uri,
+                getattr(package, '_revision', 0),
+                tales,
+                tuple(sorted( (k, str(v)) for (k, v) in query.items() )),
+                query.get('mode', displaymode),
+                cherrypy.request.base)
+
+    def get(self, key):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None:
+                self._data.move_to_end(key)
+            return entry
+
+    def store(self, key, res, contenttype):
+        """Store the response parts res and return the CachedResponse.
+        """
+        body = b"".join( (r.encode('utf-8') if isinstance(r, str) else bytes(r))
+                         for r in res )
+        entry = CachedResponse(body, contenttype)
+        if self.size:
+            with self._lock:
+                self._data[key] = entry
+                self._data.move_to_end(key)
+                while len(self._data) > self.size:
+                    self._data.popitem(last=False)
+        return entry
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+class AnnotationIndex:
+    """Time index of the annotations of a package.
+
+    Annotations are sorted by (begin, id), which is also the order
+    used for cursor-based pagination. The index is built for a given
+    package revision, and must be rebuilt when it is outdated (see
+    L{get_annotation_index}).
+    """
+    def __init__(self, annotations, revision=0):
+        self.revision = revision
+        self.annotations = sorted(annotations, key=lambda a: (a.fragment.begin, a.id))
+        self.keys = [ (a.fragment.begin, a.id) for a in self.annotations ]
+        self.ends = [ a.fragment.end for a in self.annotations ]
+        self.max_duration = max( (e - k[0] for (k, e) in zip(self.keys, self.ends)), default=0)
+
+    def search(self, begin=None, end=None, cursor=None):
+        """Iterate over annotations overlapping [begin, end].
+
+        If cursor is specified, it is a (begin, id) tuple and only
+        annotations located after it are returned.
+        """
+        start = 0
+        if begin is not None:
+            # An annotation overlapping begin cannot start before
+            # begin - max_duration.
+            start = bisect.bisect_left(self.keys, (begin - self.max_duration, ))
+        if cursor is not None:
+            start = max(start, bisect.bisect_right(self.keys, cursor))
+        stop = len(self.keys)
+        if end is not None:
+            stop = bisect.bisect_right(self.keys, (end, chr(0x10ffff)))
+        for i in range(start, stop):
+            if begin is not None and self.ends[i] < begin:
+                continue
+            yield self.annotations[i]
+
+def get_annotation_index(element):
+    """Return an up-to-date AnnotationIndex for the element annotations.
+
+    element can be a package or an annotation type. Indexes are
+    cached in the owner package, and rebuilt when its revision
+    changes.
+    """
+    package = element.ownerPackage
+    revision = getattr(package, '_revision', 0)
+    try:
+        indexes = package._annotation_indexes
+    except AttributeError:
+        indexes = package._annotation_indexes = {}
+    # Packages have no id: use None as key.
+    key = getattr(element, 'id', None)
+    index = indexes.get(key)
+    if index is None or index.revision != revision:
+        index = indexes[key] = AnnotationIndex(element.annotations, revision)
+    return index
+
 class Common:
     """Common functionalities for all cherrypy nodes.
     """
@@ -121,6 +249,56 @@ class Common:
         cherrypy.response.headers['Pragma']='no-cache'
         cherrypy.response.headers['Cache-Control']='max-age=0'
 
+    def send_cached_response(self, entry):
+        """Send a CachedResponse.
+
+        The ETag and Last-Modified validators are sent along with the
+        response, and a 304 (Not Modified) response is sent if the
+        client already holds a valid copy.
+
+        @param entry: the cached response
+        @type entry: CachedResponse
+        """
+        cherrypy.response.status = 200
+        cherrypy.response.headers['Content-type'] = entry.contenttype
+        cherrypy.response.headers['ETag'] = entry.etag
+        cherrypy.response.headers['Last-Modified'] = entry.last_modified
+        self.no_cache ()
+        cptools.validate_etags()
+        cptools.validate_since()
+        return [ entry.body ]
+
+    def run_in_mainloop(self, method, *args, **kw):
+        """Execute a modifying method in the application mainloop.
+
+        The method is serialized with the other modifications through
+        the controller queue (and thus with the model writer lock
+        held). The current request and response objects are made
+        available to the method, so that it can use the usual
+        cherrypy API.
+        """
+        request, response = cherrypy.serving.request, cherrypy.serving.response
+        def wrapper():
+            previous = cherrypy.serving.request, cherrypy.serving.response
+            cherrypy.serving.load(request, response)
+            try:
+                return method(*args, **kw)
+            finally:
+                cherrypy.serving.load(*previous)
+        try:
+            return self.controller.execute_in_mainloop(wrapper)
+        except TimeoutError as e:
+            return self.send_error(503, str(e))
+
+    def check_cacheable(self, context):
+        """Mark the current response as uncacheable if needed.
+
+        The response cannot be cached if the evaluation in context
+        used some volatile data (player, controller...).
+        """
+        if context.accessed_roots.intersection(VOLATILE_ROOTS):
+            cherrypy.request.advene_cacheable = False
+
     def start_html (self, title="", headers=None, head_section="", body_attributes="",
                     mode=None, mimetype=None, duplicate_title=False, cache=False, data=None):
         """Starts writing a HTML response (header + common body start).
@@ -332,6 +510,7 @@ class Media(Common):
        - C{/media/pause}
        - C{/media/stop}
        - C{/media/current}
+       - C{/media/waveform}
 
      Accessing the folder itself will display the media status.
 
@@ -378,6 +557,16 @@ class Media(Common):
            at the beginning.
          - C{stbv=...} : the id of a STBV to activate
 
+     The X{/media/waveform} element
+     ------------------------------
+
+       The path C{/media/waveform/package_alias} returns the waveform
+       envelope of the package media as JSON, if its peak pyramid has
+       been computed (by the sound enveloppe importer). It takes the
+       C{begin} and C{end} (in ms, default: the whole media) and
+       C{width} (number of values, default 1000) options, and returns
+       a dict with C{begin}, C{end}, C{min} and C{max} keys.
+
      The X{/media/stop} and X{/media/pause} elements
      -----------------------------------------------
 
@@ -451,10 +640,51 @@ class Media(Common):
 
         snapshot = self.controller.get_snapshot(position, media=p.media)
         cherrypy.response.headers['Content-type']=snapshot.contenttype
+        if snapshot.is_default:
+            self.no_cache()
+        else:
+            # A captured snapshot does not change for a given media
+            # and position, so the client can keep it.
+            cherrypy.response.headers['Cache-Control'] = 'public, max-age=31536000, immutable'
+            cherrypy.response.headers['ETag'] = '"%s-%d"' % (helper.mediafile2id(p.getMedia() or ''), position)
+            cptools.validate_etags()
         res.append (bytes(snapshot))
         return res
     snapshot.exposed=True
 
+    def waveform(self, *args, **params):
+        """Return the waveform envelope of the package media.
+        """
+        # waveform syntax: /media/waveform/package_alias?begin=0&end=1000&width=200
+        try:
+            waveform = importlib.import_module('advene.util.waveform')
+        except ImportError:
+            return self.send_error(501, _("Waveform data is not available (numpy is missing)"))
+        if not args:
+            return self.send_error(400, _("Missing package alias"))
+        try:
+            p = self.controller.packages[args[0]]
+        except KeyError:
+            return self.send_error(400, _("Unknown package alias"))
+        pyramid = waveform.get_pyramid(self.controller.get_default_media(p))
+        if pyramid is None:
+            return self.send_error(404, _("No waveform data for %s") % args[0])
+        try:
+            begin = float(params.get('begin', pyramid.start))
+            end = float(params.get('end', pyramid.start + pyramid.duration))
+            width = min(int(params.get('width', 1000)), 100000)
+        except ValueError:
+            return self.send_error(400, _("Invalid parameters"))
+        if width < 1 or not (math.isfinite(begin) and math.isfinite(end)):
+            return self.send_error(400, _("Invalid parameters"))
+        mins, maxs = pyramid.envelope(begin, end, width)
+        cherrypy.response.headers['Content-type'] = 'application/json'
+        return json.dumps({ 'begin': begin,
+                            'end': end,
+                            'min': [ round(v, 4) for v in mins.tolist() ],
+                            'max': [ round(v, 4) for v in maxs.tolist() ] }).encode('utf-8')
+    waveform.exposed=True
+
     def overlay(self, *args, **params):
         """Return the overlayed snapshot for the given annotation.
 
@@ -497,14 +727,16 @@ class Media(Common):
             path=[ 'here' ]
             path.extend(args[2:])
             path='/'.join(path)
-            ctx=self.controller.build_context(here=a)
-            svg_data=ctx.evaluateValue(path)
+            with self.controller.model_lock.reader():
+                ctx=self.controller.build_context(here=a)
+                svg_data=ctx.evaluateValue(path)
         elif 'svg' in a.content.mimetype:
             # Overlay svg
             svg_data=a.content.data
         else:
             # Overlay annotation title
-            svg_data=self.controller.get_title(a)
+            with self.controller.model_lock.reader():
+                svg_data=self.controller.get_title(a)
 
         if self.controller.gui:
             img=self.controller.gui.overlay(snapshot, svg_data, other_thread=True)
@@ -1003,9 +1235,7 @@ class Admin(Common):
             return self.send_error (501,
                                     _("""You should specify an uri"""))
         try:
-            # FIXME: potential problem: this method executes in the webserver thread, which may
-            # cause problems with the GUI
-            self.controller.load_package (uri=uri, alias=alias)
+            self.controller.execute_in_mainloop(self.controller.load_package, uri=uri, alias=alias)
             return "".join( (
                 self.start_html (_("Package %s loaded") % alias, duplicate_title=True, mode='navigation'),
                 _("""<p>Go to the <a href="/packages/%(alias)s">%(alias)s</a> package, or to the <a href="/packages">package list</a>.""") % { 'alias': alias }
@@ -1020,7 +1250,7 @@ class Admin(Common):
         """Unload a package.
         """
         try:
-            self.controller.unregister_package (alias)
+            self.controller.execute_in_mainloop(self.controller.unregister_package, alias)
             return "".join((
                 self.start_html (_("Package %s deleted") % alias, duplicate_title=True, mode='navigation'),
                 _("""<p>Go to the <a href="/packages">package list</a>.""")
@@ -1038,9 +1268,9 @@ class Admin(Common):
         try:
             if alias is not None:
                 # Save a specific package
-                self.controller.save_package(alias=alias)
+                self.controller.execute_in_mainloop(self.controller.save_package, alias=alias)
             else:
-                self.controller.save_package()
+                self.controller.execute_in_mainloop(self.controller.save_package)
                 alias='default'
             return "".join((
                 self.start_html (_("Package %s saved") % alias, duplicate_title=True, mode='navigation'),
@@ -1195,6 +1425,7 @@ class Packages(Common):
             res.append(_("""The TALES expression %s is not valid.""") % tales)
             res.append(str(e.args[0]))
             return
+        self.check_cacheable(context)
 
         displaymode = self.controller.server.displaymode
         # Hack to automatically switch to an image view for image objects.
@@ -1209,6 +1440,10 @@ class Packages(Common):
             displaymode = 'image'
 
         logger.debug("Displaying %s in %s mode", objet, displaymode)
+        if displaymode == 'image' or hasattr(objet, 'is_default'):
+            # Images may come from the imagecache, which is not
+            # covered by the package revision.
+            cherrypy.request.advene_cacheable = False
         if displaymode == 'image':
             # Return an image, so build the correct headers
             try:
@@ -1256,6 +1491,7 @@ class Packages(Common):
             context.setLocal('view', objet)
             try:
                 v = objet.view(context=context)
+                self.check_cacheable(context)
                 #import pdb;pdb.set_trace()
                 res.append(self.start_html(mimetype=v.contenttype, mode=displaymode, data=v))
                 res.append(v)
@@ -1430,16 +1666,38 @@ class Packages(Common):
 
         tales = "/".join (args[1:])
 
-        if cherrypy.request.method == 'PUT':
-            return self.handle_put_request(*args, **query)
-        elif cherrypy.request.method == 'POST':
-            return self.handle_post_request(*args, **query)
+        if cherrypy.request.method in ('PUT', 'POST'):
+            handler = self.handle_put_request if cherrypy.request.method == 'PUT' else self.handle_post_request
+            def modify(*args, **query):
+                try:
+                    return handler(*args, **query)
+                finally:
+                    # Modifications done through PUT/POST do not
+                    # always emit a notification. Invalidate cached
+                    # data in any case, once the modification is done
+                    # and while the writer lock is still held, so
+                    # that a concurrent GET cannot cache the previous
+                    # state under the new revision.
+                    p._revision = next_revision()
+                    self.controller.representation.clear()
+            return self.run_in_mainloop(modify, *args, **query)
         elif cherrypy.request.method != 'GET':
             return self.send_error(400, 'Unknown method: %s' % cherrypy.request.method)
 
         logger.debug("Evaluating %s", tales)
+        cache = self.controller.server.response_cache
+        # Build the key before display_package_element, which may
+        # modify query.
+        key = cache.key(pkgid, p, tales, query, self.controller.server.displaymode)
+        entry = cache.get(key)
+        if entry is not None:
+            return self.send_cached_response(entry)
+        cherrypy.request.advene_cacheable = True
         try:
-            return self.display_package_element (p , tales, query)
+            with self.controller.model_lock.reader():
+                res = self.display_package_element (p , tales, query)
+            if res is not None and cherrypy.request.advene_cacheable:
+                entry = cache.store(key, res, cherrypy.response.headers['Content-type'])
         except simpletal.simpleTAL.TemplateParseException as e:
             res=[ self.start_html(_("Error")) ]
             res.append(_("<h1>Error</h1>"))
@@ -1469,6 +1727,10 @@ class Packages(Common):
                 'value': str(v),
                 'traceback': "\n".join(code.traceback.format_tb (tr)) })
 
+        if entry is not None:
+            # Sent outside of the try block, since it may raise a
+            # 304 redirection.
+            return self.send_cached_response(entry)
         return res
     default.exposed=True
 
@@ -2033,6 +2295,186 @@ class Action(Common):
         return self.send_no_content()
     default.exposed=True
 
+class Api(Common):
+    """Handles the X{/api} JSON access requests.
+
+    URL syntax
+    ==========
+
+      - C{/api/alias/annotations} : annotations, sorted by begin time
+      - C{/api/alias/relations} : relations
+      - C{/api/alias/annotationtypes} : annotation types
+      - C{/api/alias/relationtypes} : relation types
+      - C{/api/alias/views} : views
+
+    Parameters
+    ==========
+
+      - C{fields} : comma-separated list of the fields to return
+      - C{limit} : maximum number of items to return (default 100,
+        0 for no limit)
+      - C{cursor} : opaque value from the C{next} key of a previous
+        response, used to get the next items
+      - C{type} : annotation/relation type id (annotations and relations only)
+      - C{begin}, C{end} : time range in ms (annotations only). The
+        annotations overlapping the range are returned.
+
+    The response is a JSON object C{{"items": [...], "next": cursor}},
+    where C{next} is null if there are no more items. It is streamed,
+    so that large result sets are not built in memory.
+    """
+    _cp_config = { 'response.stream': True }
+
+    DEFAULT_LIMIT = 100
+
+    def __init__(self, controller=None):
+        super().__init__(controller)
+        c = self.controller
+        def media(el):
+            return el.ownerPackage.getMetaData(config.data.namespace, "media_uri") or el.ownerPackage.getMedia()
+        common = {
+            'id': lambda e: e.id,
+            'title': lambda e: c.get_title(e),
+            'creator': lambda e: e.author,
+            'date': lambda e: e.date,
+            'color': lambda e: c.get_element_color(e),
+        }
+        content = {
+            'content_type': lambda e: e.content.mimetype,
+            'content': lambda e: e.content.data,
+        }
+        typed = {
+            'type': lambda e: e.type.id,
+            'type_title': lambda e: c.get_title(e.type),
+            'tags': lambda e: list(e.tags),
+        }
+        self.fields = {
+            'annotations': dict(common, **content, **typed,
+                                media=media,
+                                begin=lambda a: a.fragment.begin,
+                                end=lambda a: a.fragment.end,
+                                duration=lambda a: a.fragment.duration),
+            'relations': dict(common, **content, **typed,
+                              members=lambda r: [ a.id for a in r.members ]),
+            'annotationtypes': dict(common,
+                                    content_type=lambda t: t.mimetype,
+                                    schema=lambda t: t.schema.id,
+                                    count=lambda t: len(t.annotations)),
+            'relationtypes': dict(common,
+                                  content_type=lambda t: t.mimetype,
+                                  schema=lambda t: t.schema.id,
+                                  count=lambda t: len(t.relations)),
+            'views': dict(common, **content,
+                          view_class=lambda v: v.matchFilter['class']),
+        }
+        self.default_fields = {
+            'annotations': ('id', 'type', 'begin', 'end', 'content'),
+            'relations': ('id', 'type', 'members', 'content'),
+            'annotationtypes': ('id', 'title', 'content_type', 'count'),
+            'relationtypes': ('id', 'title', 'content_type', 'count'),
+            'views': ('id', 'title', 'view_class', 'content_type'),
+        }
+
+    def index(self):
+        cherrypy.response.headers['Content-type'] = 'application/json'
+        return json.dumps({ 'packages': list(self.controller.packages),
+                            'collections': list(self.fields) }).encode('utf-8')
+    index.exposed=True
+
+    def default(self, *args, **query):
+        if len(args) != 2:
+            return self.send_error(404, _("Invalid API path. It should be /api/alias/collection"))
+        alias, collection = args
+        try:
+            p = self.controller.packages[alias]
+        except KeyError:
+            return self.send_error(404, _("Unknown package alias %s") % alias)
+        if collection not in self.fields:
+            return self.send_error(404, _("Unknown collection %s") % collection)
+
+        available = self.fields[collection]
+        if query.get('fields'):
+            fields = query['fields'].split(',')
+            unknown = [ f for f in fields if f not in available ]
+            if unknown:
+                return self.send_error(400, _("Unknown field(s): %s") % ", ".join(unknown))
+        else:
+            fields = self.default_fields[collection]
+        getters = [ (f, available[f]) for f in fields ]
+
+        try:
+            limit = int(query.get('limit', self.DEFAULT_LIMIT))
+            begin = int(query['begin']) if 'begin' in query else None
+            end = int(query['end']) if 'end' in query else None
+        except ValueError:
+            return self.send_error(400, _("Invalid numeric parameter"))
+        cursor = query.get('cursor') or None
+
+        if collection == 'annotations':
+            source = p
+            if 'type' in query:
+                source = helper.get_id(p.annotationTypes, query['type'])
+                if source is None:
+                    return self.send_error(404, _("Unknown annotation type %s") % query['type'])
+            if cursor is not None:
+                # The cursor is the begin:id of the last returned annotation
+                b, _sep, i = cursor.partition(':')
+                try:
+                    cursor = (int(b), i)
+                except ValueError:
+                    return self.send_error(400, _("Invalid cursor"))
+            with self.controller.model_lock.reader():
+                elements = get_annotation_index(source).search(begin, end, cursor)
+            def next_cursor(a):
+                return "%d:%s" % (a.fragment.begin, a.id)
+        else:
+            if collection == 'relations' and 'type' in query:
+                source = helper.get_id(p.relationTypes, query['type'])
+                if source is None:
+                    return self.send_error(404, _("Unknown relation type %s") % query['type'])
+                elements = source.relations
+            else:
+                elements = getattr(p, { 'relations': 'relations',
+                                        'annotationtypes': 'annotationTypes',
+                                        'relationtypes': 'relationTypes',
+                                        'views': 'views' }[collection])
+            # Other collections are smaller: sort by id, the cursor is the last returned id.
+            elements = sorted(elements, key=lambda e: e.id)
+            if cursor is not None:
+                elements = elements[bisect.bisect_right([ e.id for e in elements ], cursor):]
+            def next_cursor(e):
+                return e.id
+
+        cherrypy.response.headers['Content-type'] = 'application/json; charset=utf-8'
+        self.no_cache()
+        return self.stream_items(elements, getters, limit, next_cursor)
+    default.exposed=True
+
+    def stream_items(self, elements, getters, limit, next_cursor):
+        """Return the JSON response, as a list of chunks (one per item).
+
+        The page is serialized while holding the model reader lock,
+        which is released before the chunks are sent, so that a slow
+        client does not block model modifications.
+        """
+        with self.controller.model_lock.reader():
+            chunks = [ '{"items": [' ]
+            count = 0
+            last = None
+            for el in elements:
+                if limit and count >= limit:
+                    break
+                chunks.append(('' if count == 0 else ',\n') + json.dumps(dict( (name, getter(el)) for (name, getter) in getters ),
+                                                                          ensure_ascii=False))
+                count += 1
+                last = el
+            else:
+                # All elements have been sent
+                last = None
+            chunks.append('], "next": %s}' % json.dumps(next_cursor(last) if last is not None else None))
+        # The encode tool only handles text/* content
+        return iter([ c.encode('utf-8') for c in chunks ])
+
 class Root(Common):
     """Common methods for all web resources.
 
@@ -2046,9 +2488,13 @@ class Root(Common):
       - C{/media} : control the player
       - C{/action} : list and invoke Advene actions
       - C{/application} : control the application
+      - C{/api} : JSON access to packages data
+      - C{/events} : Server-Sent Events stream of the application events
     """
     def __init__(self, controller=None):
         super().__init__(controller)
+        self.event_clients = threading.BoundedSemaphore(config.data.webserver.get('event-clients', 4))
+        self.api=Api(controller)
         self.admin=Admin(controller)
         self.admin.access=Access(controller)
         self.action=Action(controller)
@@ -2064,6 +2510,57 @@ class Root(Common):
         return _("Advene web resources")
     data.exposed=True
 
+    def events(self, **query):
+        """Stream the application events (Server-Sent Events).
+
+        The optional C{events} parameter is a comma-separated list of
+        event names to receive, e.g.
+        C{/events?events=AnnotationBegin,AnnotationEnd,PositionUpdate}.
+        All events are sent if it is not specified.
+
+        Position updates are coalesced, and the oldest events are
+        dropped (with an C{EventsDropped} notification) for clients
+        that do not keep up. Since each client holds a server thread,
+        the number of simultaneous clients is limited by the
+        C{event-clients} webserver setting.
+        """
+        if not self.event_clients.acquire(blocking=False):
+            return self.send_error(503, _("Too many event stream clients"))
+        events = [ e for e in query.get('events', '').split(',') if e ]
+        subscription = self.controller.event_broadcaster.subscribe(Subscription(events=events))
+        cherrypy.response.headers['Content-Type'] = 'text/event-stream; charset=utf-8'
+        cherrypy.response.headers['Cache-Control'] = 'no-cache'
+        # Do not buffer the stream in proxies
+        cherrypy.response.headers['X-Accel-Buffering'] = 'no'
+
+        released = threading.Lock()
+        def release():
+            # Called at the end of the stream, and at the end of the
+            # request, since the stream may never be iterated (HEAD
+            # requests, errors before streaming).
+            if released.acquire(blocking=False):
+                self.controller.event_broadcaster.unsubscribe(subscription)
+                self.event_clients.release()
+        cherrypy.request.hooks.attach('on_end_request', release)
+
+        def stream():
+            try:
+                yield ": connected\n\n"
+                while cherrypy.engine.state == cherrypy.engine.states.STARTED:
+                    event = subscription.get(timeout=KEEPALIVE_DELAY)
+                    if event is None:
+                        yield ": keepalive\n\n"
+                    else:
+                        yield format_sse(event)
+            finally:
+                # Executed on client disconnection (GeneratorExit)
+                release()
+        return stream()
+    events.exposed=True
+    events._cp_config = { 'response.stream': True,
+                          'tools.encode.on': True,
+                          'tools.encode.encoding': 'utf-8' }
+
     def index(self):
         """Display the server root document.
         """
@@ -2153,6 +2650,9 @@ class AdveneWebServer:
 
         self.displaymode = config.data.webserver['displaymode']
 
+        # Cache for rendered /packages responses
+        self.response_cache = ResponseCache(size=config.data.webserver.get('cache-size', 256))
+
         # Not used for the moment.
         self.authorized_hosts = {'127.0.0.1': 'localhost'}
 
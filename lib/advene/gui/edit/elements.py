@@ -220,8 +220,9 @@ class EditElementPopup (AdhocView, metaclass=EditPopupClass):
             if not f.check_validity():
                 return False
 
-        for f in self.forms:
-            f.update_element ()
+        with self.controller.modifying_model():
+            for f in self.forms:
+                f.update_element ()
 
         # The children classes can define a notify method, which will
         # be called upon modification of the element, in order to
@@ -91,6 +91,7 @@ import advene.model.tal.context
 
 import advene.core.mediacontrol
 import advene.util.helper as helper
+import advene.util.mediainfo as mediainfo
 from advene.util.tools import unescape_string, open_in_filebrowser, detect_by_bom, printable
 from advene.core.corpustools import corpus_website_export
 import xml.etree.ElementTree as ET
@@ -1193,7 +1194,7 @@ class AdveneApplication(Gtk.Application):
         stored = self.controller.package.getMetaData(config.data.namespace, "media_checksum")
 
         def do_verify(callback):
-            computed = helper.mediafile_checksum(name, callback)
+            computed = mediainfo.checksum(name, callback)
             if computed is None:
                 dialog.message_dialog(_("Checksum was cancelled."))
                 return True
@@ -1293,10 +1294,11 @@ class AdveneApplication(Gtk.Application):
                     continue
                 if search == "" or search in a.content.data:
                     self.controller.notify('EditSessionStart', element=a, immediate=True)
-                    if search:
-                        a.content.data = a.content.data.replace(search, replace)
-                    else:
-                        a.content.data = replace
+                    with self.controller.modifying_model():
+                        if search:
+                            a.content.data = a.content.data.replace(search, replace)
+                        else:
+                            a.content.data = replace
                     if isinstance(a, Annotation):
                         self.controller.notify('AnnotationEditEnd', annotation=a, batch=batch_id)
                     elif isinstance(a, Relation):
@@ -4407,6 +4409,7 @@ Image cache information: %(imagecache)s
 
         ew.add_checkbox(_("Enable snapshots"), "player-snapshot", _("Enable snapshots"))
         ew.add_spin(_("Snapshot width"), "player-snapshot-width", _("Snapshot width in pixels."), 0, 1280)
+        ew.add_checkbox(_("Keyframe index"), "player-keyframe-index", _("Index the keyframes of local media files (once per file), for faster frame stepping and snapshots"))
         ew.add_spin(_("Verbosity"), "player-level", _("Verbosity level. -1 for no messages."),
                     -1, 3)
 
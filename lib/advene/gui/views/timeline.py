@@ -1177,8 +1177,9 @@ class TimeLine(AdhocView):
 
         if new['begin'] < new['end']:
             self.controller.notify('EditSessionStart', element=source, immediate=True)
-            for k in ('begin', 'end'):
-                setattr(source.fragment, k, new[k])
+            with self.controller.modifying_model():
+                for k in ('begin', 'end'):
+                    setattr(source.fragment, k, new[k])
             self.controller.notify("AnnotationEditEnd", annotation=source)
             self.controller.notify('EditSessionEnd', element=source)
         return True
@@ -1324,7 +1325,8 @@ class TimeLine(AdhocView):
             a = widget.annotation
             missing = [t for t in tags if t not in a.tags ]
             self.controller.notify('EditSessionStart', element=a, immediate=True)
-            a.tags = a.tags + missing
+            with self.controller.modifying_model():
+                a.tags = a.tags + missing
             self.controller.notify('AnnotationEditEnd', annotation=a)
             self.controller.notify('EditSessionEnd', element=a)
         else:
@@ -1595,11 +1597,12 @@ class TimeLine(AdhocView):
             for (i,j) in enumerate(bestpath[len(sa)-1]):
                 annotation = da[i]
                 self.controller.notify('EditSessionStart', element=annotation, immediate=True)
-                if mode == 'time':
-                    annotation.fragment.begin = sa[j].fragment.begin
-                    annotation.fragment.end = sa[j].fragment.end
-                elif mode == 'content':
-                    annotation.content.data = sa[j].content.data
+                with self.controller.modifying_model():
+                    if mode == 'time':
+                        annotation.fragment.begin = sa[j].fragment.begin
+                        annotation.fragment.end = sa[j].fragment.end
+                    elif mode == 'content':
+                        annotation.content.data = sa[j].content.data
                 self.controller.notify('AnnotationEditEnd', annotation=annotation, batch=batch_id)
                 self.controller.notify('EditSessionEnd', element=annotation)
             return True
@@ -1685,7 +1688,8 @@ class TimeLine(AdhocView):
         if attr and widget.resize_time is not None:
             ann = widget.annotation
             self.controller.notify('EditSessionStart', element=ann, immediate=True)
-            setattr(ann.fragment, attr, widget.resize_time)
+            with self.controller.modifying_model():
+                setattr(ann.fragment, attr, widget.resize_time)
             self.controller.notify('AnnotationEditEnd', annotation=ann)
             self.controller.notify('EditSessionEnd', element=ann)
         return False
@@ -1837,7 +1841,8 @@ class TimeLine(AdhocView):
                         cb('validate', ann)
                     if r != ann.content.data:
                         self.controller.notify('EditSessionStart', element=ann, immediate=True)
-                        ann.content.data = r
+                        with self.controller.modifying_model():
+                            ann.content.data = r
                         controller.notify('AnnotationEditEnd', annotation=ann)
                         self.controller.notify('EditSessionEnd', element=ann)
                 close_eb(widget)
@@ -1860,7 +1865,8 @@ class TimeLine(AdhocView):
                         cb('validate', ann)
                     if r != ann.content.data:
                         self.controller.notify('EditSessionStart', element=ann, immediate=True)
-                        ann.content.data = r
+                        with self.controller.modifying_model():
+                            ann.content.data = r
                         controller.notify('AnnotationEditEnd', annotation=ann)
                         self.controller.notify('EditSessionEnd', element=ann)
                 # Navigate
@@ -2116,16 +2122,17 @@ class TimeLine(AdhocView):
             self.controller.notify('EditSessionStart', element=button.annotation, immediate=True)
 
             newpos = None
-            if event.get_state() & Gdk.ModifierType.SHIFT_MASK:
-                f.begin += incr
-                f.end += incr
-                newpos = f.begin
-            elif fr < .5:
-                f.begin += incr
-                newpos = f.begin
-            elif fr >= .5:
-                f.end += incr
-                newpos = f.end
+            with self.controller.modifying_model():
+                if event.get_state() & Gdk.ModifierType.SHIFT_MASK:
+                    f.begin += incr
+                    f.end += incr
+                    newpos = f.begin
+                elif fr < .5:
+                    f.begin += incr
+                    newpos = f.begin
+                elif fr >= .5:
+                    f.end += incr
+                    newpos = f.end
 
             self.controller.player_delayed_scrub(newpos)
 
@@ -2529,11 +2536,13 @@ class TimeLine(AdhocView):
                     # default value so that the annotation remains
                     # accessible.
                     v += 2000
-                an.fragment.end = v
+                with self.controller.modifying_model():
+                    an.fragment.end = v
             elif action == 'cancel':
                 # Delete the annotation
                 self.controller.notify('EditSessionStart', element=an, immediate=True)
-                self.controller.package.annotations.remove(an)
+                with self.controller.modifying_model():
+                    self.controller.package.annotations.remove(an)
                 self.controller.notify('AnnotationDelete', annotation=an)
             return True
 
@@ -3056,11 +3065,13 @@ class TimeLine(AdhocView):
                             # default value so that the annotation remains
                             # accessible.
                             v += 2000
-                        an.fragment.end = v
+                        with self.controller.modifying_model():
+                            an.fragment.end = v
                     elif action == 'cancel':
                         # Delete the annotation
                         self.controller.notify('EditSessionStart', element=an, immediate=True)
-                        self.controller.package.annotations.remove(an)
+                        with self.controller.modifying_model():
+                            self.controller.package.annotations.remove(an)
                         self.controller.notify('AnnotationDelete', annotation=an)
                     return True
 
@@ -3978,7 +3989,8 @@ class TimeLine(AdhocView):
                 end = max( a.fragment.end for a in annotations )
                 # Resize the first annotation
                 self.controller.notify('EditSessionStart', element=annotations[0], immediate=True)
-                annotations[0].fragment.end = end
+                with self.controller.modifying_model():
+                    annotations[0].fragment.end = end
                 self.controller.notify('AnnotationEditEnd', annotation=annotations[0], batch=batch_id)
                 self.controller.notify('EditSessionEnd', element=annotations[0])
                 # Remove all others
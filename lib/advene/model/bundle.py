@@ -430,7 +430,13 @@ class AbstractXmlBundle(WritableBundle, modeled.Modeled,
             elt_list.insert (true_index, self._get_element (item))
         else:
             ref_elt = self._get_element (self._list[-1])
-            ref_index = elt_list.index (ref_elt)
+            # When appending, the reference element is usually at (or
+            # near) the end of the child list, so look for it backwards.
+            ref_index = len (elt_list) - 1
+            while ref_index >= 0 and elt_list[ref_index] is not ref_elt:
+                ref_index -= 1
+            if ref_index < 0:
+                ref_index = elt_list.index (ref_elt)
             elt_list.insert (ref_index + 1, self._get_element (item))
 
         super (AbstractXmlBundle, self).insert (index, item)
@@ -75,6 +75,10 @@ class _advene_context (simpleTALES.Context):
 
     def __init__ (self, options):
         simpleTALES.Context.__init__(self, options, allowPythonPath=True)
+        # Names of the root symbols (here, player, options...) that
+        # were traversed during evaluation. It is used by the
+        # webserver to determine whether a result can be cached.
+        self.accessed_roots = set()
 
     def wrap_method(self, method):
         return simpleTALES.PathFunctionVariable(method)
@@ -163,6 +167,7 @@ class _advene_context (simpleTALES.Context):
         else:
             # If we can't find it then raise an exception
             raise simpleTALES.PathNotFoundException() from None
+        self.accessed_roots.add(path)
 
         # Advene hook: store the resolved_stack
         resolved_stack = [ (path, val) ]
@@ -263,6 +268,46 @@ class AdveneContext(_advene_context):
         self.locals = copy.copy(self._cached_locals)
         self.globals = copy.copy(self._cached_globals)
 
+    def derive(self, here):
+        """Return a new context based on this one, for the given element.
+
+        The new context has the same options, globals and methods as
+        this one (which is used as a template), with here bound to the
+        given element. It is much cheaper than building a new
+        context: the method table is shared (it is copied only if
+        addMethod is called on the new context), and only the globals
+        and options dictionaries are copied.
+
+        @param here: the element
+        @return: a new AdveneContext
+        """
+        c = self.__class__.__new__(self.__class__)
+        c.allowPythonPath = self.allowPythonPath
+        c.true = self.true
+        c.false = self.false
+        c.log = self.log
+        c.locals = {}
+        c.localStack = []
+        c.repeatStack = []
+        c.repeatMap = {}
+        c.accessed_roots = set()
+        c.pythonPathFuncs = simpleTALES.PythonPathFunctions(c)
+        c.methods = self.methods
+        c._shared_methods = True
+
+        c.globals = dict(self.globals)
+        options = dict(self.globals['options'])
+        c.globals['options'] = options
+        c.globals['repeat'] = c.repeatMap
+        c.globals['attrs'] = None
+        c.globals['CONTEXTS'] = dict(self.globals['CONTEXTS'],
+                                     options=options,
+                                     repeat=c.repeatMap,
+                                     attrs=None)
+        c.globals['here'] = here
+        c.checkpoint()
+        return c
+
     def __str__ (self):
         return "<pre>AdveneContext\nGlobals:\n\t%s\nLocals:\n\t%s</pre>" % (
             "\n\t".join([ "%s: %s" % (k, str(v).replace("<", "&lt;"))
@@ -281,6 +326,8 @@ class AdveneContext(_advene_context):
             options={}
         _advene_context.__init__(self, dict(options)) # *copy* dict 'options'
         self.methods = {}
+        # True if self.methods is shared with a template context
+        self._shared_methods = False
         self.addGlobal('here', here)
         for dm_name in self.defaultMethods():
             self.addMethod(dm_name, global_methods.__dict__[dm_name])
@@ -292,6 +339,10 @@ class AdveneContext(_advene_context):
         # TODO: test that function is indeed a function, and that it has the
         #       correct signature
         if True:
+            if self._shared_methods:
+                # Copy-on-write of the method table
+                self.methods = dict(self.methods)
+                self._shared_methods = False
             self.methods[name] = function
         else:
             raise AdveneTalesException("%s is not a valid method" % function)
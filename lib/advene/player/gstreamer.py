@@ -27,6 +27,9 @@ from gettext import gettext as _
 
 import advene.core.config as config
 from advene.util.helper import format_time, path2uri
+import advene.util.keyframeindex as keyframeindex
+import advene.util.mediainfo as mediainfo
+from advene.player.positionclock import PositionClock
 from advene.gui.util import get_drawable, is_wayland
 
 import ctypes
@@ -118,6 +121,8 @@ class Player:
             self.snapshotter = None
 
         self.fullres_snapshotter = None
+        # Keyframe index of the current media, if available
+        self.keyframes = None
         # This method has the following signature:
         # self.fullres_snapshot_callback(snapshot=None, message=None)
         # If snapshot is None, then there should be an explanation (string) in msg.
@@ -143,6 +148,11 @@ class Player:
         self.status = Player.UndefinedStatus
         self.current_position_value = 0
         self.stream_duration = 0
+        # The position is queried every position-query-interval ms,
+        # and interpolated from the pipeline clock in between.
+        self.position_clock = PositionClock(self.query_position, self.clock_time,
+                                            interval=config.data.player['position-query-interval'],
+                                            rate=self.rate)
         self.position_update()
 
     def log (self, msg):
@@ -254,6 +264,8 @@ class Player:
         bus.add_signal_watch()
         bus.connect('message::error', self.on_bus_message_error)
         bus.connect('message::warning', self.on_bus_message_warning)
+        # Seeks and frame steps are complete
+        bus.connect('message::async-done', self.on_bus_message_async_done)
 
     def current_status(self):
         st = self.player.get_state(100)[1]
@@ -276,6 +288,31 @@ class Player:
             position = pos / Gst.MSECOND
         return position
 
+    def query_position(self):
+        """Query the real position, for the position clock.
+        """
+        position = self.current_position()
+        if position == 0:
+            # Try again once. timestamp sometimes goes through 0 when
+            # modifying the player position.
+            position = self.current_position()
+        return position
+
+    def clock_time(self):
+        """Return the pipeline clock time in ms, or None.
+        """
+        clock = self.player.get_clock()
+        if clock is None:
+            return None
+        return clock.get_time() / Gst.MSECOND
+
+    def get_position_metrics(self):
+        """Return the position interpolation metrics.
+
+        See L{advene.player.positionclock.PositionClock.metrics}.
+        """
+        return self.position_clock.metrics()
+
     def dvd_uri(self, title=None, chapter=None):
         # FIXME: find a way to specify chapter/title
         # resindvd does not allow to specify it in the URI
@@ -283,14 +320,37 @@ class Player:
 
     def set_uri(self, item):
         self.videofile = item
+        self.position_clock.reset()
         item = path2uri(item)
         self.player.set_property('uri', item)
         if self.snapshotter:
             self.snapshotter.set_uri(item)
         if self.fullres_snapshotter:
             self.fullres_snapshotter.set_uri(item)
+        self.set_keyframe_index(None)
+        if item and config.data.player['keyframe-index']:
+            videofile = self.videofile
+            def set_index(index):
+                # The media may have changed in the meantime
+                if self.videofile == videofile:
+                    self.set_keyframe_index(index)
+                return False
+            def index_built(index):
+                # Called from the indexing thread
+                GObject.idle_add(set_index, index)
+            self.set_keyframe_index(keyframeindex.get_index(item, build=True, callback=index_built))
         return self.get_video_info()
 
+    def set_keyframe_index(self, index):
+        """Set the keyframe index of the current media.
+
+        It is shared with the snapshotters.
+        """
+        self.keyframes = index
+        for s in (self.snapshotter, self.fullres_snapshotter):
+            if s is not None:
+                s.keyframes = index
+
     def get_uri(self):
         return self.player.get_property('current-uri') or self.player.get_property('uri') or ""
 
@@ -309,30 +369,43 @@ class Player:
         if not uri:
             return default
 
-        d = GstPbutils.Discoverer()
-        try:
-            info = d.discover_uri(uri)
-        except Exception as e:
-            logger.error("Cannot find video info: %s", e.message)
-            info = None
+        # Stream information is cached for local files, so that
+        # discovery is done only once per media.
+        info = mediainfo.cached(uri, 'video_info', lambda: self.discover_video_info(uri))
         if info is None:
             # Return default data.
             logger.warning("Could not find information about video, using absurd defaults.")
             return default
-        if not info.get_video_streams():
-            # Could be an audio file.
-            default['duration'] = info.get_duration() / Gst.MSECOND
-            return default
+        default.update(info)
+        return default
 
-        stream = info.get_video_streams()[0]
-        return {
-            'uri': uri,
-            'framerate_denom': stream.get_framerate_denom(),
-            'framerate_num': stream.get_framerate_num(),
-            'width': stream.get_width(),
-            'height': stream.get_height(),
+    def discover_video_info(self, uri):
+        """Discover information about the given video.
+
+        @return: a dict, or None if the video cannot be discovered. For audio files, there is no framerate and size information.
+        """
+        d = GstPbutils.Discoverer()
+        try:
+            info = d.discover_uri(uri)
+        except Exception as e:
+            logger.error("Cannot find video info: %s", str(e))
+            return None
+        if info is None:
+            return None
+        data = {
             'duration': info.get_duration() / Gst.MSECOND,
+            'video_streams': len(info.get_video_streams()),
+            'audio_streams': len(info.get_audio_streams()),
         }
+        if info.get_video_streams():
+            stream = info.get_video_streams()[0]
+            data.update({
+                'framerate_denom': stream.get_framerate_denom(),
+                'framerate_num': stream.get_framerate_num(),
+                'width': stream.get_width(),
+                'height': stream.get_height(),
+            })
+        return data
 
     def check_uri(self):
         uri = self.get_uri()
@@ -348,8 +421,17 @@ class Player:
     def set_position(self, position):
         if not self.check_uri():
             return
+        self.position_clock.reset()
         if self.current_status() == self.UndefinedStatus:
             self.player.set_state(Gst.State.PAUSED)
+        if (self.keyframes is not None
+            and self.status == self.PauseStatus
+            and self.rate > 0):
+            n = self.keyframes.frame_steps(self.current_position(), position)
+            if n and self.player.send_event(Gst.Event.new_step(Gst.Format.BUFFERS, n, self.rate, True, False)):
+                # Stepping from the current frame is cheaper than
+                # decoding from the previous keyframe.
+                return
         p = int(position) * Gst.MSECOND
         event = Gst.Event.new_seek(self.rate, Gst.Format.TIME,
                                    Gst.SeekFlags.FLUSH | Gst.SeekFlags.ACCURATE,
@@ -364,6 +446,7 @@ class Player:
     def start(self, position=0):
         if not self.check_uri():
             return
+        self.position_clock.reset()
         if position != 0:
             self.set_position(position)
         self.player.set_state(Gst.State.PLAYING)
@@ -371,6 +454,7 @@ class Player:
     def pause(self, position=0):
         if not self.check_uri():
             return
+        self.position_clock.reset()
         if self.status == self.PlayingStatus:
             self.player.set_state(Gst.State.PAUSED)
         else:
@@ -382,6 +466,7 @@ class Player:
     def stop(self, position=0):
         if not self.check_uri():
             return
+        self.position_clock.reset()
         self.player.set_state(Gst.State.READY)
 
     def exit(self):
@@ -406,6 +491,7 @@ class Player:
             # Initialise it.
             self.fullres_snapshotter = Snapshotter(self.fullres_snapshot_taken)
             self.fullres_snapshotter.set_uri(self.player.get_property('uri'))
+            self.fullres_snapshotter.keyframes = self.keyframes
         self.fullres_snapshot_callback = callback
         if not self.fullres_snapshotter.thread_running:
             self.fullres_snapshotter.start()
@@ -545,11 +631,22 @@ class Player:
         return True
 
     def position_update(self):
-        s = self.get_stream_information ()
-        if s.position == 0:
-            # Try again once. timestamp sometimes goes through 0 when
-            # modifying the player position.
-            s = self.get_stream_information()
+        s = StreamInformation()
+        s.status = self.current_status()
+        clock = self.position_clock
+        if s.status != self.status:
+            clock.reset()
+        clock.set_playing(s.status == self.PlayingStatus)
+        s.position = clock.position() or 0
+        if clock.synced or not self.stream_duration:
+            try:
+                s.length = self.player.query_duration(Gst.Format.TIME)[1] / Gst.MSECOND
+            except Exception:
+                s.length = 0
+        else:
+            s.length = self.stream_duration
+        if s.length and s.position > s.length:
+            s.position = s.length
 
         self.status = s.status
         self.stream_duration = s.length
@@ -651,6 +748,11 @@ class Player:
             self.reparent(self.xid, imagesink)
         return True
 
+    def on_bus_message_async_done(self, bus, message):
+        if message.src == self.player:
+            self.position_clock.reset()
+        return True
+
     def on_bus_message_error(self, bus, message):
         s = message.get_structure()
         if s is None:
@@ -690,7 +792,7 @@ class Player:
         except Gst.QueryError:
             self.log("Error in set_rate (query position)")
             return
-        event = Gst.Event.new_seek(self.rate, Gst.Format.TIME,
+        event = Gst.Event.new_seek(rate, Gst.Format.TIME,
                                    Gst.SeekFlags.FLUSH,
                                    Gst.SeekType.SET, int(p),
                                    Gst.SeekType.NONE, 0)
@@ -700,6 +802,7 @@ class Player:
                 self.log("Could not set rate")
             else:
                 self.rate = rate
+                self.position_clock.set_rate(rate)
         else:
             self.log("Cannot build set_rate event")
 
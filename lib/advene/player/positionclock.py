@@ -0,0 +1,134 @@
+#
+# Advene: Annotate Digital Videos, Exchange on the NEt
+# Copyright (C) 2025 Olivier Aubert <contact@olivieraubert.net>
+#
+# Advene is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# Advene is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Advene; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+#
+"""Player position interpolation.
+
+The player position is requested at each GUI tick. Instead of
+querying the pipeline each time, the L{PositionClock} queries it
+periodically, and interpolates the position in between from a
+reference clock (the pipeline clock for the gstreamer player) and the
+playback rate.
+"""
+
+import logging
+logger = logging.getLogger(__name__)
+
+# Smoothing factor of the jitter estimation (as in RFC 3550)
+JITTER_SMOOTHING = 16
+
+class PositionClock:
+    """Interpolate a player position between real position queries.
+
+    The owner must call L{reset} when the position changes
+    discontinuously (seek, frame step, media change) and
+    L{set_rate} when the playback rate changes.
+
+    @ivar query: a function returning the real position (in ms)
+    @ivar now: a function returning the reference clock time (in ms)
+    @ivar interval: the maximum delay (in ms) between real queries. If 0, the position is always queried.
+    @ivar playing: True if the position is advancing
+    @ivar rate: the playback rate
+    @ivar synced: True if the last returned position was queried
+    @ivar drift: the difference (in ms) between the interpolated position and the real one, at the last query
+    @ivar jitter: the smoothed variation of the drift (in ms)
+    @ivar queries: the number of real queries
+    @ivar interpolations: the number of interpolated positions
+    """
+    def __init__(self, query, now, interval=250, rate=1.0):
+        self.query = query
+        self.now = now
+        self.interval = interval
+        self.rate = rate
+        self.playing = False
+        self.synced = False
+        self.drift = 0
+        self.jitter = 0
+        self.queries = 0
+        self.interpolations = 0
+        self.reset()
+
+    def reset(self):
+        """Forget the reference position, so that the next position is queried.
+        """
+        # Last real position, and the clock time of the query
+        self.reference_position = None
+        self.reference_time = None
+        self.last_position = None
+
+    def set_rate(self, rate):
+        self.rate = rate
+        self.reset()
+
+    def set_playing(self, playing):
+        if playing != self.playing:
+            self.playing = playing
+            self.reset()
+
+    def interpolate(self, t):
+        """Return the interpolated position at clock time t.
+        """
+        if not self.playing:
+            return self.reference_position
+        return self.reference_position + (t - self.reference_time) * self.rate
+
+    def position(self):
+        """Return the current position (in ms).
+        """
+        t = self.now()
+        if (self.interval <= 0
+            or t is None
+            or self.reference_time is None
+            or t < self.reference_time
+            or t - self.reference_time >= self.interval):
+            return self.sync(t)
+        self.synced = False
+        self.interpolations += 1
+        position = self.interpolate(t)
+        if self.playing and self.rate > 0 and self.last_position is not None:
+            # Do not go backwards when correcting a drift
+            position = max(position, self.last_position)
+        self.last_position = position
+        return position
+
+    def sync(self, t):
+        """Query the real position.
+        """
+        position = self.query()
+        self.queries += 1
+        self.synced = True
+        if self.reference_time is not None and t is not None and position is not None:
+            drift = self.interpolate(t) - position
+            self.jitter += (abs(drift - self.drift) - self.jitter) / JITTER_SMOOTHING
+            self.drift = drift
+        self.reference_position = position
+        self.reference_time = t if position is not None else None
+        if (self.playing and self.rate > 0
+            and self.last_position is not None and position is not None):
+            position = max(position, self.last_position)
+        self.last_position = position
+        return position
+
+    def metrics(self):
+        """Return the drift and jitter metrics, as a dict.
+        """
+        return {
+            'drift': self.drift,
+            'jitter': self.jitter,
+            'queries': self.queries,
+            'interpolations': self.interpolations,
+        }
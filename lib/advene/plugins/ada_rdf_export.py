@@ -125,6 +125,11 @@ def keywords_to_struct(keywords, on_error=None):
 class AdARDFExporter(WebAnnotationExporter):
     name = _("AdA RDF exporter")
     extension = 'ada.jsonld'
+    value_type_mapping = {
+        "evolving": "ao:EvolvingValuesAnnotationType",
+        "contrasting": "ao:ContrastingValuesAnnotationType",
+        "predefined": "ao:PredefinedValuesAnnotationType"
+    }
 
     def __init__(self, controller=None, source=None, callback=None):
         super().__init__(controller=controller, source=source, callback=callback)
@@ -148,11 +153,7 @@ class AdARDFExporter(WebAnnotationExporter):
         data = super().annotation_jsonld(a, media_uri)
 
         # Enrich with AdA-specific properties
-        value_type_mapping = {
-            "evolving": "ao:EvolvingValuesAnnotationType",
-            "contrasting": "ao:ContrastingValuesAnnotationType",
-            "predefined": "ao:PredefinedValuesAnnotationType"
-        }
+        value_type_mapping = self.value_type_mapping
         # Build body according to content type
         def new_body(btype=None):
             """Create a new body node
@@ -246,23 +247,26 @@ class AdARDFExporter(WebAnnotationExporter):
 
         return data
 
-    def export(self, filename=None):
-        # Works in source is a package or a type
-        package = self.source.ownerPackage
-        data = super().export(None)
+    def get_ontology(self):
+        """Return the ontology URI, defined in the package metadata.
+        """
+        return self.source.ownerPackage.getMetaData(config.data.namespace, "ontology_uri")
 
-        # Get the namespace from the package metdata
-        ontology = package.getMetaData(config.data.namespace, "ontology_uri")
-        if not ontology:
-            return _("Cannot find the ontology URI. It should be defined as package metadata.")
-        data['@context'].append({
-            "ao": ontology,
+    def json_context(self):
+        context = super().json_context()
+        context.append({
+            "ao": self.get_ontology(),
             "ao:annotationType": { "@type": "@id" },
             "ao:annotationValue": { "@type": "@id" },
             "ao:annotationValueSequence": { "@type": "@id" }
         })
+        return context
 
-        return self.output(data, filename)
+    def export(self, filename=None):
+        # Works in source is a package or a type
+        if not self.get_ontology():
+            return _("Cannot find the ontology URI. It should be defined as package metadata.")
+        return super().export(filename)
 
 @register_checker
 class AdAChecker(FeatureChecker):
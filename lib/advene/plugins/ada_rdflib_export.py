@@ -31,10 +31,12 @@ from collections import namedtuple
 try:
     import rdflib
     from rdflib import URIRef, BNode, Literal
-    from rdflib.collection import Collection
     from rdflib.namespace import RDF, RDFS, XSD, DC, DCTERMS
 except ImportError:
     rdflib = None
+else:
+    AS = rdflib.Namespace("http://www.w3.org/ns/activitystreams#")
+    OA = rdflib.Namespace("http://www.w3.org/ns/oa#")
 
 import advene.core.config as config
 import advene.util.helper as helper
@@ -117,18 +119,77 @@ def keywords_to_struct(keywords):
             need_value = False
     yield prev
 
+def rdf_list(node, items):
+    """Generate the triples of a RDF list starting at node.
+    """
+    for i, item in enumerate(items):
+        if i > 0:
+            cell = BNode()
+            yield (node, RDF.rest, cell)
+            node = cell
+        yield (node, RDF.first, item)
+    if items:
+        yield (node, RDF.rest, RDF.nil)
+
+def turtle_qname(uri, namespace_manager, prefixes):
+    """Return the Turtle representation of uri, as a qname if possible.
+
+    @param prefixes: the prefixes that can be used
+    """
+    try:
+        prefix, namespace, local = namespace_manager.compute_qname(uri, generate=False)
+    except Exception:
+        return uri.n3()
+    # Only use declared prefixes. A qname cannot end with a dot.
+    if prefix not in prefixes or local.endswith('.'):
+        return uri.n3()
+    local = local.replace("(", r"\(").replace(")", r"\)")
+    return "%s:%s" % (prefix, local)
+
+def turtle_literal(literal, namespace_manager, prefixes):
+    """Return the Turtle representation of a typed literal.
+    """
+    datatype = turtle_qname(literal.datatype, namespace_manager, prefixes)
+    return "%s^^%s" % (Literal(str(literal)).n3(), datatype)
+
+def serialize_graph(graph, format):
+    """Serialize a graph as a string.
+    """
+    data = graph.serialize(format=format)
+    # Older rdflib versions return bytes
+    if isinstance(data, bytes):
+        data = data.decode('utf-8')
+    return data
+
 class AdArdflibExporter(GenericExporter):
+    """AdA rdflib exporter.
+
+    By default, the whole graph is built before being serialized. With
+    the C{stream} option, N-Triples and Turtle output is written while
+    the triples are generated, so that memory usage does not depend
+    on the package size.
+    """
     name = _("AdA rdflib exporter")
     extension = 'rdf'
+    # Formats that can be serialized while iterating over annotations
+    stream_formats = ("nt", "ttl")
+    # Number of triples per N-Triples chunk
+    chunk_size = 10000
+    # Prefixes declared in streamed Turtle output
+    stream_prefixes = ('ao', 'oa', 'activitystreams', 'dc', 'dcterms', 'rdf', 'rdfs', 'xsd')
 
     def __init__(self, controller=None, source=None, callback=None):
         super().__init__(controller=controller, source=source)
         self.format = "json-ld"
         self.optionparser.add_option("-f", "--format",
                                      action="store", type="choice", dest="format",
-                                     choices=("n3", "json-ld", "ttl", "xml"),
+                                     choices=("n3", "json-ld", "ttl", "xml", "nt"),
                                      default=self.format,
                                      help=_("File format for output"))
+        self.stream = False
+        self.optionparser.add_option("-s", "--stream",
+                                     action="store_true", dest="stream", default=self.stream,
+                                     help=_("Write triples while they are generated, with bounded memory usage (nt and ttl formats only)"))
 
     @classmethod
     def is_valid_for(cls, expr):
@@ -144,47 +205,60 @@ class AdArdflibExporter(GenericExporter):
         self.extension = self.format
         return super().get_filename(basename, source)
 
-    def export(self, filename):
-        # Works in source is a package or a type
-        package = self.source.ownerPackage
-
-        media_uri = package.getMetaData(config.data.namespace, "media_uri") or self.controller.get_default_media()
-
-        # Get the namespace from the package metdata
-        ontology = package.getMetaData(config.data.namespace, "ontology_uri")
-        if not ontology:
-            return _("Cannot find the ontology URI. It should be defined as package metadata.")
-        AO = rdflib.Namespace(ontology)
-        #AR = rdflib.Namespace(ontology.replace('/ontology/', '/resource/'))
-        AS = rdflib.Namespace("http://www.w3.org/ns/activitystreams#")
-        OA = rdflib.Namespace("http://www.w3.org/ns/oa#")
-
+    def new_graph(self, ontology):
+        """Return a new graph, with the namespace bindings.
+        """
         g = rdflib.Graph()
-        g.bind('ao', AO)
+        g.bind('ao', rdflib.Namespace(ontology))
         g.bind('oa', OA)
         g.bind('activitystreams', AS)
         g.bind('dc', DC)
         g.bind('dcterms', DCTERMS)
+        return g
+
+    def triples(self, media_uri, ontology):
+        """Generate the triples for the source annotations.
+
+        Annotations are converted one at a time, so that the triples
+        can be serialized as they are generated.
+        """
+        AO = rdflib.Namespace(ontology)
+        #AR = rdflib.Namespace(ontology.replace('/ontology/', '/resource/'))
+        value_type_mapping = {
+            "evolving": AO.EvolvingValuesAnnotationType,
+            "contrasting": AO.ContrastingValuesAnnotationType,
+            "predefined": AO.PredefinedValuesAnnotationType
+        }
+        # Ontology URIs of annotation types, shared across annotations
+        type_uris = {}
+        media = URIRef(media_uri)
+        media_frags = URIRef("http://www.w3.org/TR/media-frags/")
 
         collection = BNode()
         page = URIRef("page1")
-        g.add((collection, RDF.type, OA.AnnotationCollection))
-        g.add((collection, RDFS.label, Literal(self.controller.get_title(self.source))))
-        g.add((collection, AS.totalItems, Literal(len(self.source.annotations), datatype=XSD.nonNegativeInteger)))
-        g.add((collection, AS.first, page))
+        yield (collection, RDF.type, OA.AnnotationCollection)
+        yield (collection, RDFS.label, Literal(self.controller.get_title(self.source)))
+        yield (collection, AS.totalItems, Literal(len(self.source.annotations), datatype=XSD.nonNegativeInteger))
+        yield (collection, AS.first, page)
 
         pageItems = BNode()
-        g.add((page, AS.items, pageItems))
-
-        itemcollection = Collection(g, pageItems)
+        yield (page, RDF.type, AS.OrderedCollectionPage)
+        yield (page, AS.items, pageItems)
+        yield (page, AS.startIndex, Literal(0, datatype=XSD.nonNegativeInteger))
 
         def get_annotation_uri(a):
             return "%s/%s" % (media_uri, a.id)
 
+        # Current cell of the page items list. The list is built
+        # incrementally (instead of using rdflib.collection.Collection
+        # which walks the whole list for each append).
+        cell = None
         not_part_of_ontology = set()
         for a in self.source.annotations:
             # First check if it is part of the ontology schema
-            type_uri = a.type.getMetaData(config.data.namespace, "ontology_uri")
+            type_uri = type_uris.get(a.type)
+            if type_uri is None:
+                type_uri = type_uris[a.type] = a.type.getMetaData(config.data.namespace, "ontology_uri") or ""
             if not type_uri:
                 # Report only once by type
                 if a.type not in not_part_of_ontology:
@@ -193,28 +267,30 @@ class AdArdflibExporter(GenericExporter):
                 # Just ignore this annotation
                 continue
             anode = URIRef(get_annotation_uri(a))
-            itemcollection.append(anode)
-            g.add((anode, RDF.type, OA.Annotation))
-            g.add((anode, DCTERMS.created, Literal(a.date, datatype=XSD.dateTime)))
+            if cell is None:
+                cell = pageItems
+            else:
+                next_cell = BNode()
+                yield (cell, RDF.rest, next_cell)
+                cell = next_cell
+            yield (cell, RDF.first, anode)
+
+            yield (anode, RDF.type, OA.Annotation)
+            yield (anode, DCTERMS.created, Literal(a.date, datatype=XSD.dateTime))
             # We use DC instead of DCTERMS so that we can simply put the string value as a literal
-            g.add((anode, DC.creator, Literal(a.author)))
+            yield (anode, DC.creator, Literal(a.author))
 
+            type_node = URIRef(type_uri)
             def new_body(btype=None):
-                """Create a new body node
+                """Create a new body node and its triples.
                 """
                 body = BNode()
-                g.add((anode, OA.hasBody, body))
-
-                g.add((body, AO.annotationType, URIRef(type_uri)))
+                triples = [ (anode, OA.hasBody, body),
+                            (body, AO.annotationType, type_node) ]
                 if btype is not None:
-                    g.add((body, RDF.type, btype))
-                return body
-
-            value_type_mapping = {
-                "evolving": AO.EvolvingValuesAnnotationType,
-                "contrasting": AO.ContrastingValuesAnnotationType,
-                "predefined": AO.PredefinedValuesAnnotationType
-            }
+                    triples.append((body, RDF.type, btype))
+                return body, triples
+
             # Build body according to content type
             if a.type.mimetype == 'text/x-advene-keyword-list':
                 keywords = a.content.parsed()
@@ -224,46 +300,114 @@ class AdArdflibExporter(GenericExporter):
                     val = URIRef(uri) if uri else Literal(kw)
                     return val
 
+                body = None
                 for typedvalues in keywords_to_struct(list(keywords)):
                     if typedvalues is None:
                         logger.warning("Empty typedvalues for %s", keywords)
                         continue
-                    body = new_body(value_type_mapping[typedvalues.type])
+                    body, triples = new_body(value_type_mapping[typedvalues.type])
+                    yield from triples
 
                     if typedvalues.type == "predefined":
                         for kw in typedvalues.values:
-                            g.add( (body, AO.annotationValue, get_keyword_uri(kw)) )
+                            yield (body, AO.annotationValue, get_keyword_uri(kw))
                     else:
                         # Generate a sequence for contrasting/evolving values.
                         seq = BNode()
-                        Collection(g, seq, [ get_keyword_uri(kw) for kw in typedvalues.values ])
-                        g.add( (body, AO.annotationValueSequence, seq) )
+                        yield from rdf_list(seq, [ get_keyword_uri(kw) for kw in typedvalues.values ])
+                        yield (body, AO.annotationValueSequence, seq)
 
                 # Attach comment to the last body
-                if keywords.get_comment():
-                    g.add( (body, RDFS.comment, Literal(keywords.get_comment())) )
+                if keywords.get_comment() and body is not None:
+                    yield (body, RDFS.comment, Literal(keywords.get_comment()))
 
             else:
-                body = new_body()
-                g.add((body, RDF.type, OA.TextualBody))
-                g.add((body, RDF.value, Literal(a.content.data)))
+                body, triples = new_body()
+                yield from triples
+                yield (body, RDF.type, OA.TextualBody)
+                yield (body, RDF.value, Literal(a.content.data))
 
             target = BNode()
-            g.add((anode, OA.hasTarget, target))
+            yield (anode, OA.hasTarget, target)
 
-            g.add((target, OA.hasSource, URIRef(media_uri)))
+            yield (target, OA.hasSource, media)
 
             selector = BNode()
-            g.add((target, OA.hasSelector, selector))
+            yield (target, OA.hasSelector, selector)
+
+            yield (selector, RDF.type, OA.FragmentSelector)
+            yield (selector, DCTERMS.conformsTo, media_frags)
+            yield (selector, RDF.value, Literal("t={},{}".format(helper.format_time_reference(a.fragment.begin),
+                                                                 helper.format_time_reference(a.fragment.end))))
+        if cell is not None:
+            yield (cell, RDF.rest, RDF.nil)
 
-            g.add((selector, RDF.type, OA.FragmentSelector))
-            g.add((selector, DCTERMS.conformsTo, URIRef("http://www.w3.org/TR/media-frags/")))
-            g.add((selector, RDF.value, Literal("t={},{}".format(helper.format_time_reference(a.fragment.begin),
-                                                                 helper.format_time_reference(a.fragment.end)))))
+    def serialize(self, data, textstream):
+        """Serialize the triples to the textstream, while they are generated.
+
+        data is a (triples, graph) tuple. The graph holds the
+        namespace bindings.
+        """
+        triples, graph = data
+        count = 0
+        if self.format == 'ttl':
+            # Prefixes are written once, and qnames are computed once
+            # for each URI.
+            namespace_manager = graph.namespace_manager
+            prefixes = set()
+            for prefix, namespace in namespace_manager.namespaces():
+                if prefix in self.stream_prefixes:
+                    prefixes.add(prefix)
+                    textstream.write("@prefix %s: <%s> .\n" % (prefix, namespace))
+            textstream.write("\n")
+            qnames = {}
+
+            def term(t):
+                if isinstance(t, Literal) and t.datatype is not None:
+                    return turtle_literal(t, namespace_manager, prefixes)
+                elif not isinstance(t, URIRef):
+                    return t.n3()
+                qname = qnames.get(t)
+                if qname is None:
+                    qname = qnames[t] = turtle_qname(t, namespace_manager, prefixes)
+                return qname
+
+            for count, (s, p, o) in enumerate(triples, 1):
+                textstream.write("%s %s %s .\n" % (term(s), term(p), term(o)))
+        else:
+            # N-Triples: serialize chunks of triples. Blank node
+            # identifiers are kept, so that chunks can be concatenated.
+            chunk = rdflib.Graph()
+            for count, t in enumerate(triples, 1):
+                chunk.add(t)
+                if count % self.chunk_size == 0:
+                    textstream.write(serialize_graph(chunk, 'nt'))
+                    chunk = rdflib.Graph()
+            textstream.write(serialize_graph(chunk, 'nt'))
+        self.triple_count = count
+
+    def export(self, filename):
+        # Works in source is a package or a type
+        package = self.source.ownerPackage
+
+        media_uri = package.getMetaData(config.data.namespace, "media_uri") or self.controller.get_default_media()
+
+        # Get the namespace from the package metdata
+        ontology = package.getMetaData(config.data.namespace, "ontology_uri")
+        if not ontology:
+            return _("Cannot find the ontology URI. It should be defined as package metadata.")
 
-        g.add((page, RDF.type, AS.OrderedCollectionPage))
-        g.add((page, AS.items, pageItems))
-        g.add((page, AS.startIndex, Literal(0, datatype=XSD.nonNegativeInteger)))
+        g = self.new_graph(ontology)
+        if self.stream and filename is not None:
+            if self.format in self.stream_formats:
+                self.output((self.triples(media_uri, ontology), g), filename)
+                logger.info(_("Wrote %(count)d triples to %(filename)s"), { "count": self.triple_count,
+                                                                            "filename": filename })
+                return ""
+            logger.warning(_("Cannot stream %s output, building the whole graph"), self.format)
+
+        for t in self.triples(media_uri, ontology):
+            g.add(t)
         if filename is None:
             return g
         else:
@@ -25,6 +25,7 @@ name="Base importer collection"
 from gettext import gettext as _
 
 import gzip
+import io
 import json
 import os
 import re
@@ -34,7 +35,7 @@ import xml.dom
 import xml.etree.ElementTree as ET
 
 import advene.core.config as config
-from advene.model.schema import AnnotationType
+from advene.model.schema import AnnotationType, RelationType
 import advene.util.handyxml as handyxml
 from advene.util.importer import GenericImporter
 import advene.util.helper as helper
@@ -51,6 +52,7 @@ def register(controller=None):
     controller.register_importer(IRIImporter)
     controller.register_importer(IRIDataImporter)
     controller.register_importer(FlatJSONImporter)
+    controller.register_importer(FlatJSONLinesImporter)
     return True
 
 class TextImporter(GenericImporter):
@@ -1150,3 +1152,124 @@ class FlatJSONImporter(GenericImporter):
             self.convert(self.iterator(data['annotations']))
         self.progress(1.0)
         return self.package
+
+class FlatJSONLinesImporter(GenericImporter):
+    """FlatJSON Lines importer.
+
+    It reads the output of the FlatJsonLinesExporter (optionally
+    gzip-compressed) one line at a time, so that very large files can
+    be imported. Relation members are referenced by annotation id.
+    """
+    name = _("FlatJSON Lines importer")
+
+    def __init__(self, *p, **kw):
+        super().__init__(*p, **kw)
+        # Imported annotations, indexed by id (for relation members)
+        self.annotations = {}
+        # Underlying binary file, used for progress information
+        self.rawfile = None
+        self.size = 0
+
+    @staticmethod
+    def can_handle(fname):
+        fname = fname.lower()
+        if fname.endswith('.jsonl') or fname.endswith('.jsonl.gz') or fname.endswith('.ndjson'):
+            return 100
+        else:
+            return 0
+
+    def open(self, filename):
+        """Open the (possibly gzip-compressed) file as a text stream.
+        """
+        self.rawfile = open(filename, 'rb')
+        self.size = os.fstat(self.rawfile.fileno()).st_size
+        magic = self.rawfile.read(2)
+        self.rawfile.seek(0)
+        if magic == b'\x1f\x8b':
+            return io.TextIOWrapper(gzip.GzipFile(fileobj=self.rawfile), encoding='utf-8')
+        else:
+            return io.TextIOWrapper(self.rawfile, encoding='utf-8')
+
+    def create_annotation(self, *p, **kw):
+        a = super().create_annotation(*p, **kw)
+        self.annotations[a.id] = a
+        return a
+
+    def get_relation_type(self, d):
+        rtype = self.package.get_element_by_id(d['type'])
+        if rtype is None:
+            schema = self.create_schema('imported-schema')
+            rtype = schema.createRelationType(ident=d['type'])
+            rtype.author = self.author
+            rtype.date = self.timestamp
+            rtype.title = d.get('type_title', d['type'])
+            rtype.mimetype = d.get('content_type') or 'text/plain'
+            rtype.setHackedMemberTypes( ('*', '*') )
+            if d.get('type_color'):
+                rtype.setMetaData(config.data.namespace, "color", d['type_color'])
+            schema.relationTypes.append(rtype)
+            self.update_statistics('relation-type')
+        elif not isinstance(rtype, RelationType):
+            raise Exception("Error during import: the specified type id %s is not a relation type" % d['type'])
+        return rtype
+
+    def create_relation(self, d):
+        members = []
+        for ident in d.get('members', []):
+            a = self.annotations.get(ident)
+            if a is None:
+                logger.warning("Relation %s: unknown member %s", d.get('id'), ident)
+                return None
+            members.append(a)
+        r = self.package.createRelation(
+            ident=d.get('id'),
+            type=self.get_relation_type(d),
+            author=d.get('creator') or self.author,
+            date=d.get('timestamp', self.timestamp),
+            members=members)
+        content = d.get('content')
+        if content:
+            r.content.data = content
+        self.package.relations.append(r)
+        self.update_statistics('relation')
+        return r
+
+    def iterator(self, f):
+        """Iterate over the annotation records of the file.
+
+        Relation records (which follow the annotations) are processed
+        as they are read.
+        """
+        for lineno, line in enumerate(f, 1):
+            if not line.strip():
+                continue
+            try:
+                d = json.loads(line)
+            except ValueError:
+                logger.error("Cannot parse line %d", lineno)
+                continue
+            record = d.pop('record', 'annotation')
+            if d.get('creator') is None:
+                # Use the default author
+                d.pop('creator', None)
+            if record == 'header':
+                if d.get('media'):
+                    self.package.setMedia(d['media'])
+            elif record == 'annotation':
+                yield d
+            elif record == 'relation':
+                self.create_relation(d)
+            if lineno % 1000 == 0 and self.size:
+                if not self.progress(self.rawfile.tell() / self.size, _("Imported %d elements") % lineno):
+                    break
+
+    def process_file(self, filename):
+        p, at = self.init_package(filename=filename)
+        f = self.open(filename)
+        try:
+            self.convert(self.iterator(f))
+        finally:
+            f.close()
+            self.rawfile.close()
+        self.progress(1.0)
+        return self.package
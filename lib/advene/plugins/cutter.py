@@ -27,6 +27,11 @@ from gi.repository import Gst
 
 from advene.util.gstimporter import GstImporter
 
+try:
+    import advene.util.audioanalysis as audioanalysis
+except ImportError:
+    audioanalysis = None
+
 def register(controller=None):
     controller.register_importer(CutterImporter)
     return True
@@ -61,13 +66,28 @@ class CutterImporter(GstImporter):
         ## Internal data structures
         self.buffer = []
         self.last_above = None
+        # NumPy analysis engine, if available
+        self.analyzer = None
+        # Level measurement interval (in ms) for the analyzer
+        self.interval = 10
 
     def do_finalize(self):
+        if self.analyzer is not None:
+            self.analyzer.flush()
+            above = self.analyzer.values('rms') >= self.threshold
+            min_gap = self.min_silence_duration / self.interval
+            self.buffer = [ (self.analyzer.time(begin), self.analyzer.time(end))
+                            for begin, end in audioanalysis.segments(above, min_gap) ]
         self.convert( { 'begin': begin,
                         'end': end,
                         'content': 'sound' }
                       for begin, end in self.buffer )
 
+    def process_frame(self, frame):
+        if self.analyzer is not None:
+            self.analyzer.feed(frame['data'], frame['pts'])
+        return True
+
     def do_process_message(self, message, bus=None):
         if message.get_name() == 'cutter':
             t = message['timestamp'] / Gst.MSECOND
@@ -86,4 +106,11 @@ class CutterImporter(GstImporter):
                              title=_("Sound segment"),
                              description=_("Sound segmentation with a threshold of %(threshold)d dB - channel: %(channel)s") % self.__dict__)
 
+        if audioanalysis is not None:
+            self.analyzer = audioanalysis.AudioAnalyzer(interval=self.interval,
+                                                        channel=self.channel,
+                                                        features=('rms', ))
+            return self.analyzer.pipeline(self.analyzer.sample_rate, self.analyzer.channels)
+
+        # Fallback: use cutter element messages
         return "audioconvert ! audiopanorama method=1 panorama=%d ! audioconvert ! cutter threshold-dB=%s run-length=%d" % (self.channel_mapping[self.channel], str(self.threshold), self.min_silence_duration * Gst.MSECOND)
@@ -23,7 +23,11 @@ logger = logging.getLogger(__name__)
 
 from gettext import gettext as _
 
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import importlib
+import multiprocessing
 import os
+import time
 
 try:
     import cv2
@@ -39,6 +43,112 @@ def register(controller=None):
         controller.register_importer(FeatureDetectImporter)
     return True
 
+# Minimum number of frames of a segment processed by a worker
+MIN_SEGMENT_FRAMES = 500
+
+def objects_changed(objects, stored, threshold):
+    """Check if the detected objects are different from the stored ones.
+
+    They are different if their number differs, or if an object
+    coordinate moved more than threshold.
+    """
+    if len(objects) != len(stored):
+        return True
+    if not objects:
+        return False
+    d = max( abs(a - b)
+             for obj, sto in zip(objects, stored)
+             for a, b in zip(obj, sto) )
+    logger.debug("distance %d", d)
+    return d > threshold
+
+def detect_segment(params, start=0, end=None, progress=None):
+    """Detect features in the frames [start, end[ of a video.
+
+    Detection is run every C{stride} frames. When the objects
+    detected in two successive sampled frames differ, detection is
+    run on the skipped frames in between, to find the exact change
+    positions. The last frame of the segment is always processed.
+
+    This is executed in worker processes.
+
+    Seeking by frame number (CAP_PROP_POS_FRAMES) is not accurate
+    with some codecs, so the segment is anchored on the timestamp of
+    its first decoded frame: frames decoded before C{start} are
+    skipped, and frames missed by a late seek are not processed.
+
+    @param params: a dict with filename, fps, classifier, size, neighbors, stride and motion_threshold keys
+    @param start: the first frame
+    @param end: the frame after the last one. If None, process until the end of the video.
+    @param progress: a method with signature (frame). If it returns False, the detection is stopped.
+    @return: a tuple (detections, last, decoded), where detections is the list of (frame, objects) tuples for frames where detected objects change, last is the last processed frame (or None) and decoded is the number of decoded frames.
+    """
+    video = cv2.VideoCapture(params['filename'])
+    if not video.isOpened():
+        raise Exception(_("Cannot read video file %s") % params['filename'])
+    if start:
+        video.set(cv2.CAP_PROP_POS_FRAMES, start)
+    cascade = cv2.CascadeClassifier(params['classifier'])
+    size = tuple(params['size'])
+    stride = max(1, params['stride'])
+    threshold = params['motion_threshold']
+
+    def detect(gray):
+        objects = cascade.detectMultiScale(gray, 1.2, params['neighbors']) # scale_factor=1.2, min_neighbors=2
+        return [ tuple(int(v) for v in obj) for obj in objects ]
+
+    detections = []
+    def record(frame, objects):
+        if not detections or detections[-1][1] != objects:
+            detections.append((frame, objects))
+
+    # Grey-level scaled images of the frames skipped since the last sample
+    pending = []
+    previous = None
+    def sample(frame, gray):
+        nonlocal previous
+        objects = detect(gray)
+        if previous is not None and objects_changed(objects, previous, threshold):
+            # Refine: process the skipped frames
+            for f, g in pending:
+                record(f, detect(g))
+        pending.clear()
+        record(frame, objects)
+        previous = objects
+
+    frame = start
+    decoded = 0
+    # Whether the frame number is known
+    anchored = not start
+    try:
+        while end is None or frame < end:
+            ret, image = video.read()
+            if not ret:
+                break
+            if not anchored:
+                anchored = True
+                frame = int(round(video.get(cv2.CAP_PROP_POS_MSEC) * params['fps'] / 1000))
+                if frame > start:
+                    logger.warning("Inaccurate seek in %s: frames %d to %d are not processed", params['filename'], start, frame - 1)
+                    start = frame
+            if frame < start:
+                frame += 1
+                continue
+            decoded += 1
+            gray = cv2.cvtColor(cv2.resize(image, size), cv2.COLOR_BGR2GRAY)
+            if (frame - start) % stride == 0:
+                sample(frame, gray)
+            else:
+                pending.append((frame, gray))
+            frame += 1
+            if progress is not None and frame % 25 == 0 and not progress(frame):
+                break
+        if pending:
+            sample(*pending.pop())
+    finally:
+        video.release()
+    return detections, (frame - 1 if decoded else None), decoded
+
 class FeatureDetectImporter(GenericImporter):
     name = _("Feature detection (face...)")
 
@@ -52,6 +162,11 @@ class FeatureDetectImporter(GenericImporter):
 
         # Detect that a shape has moved
         self.motion_threshold = 10
+        # Run detection every stride frames
+        self.stride = 1
+        # Seeking is not frame-accurate with some codecs (see
+        # detect_segment), so parallel processing is not the default.
+        self.workers = 1
 
         self.optionparser.add_option("-n", "--min-neighbors",
                                      action="store", type="int", dest="neighbors", default=self.neighbors,
@@ -65,6 +180,12 @@ class FeatureDetectImporter(GenericImporter):
         self.optionparser.add_option("-c", "--classifier",
                                      action="store", type="choice", dest="classifier", choices=classifiers, default=self.classifier,
                                      help=_("Classifier"))
+        self.optionparser.add_option("-t", "--stride",
+                                     action="store", type="int", dest="stride", default=self.stride,
+                                     help=_("Run detection every N frames. Skipped frames are processed only around detected changes, so features visible less than N frames may be missed."))
+        self.optionparser.add_option("-w", "--workers",
+                                     action="store", type="int", dest="workers", default=self.workers,
+                                     help=_("Number of worker processes. Each one processes a segment of the video, starting with an approximate seek: some frames at segment boundaries may be missed with some codecs."))
 
     @staticmethod
     def can_handle(fname):
@@ -85,29 +206,107 @@ class FeatureDetectImporter(GenericImporter):
         self.progress(0, _("Detection started"))
         video = cv2.VideoCapture(str(filename))
 
-        if not video:
-            raise "Cannot read video file:"
-        self.convert(self.iterator(video))
-        return self.package
-
-    def iterator(self, video):
-        def svg_rect(x, y , w, h):
-            return
-
         if not video.isOpened():
-            return
-
-        framecount = video.get(cv2.CAP_PROP_FRAME_COUNT)
-        pos = 0
+            raise Exception(_("Cannot read video file %s") % filename)
+        framecount = int(video.get(cv2.CAP_PROP_FRAME_COUNT))
+        fps = video.get(cv2.CAP_PROP_FPS) or float(config.data.preferences['default-fps'])
         # Take the first frame to get width/height
         ret, frame = video.read()
-        width, height, depth = frame.shape
+        video.release()
+        if not ret:
+            return self.package
+        height, width = frame.shape[:2]
         scaled_width, scaled_height = int(width / self.scale), int(height / self.scale)
-        logger.warning("Video dimensions %dx%d - scaled to %dx%d", width, height, scaled_width, scaled_height)
+        logger.info("Video dimensions %dx%d - scaled to %dx%d", width, height, scaled_width, scaled_height)
+
+        params = {
+            'filename': str(filename),
+            'fps': fps,
+            'classifier': config.data.advenefile( ('haars', self.classifier + '.xml') ),
+            'size': (scaled_width, scaled_height),
+            'neighbors': self.neighbors,
+            'stride': self.stride,
+            'motion_threshold': self.motion_threshold,
+        }
+        t0 = time.time()
+        detections, last, decoded = self.detect(params, framecount)
+        duration = time.time() - t0
+        logger.info("Processed %d frames in %.1fs: %.1f frames/s", decoded, duration, decoded / (duration or 1))
+        self.progress(1.0, _("Processed %(frames)d frames in %(duration).1fs (%(rate).1f frames/s)") % {
+            'frames': decoded,
+            'duration': duration,
+            'rate': decoded / (duration or 1) })
+
+        self.convert(self.iterator(detections, last, fps, scaled_width, scaled_height))
+        return self.package
+
+    def segments(self, framecount):
+        """Return the list of (start, end) frame segments to process.
+        """
+        count = min(self.workers * 2, framecount // MIN_SEGMENT_FRAMES)
+        if self.workers <= 1 or count <= 1:
+            return [ (0, None) ]
+        bounds = [ i * framecount // count for i in range(count) ]
+        # The last segment is processed until the end of the video,
+        # in case the frame count is not accurate.
+        return list(zip(bounds, bounds[1:] + [ None ]))
+
+    def detect(self, params, framecount):
+        """Detect features in the video.
+
+        Segments are processed by a pool of worker processes, and
+        their results are concatenated.
 
-        cascade = cv2.CascadeClassifier(config.data.advenefile( ('haars', self.classifier + '.xml') ))
-        count = 0
+        @return: a tuple (detections, last, decoded) (see L{detect_segment})
+        """
+        segments = self.segments(framecount)
+        if len(segments) == 1:
+            def progress(frame):
+                return self.progress(frame / (framecount or 1),
+                                     _("Processing frame %(frame)d / %(count)d") % { 'frame': frame,
+                                                                                      'count': framecount })
+            return detect_segment(params, progress=progress)
+
+        # Plugins are loaded under a private module name, which cannot
+        # be imported by worker processes: use the advene.plugins one.
+        worker = importlib.import_module('advene.plugins.featuredetect').detect_segment
+        results = {}
+        # Use the spawn method, since fork is unsafe when the GUI is running
+        with ProcessPoolExecutor(max_workers=self.workers,
+                                 mp_context=multiprocessing.get_context('spawn')) as executor:
+            futures = dict( (executor.submit(worker, params, start, end), i)
+                            for (i, (start, end)) in enumerate(segments) )
+            for n, future in enumerate(as_completed(futures)):
+                results[futures[future]] = future.result()
+                if not self.progress((n + 1) / len(segments),
+                                     _("Processed %(count)d / %(total)d segments") % { 'count': n + 1,
+                                                                                        'total': len(segments) }):
+                    for f in futures:
+                        f.cancel()
+                    break
+        # Merge the results of contiguous processed segments
+        detections = []
+        last = None
+        decoded = 0
+        for i in range(len(segments)):
+            if i not in results:
+                break
+            d, l, c = results[i]
+            # A segment starts with the objects of its first frame,
+            # which may be the same as at the end of the previous one.
+            detections.extend((frame, objects) for frame, objects in d
+                              if not detections or detections[-1][1] != objects)
+            if l is not None:
+                last = l
+            decoded += c
+        return detections, last, decoded
 
+    def iterator(self, detections, last, fps, scaled_width, scaled_height):
+        """Generate annotations from the detected objects.
+
+        @param detections: a list of (frame, objects) tuples, where objects change
+        @param last: the last processed frame
+        """
         svg_template = """<svg xmlns='http://www.w3.org/2000/svg' version='1' viewBox="0 0 %(scaled_width)d %(scaled_height)d" x='0' y='0' width='%(scaled_width)d' height='%(scaled_height)d'>%%s</svg>""" % locals()
         def objects2svg(objs, threshold=-1):
             """Convert a object-list into SVG.
@@ -115,45 +314,30 @@ class FeatureDetectImporter(GenericImporter):
             return svg_template % "\n".join("""<rect style="fill:none;stroke:green;stroke-width:4;" width="%(w)d" height="%(h)s" x="%(x)s" y="%(y)s"></rect>""" % locals()
                                             for (x, y, w, h) in objs)
 
-        start_pos = None
-
-        while ret:
-
-            gray = cv2.cvtColor(cv2.resize(frame, (scaled_width, scaled_height)), cv2.COLOR_RGB2GRAY)
-
-            objects = cascade.detectMultiScale(gray, 1.2, self.neighbors) # scale_factor=1.2, min_neighbors=2
-
-            def distance(v1, v2):
-                d = max( abs(a - b)
-                         for obj, sto in zip(objects, stored_objects)
-                         for a, b in zip(obj, sto) )
-                logger.debug("distance %d", d)
-                return d
+        def position(frame):
+            return int(frame * 1000 / fps)
 
-            if len(objects):
+        start_pos = None
+        stored_objects = None
+        for frame, objects in detections:
+            pos = position(frame)
+            if objects:
                 logger.debug("Detected object %s", objects)
                 # Detected face.
                 if start_pos is None:
-                    # Only create a new annotation if above threshold
-                    stored_objects = objects[:]
+                    stored_objects = objects
+                    start_pos = pos
+                elif objects_changed(objects, stored_objects, self.motion_threshold):
+                    # A detection already occurred and it is too different.
+                    yield {
+                        'begin': start_pos,
+                        'end': pos,
+                        'content': objects2svg(stored_objects),
+                        }
+                    stored_objects = objects
                     start_pos = pos
-                    count += 1
-                else:
-                    # A detection already occurred. Check if it not too different.
-                    if (len(objects) != len(stored_objects)
-                        or distance(objects, stored_objects) > self.motion_threshold):
-                        logger.debug("------------------------------------ generate annotation ---------------------")
-                        yield {
-                            'begin': start_pos,
-                            'end': pos,
-                            'content': objects2svg(stored_objects),
-                            }
-                        stored_objects = objects[:]
-                        start_pos = pos
-                        count += 1
             elif start_pos is not None:
-                 #End of feature(s)
-                logger.debug("------------------------------------ generate annotation ---------------------")
+                #End of feature(s)
                 yield {
                     'begin': start_pos,
                     'end': pos,
@@ -161,18 +345,10 @@ class FeatureDetectImporter(GenericImporter):
                     }
                 start_pos = None
 
-            if not self.progress(video.get(cv2.CAP_PROP_POS_FRAMES) / framecount,
-                                 _("Detected %(count)d feature(s) until %(time)s") % { 'count': count,
-                                                                                       'time': helper.format_time(pos) }):
-                break
-
-            pos = video.get(cv2.CAP_PROP_POS_MSEC)
-            ret, frame = video.read()
-
         # Last frame
-        if start_pos is not None:
+        if start_pos is not None and last is not None:
             yield {
                 'begin': start_pos,
-                'end': pos,
+                'end': position(last),
                 'content': objects2svg(stored_objects),
                 }
@@ -20,25 +20,29 @@
 
 name="Shot detection importer"
 
+import logging
+logger = logging.getLogger(__name__)
+
 from gettext import gettext as _
 
 import os
-import sys
 
 try:
-    # Needed for pimpy component
     import numpy
-    import opencv.cv as cv
-    import opencv.highgui as hg
 except ImportError:
-    numpy = cv = hg = None
+    numpy = None
+
+try:
+    import cv2
+except ImportError:
+    cv2 = None
 
 import advene.core.config as config
 import advene.util.helper as helper
 from advene.util.importer import GenericImporter
 
 def register(controller=None):
-    if numpy and cv and hg:
+    if numpy is not None and cv2 is not None:
         controller.register_importer(DelakisShotDetectImporter)
     return True
 
@@ -51,6 +55,9 @@ class DelakisShotDetectImporter(GenericImporter):
         'aggressive': { 'ALPHA': 1.7, 'BETA': 0.05 },
         }
 
+    # Number of frames processed at once
+    chunk_size = 1000
+
     def __init__(self, *p, **kw):
         super(DelakisShotDetectImporter, self).__init__(*p, **kw)
 
@@ -82,23 +89,23 @@ class DelakisShotDetectImporter(GenericImporter):
         histofile = filename + '-histogram.npy'
         if os.path.exists(histofile):
             self.progress(0, _("Loading histogram"))
-            histos = numpy.load(histofile)
+            # Memory-map the histogram, so that it is read by chunks
+            histos = numpy.load(histofile, mmap_mode='r')
+            chunks = ( histos[i:i + self.chunk_size]
+                       for i in range(0, len(histos), self.chunk_size) )
             # FIXME: how to cache FPS ?
             fps = float(config.data.preferences['default-fps'])
         else :
-            he = HistogramExtractor()
-            histos, fps = he.process(filename, self.progress)
-            if self.cache_histogram:
-                try:
-                    numpy.save(histofile, histos)
-                except Exception as e:
-                    self.controller.log("Cannot save histogram: %s" % e.message)
+            he = HistogramExtractor(filename, chunk_size=self.chunk_size)
+            chunks = he.chunks(self.progress,
+                               cache=histofile if self.cache_histogram else None)
+            fps = he.fps
 
         sd = ShotDetector()
         for k, v in self.profiles[self.profile].items():
             setattr(sd, k, v)
         #Detect cut and dissolve
-        self.convert(sd.process(histos, int(1000 / fps)))
+        self.convert(sd.process_chunks(chunks, int(1000 / fps)))
         return self.package
 
 # Code adapted from pimpy: http://pim.gforge.inria.fr/pimpy/
@@ -122,6 +129,12 @@ class ShotDetector:
     year = {2006},
     url = {ftp://ftp.irisa.fr/techreports/theses/2006/delakis.pdf }
     }
+
+    Histograms are reduced to per-frame features (histogram
+    distance, cumulated distance over K frames, pixelwise
+    difference), which are then thresholded. Histograms can be
+    given by chunks (see L{process_chunks}), in which case only the
+    current chunk and the last K histograms are held in memory.
     """
     def __init__(self, progress=None):
         if progress is None:
@@ -142,47 +155,41 @@ class ShotDetector:
         pass
 
     def process(self, histos, mspf=40):
+        """Detect cuts and dissolves from the array of histograms.
+        """
+        return self.process_chunks([ histos ], mspf)
+
+    def process_chunks(self, chunks, mspf=40):
+        """Detect cuts and dissolves from histogram chunks.
+
+        @param chunks: an iterable of (frames, NB_BINS) histogram arrays
+        @param mspf: the duration of a frame, in ms
+        """
         self.progress(.1, _("Computing hdiff"))
-        nbpixel = numpy.sum(histos[0])
-        #compute various histogram variations
-        hdiff = (numpy.abs(histos[:-1] - histos[1:])) / 2
-        hdiffsumchannel = numpy.sum(hdiff, axis=1)
-        histo_dist = hdiffsumchannel / nbpixel / NB_CHANNELS
+        histo_dist, hcumul, hpixelwise = self.features(chunks)
+        if not len(histo_dist):
+            return
 
         self.progress(.2, _("Detecting cuts"))
-        #detect hard cut
-        cuts = numpy.flatnonzero( histo_dist >= self.HIGH_CUT_THRESHOLD )
-
-        #detect low cut
-        for f in numpy.flatnonzero(
-                (histo_dist < self.HIGH_CUT_THRESHOLD) &
-                (histo_dist >= self.SHOT_THRESHOLD)
-        ):
-            if self.__cut_detection(f, histo_dist):
-                cuts = numpy.append(cuts, f)
-
-        cuts.sort()
-        n = 1
-        yield {
-            'begin': 0,
-            'end': cuts[0] * mspf,
-            'content': str(n),
-            }
-        for b, e in zip(cuts[:-1], cuts[1:]):
-            n += 1
+        cuts = self.__cut_detection(histo_dist)
+        if len(cuts):
+            n = 1
             yield {
-                'begin': b * mspf,
-                'end': e * mspf,
-                'content': str(n)
+                'begin': 0,
+                'end': cuts[0] * mspf,
+                'content': str(n),
                 }
+            for b, e in zip(cuts[:-1], cuts[1:]):
+                n += 1
+                yield {
+                    'begin': b * mspf,
+                    'end': e * mspf,
+                    'content': str(n)
+                    }
 
         self.progress(.3, _("Detecting dissolves"))
         #detect dissolve
-        hcumul = self.__histo_cumul(histos)
         hcumul = self.__filter_by_cut(cuts, hcumul)
-        hpixelwise = self.__histo_pixelwise(hdiff)
-        hpixelwise = hpixelwise / nbpixel / 100
-
         for diss in self.__detect_dissolve(hcumul, hpixelwise):
             yield {
                 'begin': diss[0] * mspf,
@@ -190,98 +197,213 @@ class ShotDetector:
                 'content': 'grad',
                 }
 
+    def features(self, chunks):
+        """Compute the per-frame features from histogram chunks.
+
+        Only the last K histograms of a chunk are kept for processing
+        the next one.
+
+        @return: a tuple of arrays (histo_dist, hcumul, hpixelwise), whose item i
+                 is related to the transition between frames i and i + 1.
+        """
+        histo_dist = []
+        hcumul = []
+        hpixelwise = []
+        nbpixel = None
+        # Weights for the pixelwise difference
+        weights = numpy.arange(T, NB_BINS) - T - 1
+        # Histograms of the previous frames
+        previous = numpy.empty((0, NB_BINS))
+        # Index of the first frame of the chunk
+        offset = 0
+        for chunk in chunks:
+            if not len(chunk):
+                continue
+            chunk = numpy.asarray(chunk, dtype=numpy.float64)
+            if nbpixel is None:
+                nbpixel = numpy.sum(chunk[0])
+            histos = numpy.concatenate((previous, chunk))
+            start = len(previous)
+            # Indexes (in histos) of the frames that have a predecessor
+            idx = numpy.arange(max(start, 1), len(histos))
+            if len(idx):
+                hdiff = numpy.abs(histos[idx] - histos[idx - 1]) / 2
+                histo_dist.append(numpy.sum(hdiff, axis=1) / nbpixel / NB_CHANNELS)
+                hpixelwise.append(hdiff[:, T:NB_BINS] @ weights)
+
+                # Cumulated distance of the mean histogram of the
+                # transition with the K - 1 previous frames
+                h = (histos[idx] + histos[idx - 1]) / 2
+                frame = idx + (offset - start)
+                c = numpy.zeros(len(idx))
+                for k in range(1, K):
+                    valid = frame >= k
+                    d = numpy.sum(numpy.abs(h - histos[numpy.maximum(idx - k, 0)]), axis=1) / nbpixel
+                    c += numpy.where(valid, d, 0)
+                hcumul.append(c / K)
+            previous = histos[-K:]
+            offset += len(chunk)
+
+        if not histo_dist:
+            return numpy.empty(0), numpy.empty(0), numpy.empty(0)
+        return (numpy.concatenate(histo_dist),
+                numpy.concatenate(hcumul),
+                numpy.concatenate(hpixelwise) / nbpixel / 100)
+
     def __detect_dissolve(self, hcumul, hpixelwise):
-        motion_frames = hpixelwise > self.MOTION_THRESHOLD
-        start = end = -1
-        for f in numpy.flatnonzero(hcumul > self.DISS_THRESHOLD):
-            #new frame not in current dissolve, record dissolve
-            if start > 0 and f > end:
-                motion = numpy.sum(motion_frames[list(range(start,end))])
-                if not motion and end - start > self.DISS_MIN_FRAMES:
-                    yield (start,end)
-                start = end = -1
-
-            if start < 0 :
-                start = end = f
-                #find lower bound
-                while start > 0 and hcumul[start] > self.DISS_START_THRESHOLD:
-                    start -= 1
-                #find upper bound
-                while end+1 < len(hcumul) and hcumul[end+1] > self.DISS_END_THRESHOLD :
-                    end += 1
-
-        #add the last dissolve
-        if start > 0 and end > 0 :
-            motion = numpy.sum(motion_frames[list(range(start,end))])
-            if not motion and end - start > self.DISS_MIN_FRAMES:
-                yield (start,end)
-
-    def __histo_pixelwise(self,hdiff):
-        r = []
-        for h in hdiff:
-            s = 0
-            for i in range(T, NB_BINS):
-                s += (h[i] * (i-T-1))
-            r.append(s)
-        return numpy.array(r)
-
-    def __histo_cumul(self, histos):
-        nbpix = numpy.sum(histos[0])
-        r = []
-        for i in range(1, len(histos)):
-            h = (histos[i] + histos[i-1]) / 2
-            c = 0
-            for k in range(1, K):
-                if i - k < 0 :
-                    break
-                c += numpy.sum(numpy.abs(h - histos[i - k])) / nbpix
-            r.append(c / K)
-        return numpy.array(r)
+        n = len(hcumul)
+        if not n:
+            return
+        indexes = numpy.arange(n)
+        # Cumulated count of motion frames
+        motion = numpy.concatenate(([ 0 ], numpy.cumsum(hpixelwise > self.MOTION_THRESHOLD)))
+        # Lower bound of a dissolve containing frame f: last frame before f
+        # below the start threshold (or 0).
+        lower = numpy.maximum.accumulate(numpy.where(hcumul <= self.DISS_START_THRESHOLD, indexes, 0))
+        # Upper bound of a dissolve containing frame f: last frame
+        # before the next frame below the end threshold (or the last frame).
+        upper = numpy.minimum.accumulate(numpy.where(hcumul <= self.DISS_END_THRESHOLD, indexes, n)[::-1])[::-1]
+
+        candidates = numpy.flatnonzero(hcumul > self.DISS_THRESHOLD)
+        i = 0
+        while i < len(candidates):
+            f = candidates[i]
+            start = lower[f]
+            end = upper[f + 1] - 1 if f + 1 < n else f
+            if motion[end] - motion[start] == 0 and end - start > self.DISS_MIN_FRAMES:
+                yield (start, end)
+            # Skip candidates belonging to the same dissolve
+            i = numpy.searchsorted(candidates, end, side='right')
 
     def __filter_by_cut(self, cuts, histo_cumul):
-        for c in cuts:
-            for i in range(K):
-                try :
-                    histo_cumul[c + i] = histo_cumul[c + i]/(K - i)
-                except IndexError:
-                    break
-        return histo_cumul
+        # Divide the K values following a cut by K, K - 1, ... 1
+        divisor = numpy.ones(len(histo_cumul))
+        for i in range(K):
+            idx = cuts + i
+            idx = idx[idx < len(histo_cumul)]
+            numpy.multiply.at(divisor, idx, K - i)
+        return histo_cumul / divisor
+
+    def __cut_detection(self, histo_dist):
+        """Return the indexes of hard cuts and adaptive threshold cuts.
+
+        The adaptive threshold is based on the mean distance over
+        MEAN_WINDOW frames before and after each frame, computed with
+        cumulative sums.
+        """
+        n = len(histo_dist)
+        f = numpy.arange(n)
+        cumsum = numpy.concatenate(([ 0 ], numpy.cumsum(histo_dist)))
+
+        # Left window: [f - 1 - MEAN_WINDOW, f - 1[
+        left_start = f - 1 - MEAN_WINDOW
+        left_valid = left_start >= 0
+        left_start = numpy.maximum(left_start, 0)
+        mean_left = (cumsum[numpy.maximum(f - 1, 0)] - cumsum[left_start]) / MEAN_WINDOW + self.BETA
+
+        # Right window: [f + 1, f + 1 + MEAN_WINDOW[, truncated at the end
+        right_start = numpy.minimum(f + 1, n)
+        right_end = numpy.minimum(f + 1 + MEAN_WINDOW, n)
+        right_count = right_end - right_start
+        right_valid = right_count > 0
+        mean_right = (cumsum[right_end] - cumsum[right_start]) / numpy.maximum(right_count, 1) + self.BETA
+
+        adapt_threshold = self.ALPHA * ((mean_left + mean_right) / 2) - self.BETA
+        low_cuts = ((histo_dist < self.HIGH_CUT_THRESHOLD)
+                    & (histo_dist >= self.SHOT_THRESHOLD)
+                    & left_valid & right_valid
+                    & (histo_dist >= adapt_threshold))
+        return numpy.flatnonzero((histo_dist >= self.HIGH_CUT_THRESHOLD) | low_cuts)
 
-    def __cut_detection(self, f, histo_dist):
-        d = histo_dist[f]
-        left_diff  = histo_dist[f - 1 - MEAN_WINDOW : f - 1] + self.BETA
-        right_diff = histo_dist[f + 1 : f + 1 + MEAN_WINDOW] + self.BETA
+class HistogramExtractor:
+    """Extract grey-level histograms from a video file.
 
-        mean_left  = numpy.mean(left_diff)
-        mean_rigth = numpy.mean(right_diff)
-        mean_local = (mean_left + mean_rigth) / 2
+    @ivar fps: the video framerate
+    """
+    def __init__(self, videofile, chunk_size=1000):
+        self.videofile = videofile
+        self.chunk_size = chunk_size
+        self.video = cv2.VideoCapture(str(videofile))
+        if not self.video.isOpened():
+            raise Exception("Could not open video file")
+        self.fps = self.video.get(cv2.CAP_PROP_FPS) or float(config.data.preferences['default-fps'])
 
-        adapt_threshold =  self.ALPHA * mean_local  - self.BETA
-        return d >= adapt_threshold
+    def chunks(self, progress, cache=None):
+        """Generate histogram chunks.
 
-class HistogramExtractor:
-    def process(self, videofile, progress):
+        @param progress: a progress callback. If it returns False, the extraction is stopped.
+        @param cache: a filename. If specified, the histograms are saved in numpy format
+                      once the whole video has been read.
+        @return: an iterator of (frames, NB_BINS) int32 arrays
+        """
         progress(0, _("Extracting histogram"))
-        video = hg.cvCreateFileCapture(str(videofile).encode(sys.getfilesystemencoding()))
-        if not video:
-            raise Exception("Could not open video file")
-        histo = cv.cvCreateHist([256],cv.CV_HIST_ARRAY,[[0,256]], 1)
-        frame = hg.cvQueryFrame(video)
-        frame_gray  = cv.cvCreateImage(cv.cvGetSize(frame), frame.depth, 1)
-        hists    = []
+        framecount = self.video.get(cv2.CAP_PROP_FRAME_COUNT) or 1
+        rawfile = None
+        if cache is not None:
+            rawfile = open(cache + '.tmp', 'wb')
         nbframes = 0
+        complete = False
+        try:
+            buf = numpy.empty((self.chunk_size, NB_BINS), dtype='int32')
+            n = 0
+            while True:
+                ret, frame = self.video.read()
+                if not ret:
+                    break
+                if frame.ndim == 3:
+                    frame = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+                buf[n] = cv2.calcHist([ frame ], [ 0 ], None, [ 256 ], [ 0, 256 ]).ravel()[:NB_BINS]
+                n += 1
+                if n == self.chunk_size:
+                    if rawfile is not None:
+                        buf.tofile(rawfile)
+                    nbframes += n
+                    yield buf
+                    buf = numpy.empty((self.chunk_size, NB_BINS), dtype='int32')
+                    n = 0
+                    if not progress(min(nbframes / framecount, 1.0), _("Extracting histogram")):
+                        return
+            if n:
+                if rawfile is not None:
+                    buf[:n].tofile(rawfile)
+                nbframes += n
+                yield buf[:n]
+            complete = True
+        finally:
+            self.video.release()
+            if rawfile is not None:
+                rawfile.close()
+                # Do not cache the histograms of a cancelled or
+                # failed extraction: they would be used as is by
+                # the next run.
+                if complete and nbframes:
+                    self.save_cache(cache, nbframes)
+                try:
+                    os.unlink(cache + '.tmp')
+                except OSError:
+                    pass
 
-        fps = hg.cvGetCaptureProperty(video, hg.CV_CAP_PROP_FPS)
-        while frame :
-            if not progress(hg.cvGetCaptureProperty(video, hg.CV_CAP_PROP_POS_AVI_RATIO)):
-                break
-            hg.cvConvertImage(frame,frame_gray)
-            cv.cvCalcHist(frame_gray,histo,0,None)
-            h = [cv.cvGetReal1D(histo.bins,i) for i in range(255) ]
-            h = numpy.array(h,dtype='int32')
-            hists.append(h)
-            frame = hg.cvQueryFrame(video)
-            nbframes += 1
-
-        hists = numpy.array(hists)
-        return hists.reshape(nbframes, -1), fps
+    def save_cache(self, cache, nbframes):
+        """Convert the raw histogram data to numpy format.
+        """
+        try:
+            raw = numpy.memmap(cache + '.tmp', dtype='int32', mode='r', shape=(nbframes, NB_BINS))
+            data = numpy.lib.format.open_memmap(cache, mode='w+', dtype='int32', shape=(nbframes, NB_BINS))
+            for i in range(0, nbframes, self.chunk_size):
+                data[i:i + self.chunk_size] = raw[i:i + self.chunk_size]
+            data.flush()
+            del data, raw
+        except Exception as e:
+            logger.error("Cannot save histogram: %s", e)
+            try:
+                os.unlink(cache)
+            except OSError:
+                pass
+
+    def process(self, progress):
+        """Return the array of all histograms, and the framerate.
+        """
+        hists = list(self.chunks(progress))
+        if not hists:
+            return numpy.empty((0, NB_BINS), dtype='int32'), self.fps
+        return numpy.concatenate(hists), self.fps
@@ -26,10 +26,15 @@ from gettext import gettext as _
 
 import base64
 from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+import hashlib
 from io import BytesIO
 import json
+import os
+import time
 from PIL import Image
 import requests
+from requests.adapters import HTTPAdapter
 
 import advene.core.config as config
 import advene.util.helper as helper
@@ -39,6 +44,163 @@ def register(controller=None):
     controller.register_importer(HPIImporter)
     return True
 
+# Number of frames sent for each annotation
+FRAMES_PER_ANNOTATION = 3
+
+# HTTP status codes for which a request is retried
+RETRY_STATUS = (429, 500, 502, 503, 504)
+
+class VCDError(Exception):
+    """Error reported by the VCD server.
+    """
+    pass
+
+class VCDClient:
+    """Client for the VCD concept detection webservice.
+
+    It uses a persistent session, so that connections to the server
+    are reused. Annotations are sent in batches, whose size is adapted
+    to the server response time within the limits advertised by the
+    server. Multiple requests are kept in flight, so that the server
+    does not wait for the client between requests, and failed requests
+    are retried with an exponential backoff.
+
+    @ivar url: the webservice URL
+    @ivar inflight: the maximum number of simultaneous requests
+    @ivar retries: the number of retries of a failed request
+    @ivar backoff: the delay (in seconds) before the first retry. It is doubled for each retry.
+    @ivar timeout: the request timeout (in seconds)
+    @ivar target_duration: the expected request duration (in seconds), used to adapt the batch size
+    @ivar batch_size: the current batch size (in frames)
+    """
+    def __init__(self, url, inflight=2, retries=3, backoff=1.0, timeout=600, target_duration=5.0):
+        self.url = url
+        self.inflight = max(1, inflight)
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.target_duration = target_duration
+        self.minimum_batch_size = FRAMES_PER_ANNOTATION
+        self.maximum_batch_size = None
+        self.batch_size = 16 * FRAMES_PER_ANNOTATION
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_maxsize=self.inflight)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def close(self):
+        self.session.close()
+
+    def get_capabilities(self, timeout=10):
+        """Return the server capabilities.
+
+        The batch size limits are updated accordingly.
+
+        @raise requests.exceptions.RequestException: if the server cannot be reached
+        """
+        r = self.session.get(self.url, timeout=timeout)
+        if r.status_code != 200:
+            return {}
+        caps = r.json().get('data', {}).get('capabilities', {})
+        if caps.get('minimum_batch_size'):
+            self.minimum_batch_size = max(caps['minimum_batch_size'], FRAMES_PER_ANNOTATION)
+        if caps.get('maximum_batch_size'):
+            self.maximum_batch_size = caps['maximum_batch_size']
+        self.batch_size = self.clamp(self.batch_size)
+        return caps
+
+    def clamp(self, size):
+        """Return the size, limited to the advertised batch size limits.
+        """
+        size = max(size, self.minimum_batch_size)
+        if self.maximum_batch_size:
+            size = min(size, self.maximum_batch_size)
+        return int(size)
+
+    def adapt(self, frames, duration):
+        """Adapt the batch size after a request.
+
+        @param frames: the number of frames of the request
+        @param duration: the request duration
+        """
+        if duration <= 0:
+            return
+        size = frames * self.target_duration / duration
+        # Do not change too abruptly
+        size = min(max(size, self.batch_size / 2), self.batch_size * 2)
+        self.batch_size = self.clamp(size)
+
+    def post(self, data):
+        """Send a request, retrying if necessary.
+
+        @return: a tuple (output, duration)
+        @raise VCDError: if the server returned an error
+        @raise requests.exceptions.RequestException: if the request still fails after retries
+        """
+        headers = {"Content-Type": "application/json", "Accept": "application/json"}
+        for attempt in range(self.retries + 1):
+            t0 = time.time()
+            try:
+                response = self.session.post(self.url, headers=headers, json=data, timeout=self.timeout)
+                if response.status_code in RETRY_STATUS:
+                    response.raise_for_status()
+                break
+            except (requests.exceptions.ConnectionError,
+                    requests.exceptions.Timeout,
+                    requests.exceptions.HTTPError) as e:
+                if attempt >= self.retries:
+                    raise
+                delay = self.backoff * 2 ** attempt
+                logger.warning("VCD request failed (%s) - retrying in %.1fs", e, delay)
+                time.sleep(delay)
+        duration = time.time() - t0
+        try:
+            output = response.json()
+        except ValueError:
+            raise VCDError(_("Server transmission error."))
+        if output.get('status') != 200:
+            raise VCDError(output.get('message', _("Server transmission error.")))
+        return output, duration
+
+    def process(self, annotations, build_request):
+        """Send the annotations to the server.
+
+        @param annotations: a list of annotations
+        @param build_request: a method with signature (annotations), returning the request data for the given annotations
+        @return: a generator of (annotations, output) tuples, in the order of the annotations
+        """
+        executor = ThreadPoolExecutor(max_workers=self.inflight)
+        pending = {}
+        results = {}
+        position = 0
+        submitted = 0
+        expected = 0
+        try:
+            while position < len(annotations) or pending:
+                while position < len(annotations) and len(pending) < self.inflight:
+                    count = max(1, self.batch_size // FRAMES_PER_ANNOTATION)
+                    batch = annotations[position:position + count]
+                    position += len(batch)
+                    future = executor.submit(self.post, build_request(batch))
+                    pending[future] = (submitted, batch)
+                    submitted += 1
+                done, _not_done = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    index, batch = pending.pop(future)
+                    output, duration = future.result()
+                    self.adapt(len(batch) * FRAMES_PER_ANNOTATION, duration)
+                    logger.debug("VCD batch of %d annotations processed in %.2fs - batch size %d",
+                                 len(batch), duration, self.batch_size)
+                    results[index] = (batch, output)
+                while expected in results:
+                    yield results.pop(expected)
+                    expected += 1
+        finally:
+            for future in pending:
+                future.cancel()
+            executor.shutdown(wait=False)
+
 class HPIImporter(GenericImporter):
     name = _("HPI concept extraction")
     annotation_filter = True
@@ -75,15 +237,17 @@ class HPIImporter(GenericImporter):
         self.split_types = False
         self.create_relations = False
         self.url = self.get_preferences().get('url', 'http://localhost:9000/')
+        self.inflight = 2
+        self.resume = True
+        # Number of concepts in the checkpoint, used as key for the next ones
+        self.checkpoint_size = 0
 
         self.server_options = {}
         # Populate available models options from server
         try:
-            r = requests.get(self.url)
-            if r.status_code == 200:
+            caps = VCDClient(self.url).get_capabilities()
+            if caps:
                 # OK. We should have some server options available as json
-                data = r.json()
-                caps = data.get('data', {}).get('capabilities', {})
                 for n in ('minimum_batch_size', 'maximum_batch_size', 'available_models'):
                     self.server_options[n] = caps.get(n, None)
                 logger.warning("Got capabilities from VCD server - batch size in (%d, %d) - %d models: %s",
@@ -91,7 +255,7 @@ class HPIImporter(GenericImporter):
                                self.server_options['maximum_batch_size'],
                                len(self.server_options['available_models']),
                                ", ".join(item['id'] for item in self.server_options['available_models']))
-        except requests.exceptions.RequestException:
+        except (requests.exceptions.RequestException, ValueError):
             pass
         if 'available_models' in self.server_options:
             self.available_models = OrderedDict((item['id'], item) for item in self.server_options['available_models'])
@@ -137,6 +301,16 @@ class HPIImporter(GenericImporter):
             dest="create_relations", default=self.create_relations,
             help=_("Create relations between the original annotations and the new ones"),
             )
+        self.optionparser.add_option(
+            "-n", "--inflight", action="store", type="int",
+            dest="inflight", default=self.inflight,
+            help=_("Number of simultaneous requests to the webservice"),
+            )
+        self.optionparser.add_option(
+            "-s", "--restart", action="store_false",
+            dest="resume", default=self.resume,
+            help=_("Do not resume an interrupted extraction"),
+            )
 
     def process_file(self, _filename):
         self.convert(self.iterator())
@@ -152,8 +326,8 @@ class HPIImporter(GenericImporter):
 
         # Check server connectivity
         try:
-            requests.get(self.url)
-        except requests.exceptions.RequestException:
+            VCDClient(self.url).get_capabilities()
+        except (requests.exceptions.RequestException, ValueError):
             unmet_requirements.append(_("Cannot connect to VCD server. Check that it is running and accessible."))
 
         # Make sure that we have all appropriate screenshots
@@ -176,7 +350,7 @@ class HPIImporter(GenericImporter):
         self.source_type = self.controller.package.get_element_by_id(self.source_type_id)
         minconf = self.confidence
 
-        self.progress(.1, "Sending request to server")
+        self.progress(.1, _("Sending requests to server"))
         if self.split_types:
             # Dict indexed by entity type name
             new_atypes = {}
@@ -222,82 +396,217 @@ class HPIImporter(GenericImporter):
                 scaled = original
             return scaled
 
-        # Use a requests.session to use a KeepAlive connection to the server
-        session = requests.session()
-        headers = {"Content-Type": "application/json", "Accept": "application/json"}
-        response = session.post(self.url, headers=headers, json={
-            "model": self.model,
-            'media_uri': self.package.uri,
-            'media_filename': self.controller.get_default_media(),
-            'minimum_confidence': minconf,
-            'annotations': [
-                { 'annotationid': a.id,
-                  'begin': a.fragment.begin,
-                  'end': a.fragment.end,
-                  'frames': [
-                      {
-                          'screenshot': base64.encodebytes(get_scaled_image(t)).decode('ascii'),
-                          'timecode': t
-                      } for t in (a.fragment.begin,
-                                  int((a.fragment.begin + a.fragment.end) / 2),
-                                  a.fragment.end)
-                  ]
-                }
-                for a in self.source_type.annotations
-            ]
-        })
-
-        output = response.json()
-        if output.get('status') != 200:
+        def build_request(annotations):
+            return {
+                "model": self.model,
+                'media_uri': self.package.uri,
+                'media_filename': self.controller.get_default_media(),
+                'minimum_confidence': minconf,
+                'annotations': [
+                    { 'annotationid': a.id,
+                      'begin': a.fragment.begin,
+                      'end': a.fragment.end,
+                      'frames': [
+                          {
+                              'screenshot': base64.encodebytes(get_scaled_image(t)).decode('ascii'),
+                              'timecode': t
+                          } for t in (a.fragment.begin,
+                                      int((a.fragment.begin + a.fragment.end) / 2),
+                                      a.fragment.end)
+                      ]
+                    }
+                    for a in annotations
+                ]
+            }
+
+        def concepts_iterator():
+            """Iterate over (annotations, concepts, keys) batches.
+
+            keys are the checkpoint keys of the concepts. The concepts
+            of an interrupted extraction which were not converted yet
+            are returned first.
+            """
+            annotations = list(self.source_type.annotations)
+            done, pending = self.load_checkpoint() if self.resume else (set(), [])
+            if done:
+                logger.warning(_("Resuming extraction: %(count)d / %(total)d annotations already processed") % {
+                    "count": len(done),
+                    "total": len(annotations) })
+                yield ([ a for a in annotations if a.id in done ],
+                       [ concept for key, concept in pending ],
+                       [ key for key, concept in pending ])
+                annotations = [ a for a in annotations if a.id not in done ]
+            else:
+                self.clear_checkpoint()
+            client = VCDClient(self.url, inflight=self.inflight)
+            try:
+                client.get_capabilities()
+            except (requests.exceptions.RequestException, ValueError):
+                logger.debug("Cannot get VCD capabilities", exc_info=True)
+            try:
+                for batch, output in client.process(annotations, build_request):
+                    # FIXME: maybe check consistency with media_filename/media_uri?
+                    concepts = output.get('data', {}).get('concepts', [])
+                    keys = self.save_checkpoint(batch, concepts)
+                    yield batch, concepts, keys
+            finally:
+                client.close()
+
+        total = len(self.source_type.annotations)
+        processed = 0
+        concept_count = 0
+        try:
+            for batch, concepts, keys in concepts_iterator():
+                processed += len(batch)
+                concept_count += len(concepts)
+                # Checkpoint keys of the concepts converted in this batch
+                created = {}
+                try:
+                    for key, item in zip(keys, concepts):
+                        # Should not happen, since we pass the parameter to the server
+                        if item["confidence"] < minconf:
+                            continue
+                        a = self.package.get_element_by_id(item['annotationid'])
+                        if a is None:
+                            continue
+                        if self.detected_position:
+                            begin = item['timecode']
+                        else:
+                            begin = a.fragment.begin
+                        end = a.fragment.end
+                        label = item.get('label')
+                        label_id = helper.title2id(label)
+                        if label and self.split_types:
+                            new_atype = new_atypes.get(label_id)
+                            if new_atype is None:
+                                # Not defined yet. Create a new one.
+                                new_atype = self.ensure_new_type(label_id,
+                                                                 title = _("%s concept" % label),
+                                                                 mimetype = 'application/json')
+                                new_atype.setMetaData(config.data.namespace, "representation",
+                                                      'here/content/parsed/label')
+                                new_atypes[label_id] = new_atype
+                        an = yield {
+                            'type': new_atype,
+                            'begin': begin,
+                            'end': end,
+                            'content': json.dumps(item),
+                            'send': True,
+                        }
+                        if an is None:
+                            continue
+                        created[key] = an.id
+                        if self.create_relations:
+                            r = self.package.createRelation(
+                                ident='_'.join( ('r', a.id, an.id) ),
+                                type=rtype,
+                                author=config.data.get_userid(),
+                                date=self.timestamp,
+                                members=(a, an))
+                            r.title = "Relation between %s and %s" % (a.id, an.id)
+                            self.package.relations.append(r)
+                            self.update_statistics('relation')
+                finally:
+                    # Record the created annotations, so that their
+                    # concepts are not converted again on resume.
+                    self.save_created(created)
+                if not self.progress(.1 + .9 * processed / (total or 1),
+                                     _("Processed %(count)d / %(total)d annotations") % { "count": processed,
+                                                                                           "total": total }):
+                    # The extraction can be resumed later
+                    return
+        except (VCDError, requests.exceptions.RequestException) as e:
             # Not OK result. Display error message.
-            msg = _("Server error: %s") % output.get('message', _("Server transmission error."))
+            msg = _("Server error: %s") % (str(e) or _("Server transmission error."))
             logger.error(msg)
             self.output_message = msg
             return
-        # FIXME: maybe check consistency with media_filename/media_uri?
-        concepts = output.get('data', {}).get('concepts', [])
-        progress = .2
-        step = .8 / (len(concepts) or 1)
-        self.progress(.2, _("Parsing %d results") % len(concepts))
-        logger.warning(_("Parsing %(count)d results (level %(confidence)f)") % { "count": len(concepts),
-                                                                                 "confidence": self.confidence })
-        for item in concepts:
-            # Should not happen, since we pass the parameter to the server
-            if item["confidence"] < minconf:
-                continue
-            a = self.package.get_element_by_id(item['annotationid'])
-            if self.detected_position:
-                begin = item['timecode']
-            else:
-                begin = a.fragment.begin
-            end = a.fragment.end
-            label = item.get('label')
-            label_id = helper.title2id(label)
-            if label and self.split_types:
-                new_atype = new_atypes.get(label_id)
-                if new_atype is None:
-                    # Not defined yet. Create a new one.
-                    new_atype = self.ensure_new_type(label_id,
-                                                     title = _("%s concept" % label),
-                                                     mimetype = 'application/json')
-                    new_atype.setMetaData(config.data.namespace, "representation",
-                                          'here/content/parsed/label')
-                    new_atypes[label_id] = new_atype
-            an = yield {
-                'type': new_atype,
-                'begin': begin,
-                'end': end,
-                'content': json.dumps(item),
-            }
-            if an is not None and self.create_relations:
-                r = self.package.createRelation(
-                    ident='_'.join( ('r', a.id, an.id) ),
-                    type=rtype,
-                    author=config.data.get_userid(),
-                    date=self.timestamp,
-                    members=(a, an))
-                r.title = "Relation between %s and %s" % (a.id, an.id)
-                self.package.relations.append(r)
-                self.update_statistics('relation')
-            self.progress(progress)
-            progress += step
+        logger.warning(_("Parsed %(count)d results (level %(confidence)f)") % { "count": concept_count,
+                                                                                "confidence": self.confidence })
+        self.clear_checkpoint()
+
+    def checkpoint_filename(self):
+        """Return the filename of the checkpoint for the current parameters.
+        """
+        key = json.dumps([ self.url, self.model, self.confidence,
+                           self.package.uri, self.controller.get_default_media(),
+                           self.source_type_id ])
+        return config.data.advenefile( ('hpi', hashlib.sha1(key.encode('utf-8')).hexdigest() + '.jsonl'),
+                                       'settings')
+
+    def load_checkpoint(self):
+        """Load the results of an interrupted extraction.
+
+        It also sets checkpoint_size.
+
+        @return: a tuple (done, pending) where done is a set of processed annotation ids and pending the list of (key, concept) tuples of their concepts that were not converted yet
+        """
+        done = set()
+        concepts = {}
+        created = {}
+        self.checkpoint_size = 0
+        filename = self.checkpoint_filename()
+        if not os.path.exists(filename):
+            return done, []
+        try:
+            with open(filename, encoding='utf-8') as f:
+                for line in f:
+                    record = json.loads(line)
+                    if 'created' in record:
+                        created.update((int(key), aid) for key, aid in record['created'].items())
+                        continue
+                    # Ignore annotations that have been modified since then
+                    valid = set()
+                    for aid, (begin, end) in record['annotations'].items():
+                        a = self.package.get_element_by_id(aid)
+                        if a is not None and a.fragment.begin == begin and a.fragment.end == end:
+                            valid.add(aid)
+                    done.update(valid)
+                    for c in record['concepts']:
+                        if c['annotationid'] in valid:
+                            concepts[self.checkpoint_size] = c
+                        self.checkpoint_size += 1
+        except (OSError, ValueError, KeyError):
+            # Incomplete last line (or invalid file): keep the valid records
+            logger.warning("Cannot read extraction checkpoint %s", filename, exc_info=True)
+        # Skip the concepts whose annotation was created (and is
+        # still in the package)
+        pending = [ (key, c) for key, c in sorted(concepts.items())
+                    if key not in created or self.package.get_element_by_id(created[key]) is None ]
+        return done, pending
+
+    def save_checkpoint(self, annotations, concepts):
+        """Save the results for the given annotations.
+
+        @return: the checkpoint keys of the concepts
+        """
+        start = self.checkpoint_size
+        self.checkpoint_size += len(concepts)
+        self.append_checkpoint({ 'annotations': dict( (a.id, (a.fragment.begin, a.fragment.end))
+                                                      for a in annotations ),
+                                 'concepts': concepts })
+        return list(range(start, self.checkpoint_size))
+
+    def save_created(self, created):
+        """Save the ids of the annotations created from concepts.
+
+        @param created: a dict of concept checkpoint key -> annotation id
+        """
+        if created:
+            self.append_checkpoint({ 'created': created })
+
+    def append_checkpoint(self, record):
+        filename = self.checkpoint_filename()
+        try:
+            os.makedirs(os.path.dirname(filename), exist_ok=True)
+            with open(filename, 'a', encoding='utf-8') as f:
+                f.write(json.dumps(record))
+                f.write("\n")
+        except OSError:
+            logger.warning("Cannot save extraction checkpoint %s", filename, exc_info=True)
+
+    def clear_checkpoint(self):
+        self.checkpoint_size = 0
+        filename = self.checkpoint_filename()
+        if os.path.exists(filename):
+            os.unlink(filename)
@@ -63,17 +63,45 @@ __SUPPORTED_COLORS_RGB__ = {'darkred': (139, 0, 0), 'firebrick': (178, 34, 34),
 class DomCol(object):
     def __init__(self, named_colors):
         self.named_centroids = named_colors
+        self.centroids = np.array([ np.asarray(self.named_centroids[c], dtype=np.float64).reshape(-1)
+                                    for c in self.named_centroids ])
 
     def map_color_name(self, color_rgb):
         dists = dict()
-        for c in self.named_centroids:
-            dists[c] = scipy.spatial.distance.sqeuclidean(self.named_centroids[c], color_rgb)
+        for c, centroid in zip(self.named_centroids, self.centroids):
+            dists[c] = scipy.spatial.distance.sqeuclidean(centroid, np.ravel(color_rgb))
 
         # sort dists ascending - color with smallest dist to query color is the most likely hit
         sorted_dists = sorted(dists.items(), key=lambda kv: kv[1])
 
         return sorted_dists[0][0], sorted_dists[0][1]
 
+    def count_colors(self, pixels):
+        """Return the number of pixels assigned to each centroid.
+
+        @param pixels: a samples x channels array
+        @return: an array of counts, indexed like self.centroids
+        """
+        # assign codes, nns: row index of nearest centroid
+        nns, dist = vq(pixels, self.centroids)
+        return np.bincount(nns, minlength=len(self.centroids))
+
+    def dominant_colors(self, counts):
+        """Return the dominant colors from centroid counts.
+
+        @param counts: an array of pixel counts per centroid (see L{count_colors})
+        @return: an iterator of (centroid, relative size) tuples, sorted by decreasing size
+        """
+        # the assigned centroids and their frequencies
+        idx = np.flatnonzero(counts)
+        cnts = counts[idx]
+        total = counts.sum()
+
+        dom_col_size = [cnts[c] / total for c in np.argsort(cnts)[::-1]]
+        dom_cols = [self.centroids[c] for c in idx[np.argsort(cnts)[::-1]]]
+
+        return zip(dom_cols, dom_col_size)
+
     def cluster_colors(self, pixmaps):
         if len(pixmaps.shape) != 4 or pixmaps.shape[2] != 3:
             raise ValueError(
@@ -81,24 +109,12 @@ class DomCol(object):
                 "Shape: {0}".format(pixmaps.shape)
             )
 
-        # extract a samples x channels array of all pixels in pixmaps:
-        pixels = pixmaps.transpose((2, 0, 1, 3))
-        pixels = pixels.reshape((pixels.shape[0], pixels.shape[1] * pixels.shape[2] * pixels.shape[3])).T
-
-        centroids = np.zeros((len(self.named_centroids), pixels.shape[1]))
-        for i, c in enumerate(self.named_centroids):
-            centroids[i][:] = self.named_centroids[c]
-
-        # assign codes, nns: row index of nearest centroid, dist: distance of pixel to nearest centroid:
-        nns, dist = vq(pixels, centroids)
-
-        # return sorted unique nns, i.e. the unique row indices in centroids and the frequencies
-        idx, cnts = np.unique(nns, return_counts=True)
-
-        dom_col_size = [cnts[c] / pixels.shape[0] for c in np.argsort(cnts)[::-1]]
-        dom_cols = [centroids[c] for c in idx[np.argsort(cnts)[::-1]]]
-
-        return zip(dom_cols, dom_col_size)
+        # count the pixels of each sample, without building a
+        # samples x channels array of all pixels in pixmaps
+        counts = np.zeros(len(self.centroids), dtype=np.int64)
+        for i in range(pixmaps.shape[3]):
+            counts += self.count_colors(pixmaps[:, :, :, i].reshape(-1, 3))
+        return self.dominant_colors(counts)
 
 
 class DomColExtractor(GstImporter):
@@ -136,10 +152,13 @@ class DomColExtractor(GstImporter):
         self.frame_width = 240
         self.offset = 40     # the segment offset - added/subtracted from segment boundaries
         self.stepsize = 500  # every stepsize milliseconds, a frame is considered for color extraction
+        self.pixel_step = 1  # only every pixel_step-th pixel of each row/column is considered
         self.cur_ann_begin = None
         self.cur_ann_end = None
-        self.cur_ann_pixbufs = []
+        # Per-centroid pixel counts for the current annotation
+        self.cur_ann_counts = None
         self.last_considered_ts = None
+        self.source_annotations = []
         self.annotations = []
 
         self.rel_cluster_size = 0.05
@@ -175,6 +194,12 @@ class DomColExtractor(GstImporter):
                 "the given threshold."),
         )
 
+        self.optionparser.add_option(
+            "--pixel-step", action="store", type="int",
+            dest="pixel_step", default=self.pixel_step,
+            help=_("Downsample frames, considering one pixel out of N in each direction."),
+        )
+
         self.optionparser.add_option(
             "--colors", action="store", type=str,
             dest="colors", default=json.dumps(__SUPPORTED_COLORS_RGB__),
@@ -206,6 +231,9 @@ class DomColExtractor(GstImporter):
         if self.cluster_compactness <= 0 or self.cluster_compactness >= 1.0:
             unmet_requirements.append(_("Cluster compactness must be > 0.0 and < 1.0."))
 
+        if self.pixel_step < 1:
+            unmet_requirements.append(_("Pixel step must be >= 1."))
+
         colors = dict()
         try:
             colors = json.loads(self.colors)
@@ -240,15 +268,20 @@ class DomColExtractor(GstImporter):
         return unmet_requirements
 
     def do_finalize(self):
-        if len(self.cur_ann_pixbufs):
-            cnames = self.extract_dominant_colors(self.cur_ann_pixbufs)
+        self.flush_annotation()
+        self.convert(f for f in self.annotations)
+
+    def flush_annotation(self):
+        """Generate the annotation data for the current annotation.
+        """
+        if self.cur_ann_counts is not None:
+            cnames = self.names_from_colors(self.dc.dominant_colors(self.cur_ann_counts))
             self.annotations.append({
                 'begin': self.cur_ann_begin,
                 'end': self.cur_ann_end,
                 'content': cnames['representation']
             })
-
-        self.convert(f for f in self.annotations)
+            self.cur_ann_counts = None
 
     def extract_dominant_colors(self, frame_list):
         if type(frame_list) is list:
@@ -261,8 +294,13 @@ class DomColExtractor(GstImporter):
         if len(pixmaps.shape) != 4 or pixmaps.shape[2] != 3:
             raise ValueError("Invalid frame list!")
 
-        dom_cols = self.dc.cluster_colors(pixmaps=pixmaps)
+        return self.names_from_colors(self.dc.cluster_colors(pixmaps=pixmaps))
 
+    def names_from_colors(self, dom_cols):
+        """Return the color names data for the given dominant colors.
+
+        @param dom_cols: an iterator of (centroid, relative size) tuples
+        """
         cnames = list()
         for col in dom_cols:
             logger.debug("{0} ({1})".format(self.dc.map_color_name(col[0])[0], col[1]))
@@ -285,18 +323,11 @@ class DomColExtractor(GstImporter):
     def process_frame(self, frame):
         cur_ts = int(frame['date'])
 
-        for i, anno in enumerate(self.source_type.annotations):
+        for anno in self.source_annotations:
             if anno.fragment.begin + self.offset <= cur_ts <= anno.fragment.end - self.offset:
                 if self.cur_ann_begin != anno.fragment.begin or self.cur_ann_end != anno.fragment.end:
-                    if len(self.cur_ann_pixbufs):
-                        # we have a new annotation - need to extract dominant colors from previous one
-                        cnames = self.extract_dominant_colors(self.cur_ann_pixbufs)
-                        self.annotations.append({
-                            'begin': self.cur_ann_begin,
-                            'end': self.cur_ann_end,
-                            'content': cnames['representation']
-                        })
-                        self.cur_ann_pixbufs = list()
+                    # we have a new annotation - need to extract dominant colors from previous one
+                    self.flush_annotation()
 
                     self.cur_ann_begin = anno.fragment.begin
                     self.cur_ann_end = anno.fragment.end
@@ -318,12 +349,20 @@ class DomColExtractor(GstImporter):
                     else:
                         raise ValueError("unknown colorspace!")
 
-                    self.cur_ann_pixbufs.append(cur_pixbuf)
+                    # Only keep the pixel counts per color, so that memory usage
+                    # does not depend on the annotation duration
+                    pixels = cur_pixbuf[::self.pixel_step, ::self.pixel_step].reshape(-1, channels)
+                    counts = self.dc.count_colors(pixels)
+                    if self.cur_ann_counts is None:
+                        self.cur_ann_counts = counts
+                    else:
+                        self.cur_ann_counts += counts
                     self.last_considered_ts = cur_ts
         return True
 
     def setup_importer(self, filename):
         self.source_type = self.controller.package.get_element_by_id(self.source_type_id)
+        self.source_annotations = list(self.source_type.annotations)
         at = self.ensure_new_type('domcols',
                              title=_("Dominant Color Extractor"),
                              mimetype='application/x-advene-structured',
@@ -28,6 +28,12 @@ from gi.repository import Gst
 
 from advene.util.gstimporter import GstImporter
 
+try:
+    import advene.util.audioanalysis as audioanalysis
+    import advene.util.waveform as waveform
+except ImportError:
+    audioanalysis = None
+
 from math import isinf, isnan
 
 def register(controller=None):
@@ -50,6 +56,8 @@ class SoundEnveloppeImporter(GstImporter):
 
         # Lower bound for db values, to avoid a too large value range
         self.lower_db_limit = -80
+        # Cache the waveform peak pyramid, built along with the enveloppe
+        self.waveform = True
 
         ## Corresponding optionparser object definition
         self.optionparser.add_option("-i", "--interval",
@@ -62,11 +70,17 @@ class SoundEnveloppeImporter(GstImporter):
                                      action="store", type="choice", dest="channel", choices=("both", "left", "right"), default=self.channel,
                                      help=_("Channel selection."))
         self.optionparser.add_option("-v", "--value",
-                                     action="store", type="choice", dest="value", choices=("rms", "peak"), default=self.value,
-                                     help=_("Value to consider (peak or RMS)."))
+                                     action="store", type="choice", dest="value",
+                                     choices=("rms", "peak", "centroid") if audioanalysis else ("rms", "peak"),
+                                     default=self.value,
+                                     help=_("Value to consider (peak or RMS level, or spectral centroid)."))
         self.optionparser.add_option("-l", "--lower-db-limit",
                                      action="store", type="int", dest="lower_db_limit", default=self.lower_db_limit,
                                      help=_("Lower dB limit"))
+        if audioanalysis is not None:
+            self.optionparser.add_option("-w", "--no-waveform",
+                                         action="store_false", dest="waveform", default=self.waveform,
+                                         help=_("Do not cache the waveform peak pyramid of the media."))
 
         ## Internal data structures
         self.buffer = []
@@ -76,6 +90,9 @@ class SoundEnveloppeImporter(GstImporter):
         self.first_item_time = 0
         # initial value (in dB).
         self.lastval = self.lower_db_limit
+        # NumPy analysis engine, if available
+        self.analyzer = None
+        self.media_filename = None
 
     def generate_normalized_annotations(self):
         n = 1.0 * len(self.buffer_list)
@@ -94,7 +111,53 @@ class SoundEnveloppeImporter(GstImporter):
                 'content': " ".join("%.02f" % (factor * (f - m)) for f in tup[2]),
             } ])
 
+    def generate_annotations_from_analyzer(self):
+        """Generate annotations from the values computed by the analyzer.
+        """
+        self.analyzer.flush()
+        values = self.analyzer.values(self.value)
+        if self.value != 'centroid':
+            # Silence (-inf) is clipped to the lower limit, other
+            # invalid values are replaced by the previous value.
+            values = audioanalysis.fill_invalid(values.clip(min=self.lower_db_limit), self.lower_db_limit)
+        values = audioanalysis.normalize(values)
+        n = len(values)
+        self.progress(0, _("Generating annotations"))
+        def annotations():
+            for i in range(0, n, self.count):
+                self.progress(i / n)
+                chunk = values[i:i + self.count]
+                yield {
+                    'begin': self.analyzer.time(i),
+                    'end': self.analyzer.time(i + len(chunk)),
+                    'content': " ".join(map("{:.02f}".format, chunk.tolist())),
+                }
+        self.convert(annotations())
+
+    def process_frame(self, frame):
+        if self.analyzer is not None:
+            self.analyzer.feed(frame['data'], frame['pts'])
+        return True
+
+    def save_waveform(self):
+        """Save the waveform peak pyramid in the cache.
+        """
+        filename = waveform.cache_filename(self.media_filename)
+        if filename is None:
+            return
+        try:
+            self.analyzer.peaks.finish().save(filename)
+        except OSError:
+            logger.warning("Cannot save waveform data for %s", self.media_filename, exc_info=True)
+
     def do_finalize(self):
+        if self.analyzer is not None:
+            self.generate_annotations_from_analyzer()
+            if self.analyzer.peaks is not None and self.reached_end:
+                # Do not cache the waveform of an interrupted import,
+                # which only covers the beginning of the media.
+                self.save_waveform()
+            return True
         # Add last buffer data
         if self.buffer:
             # There is some data left.
@@ -137,4 +200,17 @@ class SoundEnveloppeImporter(GstImporter):
                              mimetype = 'application/x-advene-values',
                              description = _("Sound enveloppe"))
 
+        if audioanalysis is not None:
+            self.media_filename = filename
+            peaks = None
+            if self.waveform and waveform.media_key(filename) is not None:
+                peaks = waveform.PeakPyramidBuilder(22050)
+            self.analyzer = audioanalysis.AudioAnalyzer(sample_rate=22050,
+                                                        interval=self.interval,
+                                                        channel=self.channel,
+                                                        features=(self.value, ),
+                                                        peaks=peaks)
+            return self.analyzer.pipeline(self.analyzer.sample_rate, self.analyzer.channels)
+
+        # Fallback: use level element messages
         return "audioconvert ! level name=level interval=%s" % str(self.interval * Gst.MSECOND)
@@ -23,7 +23,16 @@ logger = logging.getLogger(__name__)
 
 from gettext import gettext as _
 
+import array
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+import importlib
 import json
+import math
+import multiprocessing
+import operator
+import sys
+
+from gi.repository import GObject
 
 try:
     from vosk import Model, KaldiRecognizer
@@ -39,6 +48,70 @@ def register(controller=None):
         logger.warning("Cannot import VOSK module - speech recognition disabled")
     return True
 
+# Size (in bytes) of the data chunks fed to the recognizer in worker processes
+CHUNK_SIZE = 8000
+
+# Model of the current worker process, initialized by init_worker
+_model = None
+
+def init_worker(model_name):
+    """Load the model in a worker process.
+    """
+    global _model
+    _model = Model(model_name=model_name)
+
+def parse_result(result_json, offset=0, words=True):
+    """Convert a recognizer result.
+
+    @param result_json: the JSON result from the recognizer
+    @param offset: the offset (in s) to add to timestamps
+    @param words: generate word items
+    @return: a list of (begin, end, type, text, confidence) tuples, with times in s
+    """
+    res = json.loads(result_json)
+    items = []
+    if res.get('result'):
+        items.append( (res['result'][0]['start'] + offset,
+                       res['result'][-1]['end'] + offset,
+                       'sentence',
+                       res['text'],
+                       sum(r['conf'] for r in res['result']) / len(res['result'])) )
+        if words:
+            for r in res.get('result'):
+                items.append( (r['start'] + offset, r['end'] + offset, 'word', r['word'], r['conf']) )
+    return items
+
+def recognize_segment(offset, data, sample_rate, words=True):
+    """Recognize speech in an audio segment.
+
+    This is executed in worker processes.
+
+    @param offset: the segment position (in s)
+    @param data: the audio data (S16LE mono samples)
+    @return: a list of items (see L{parse_result})
+    """
+    recognizer = KaldiRecognizer(_model, sample_rate)
+    recognizer.SetWords(True)
+    items = []
+    for i in range(0, len(data), CHUNK_SIZE):
+        if recognizer.AcceptWaveform(data[i:i + CHUNK_SIZE]):
+            items.extend(parse_result(recognizer.Result(), offset, words))
+    items.extend(parse_result(recognizer.FinalResult(), offset, words))
+    return items
+
+def level(data):
+    """Return the RMS level (in dB) of S16LE samples.
+    """
+    samples = array.array('h', data)
+    if sys.byteorder == 'big':
+        samples.byteswap()
+    if not samples:
+        return -math.inf
+    rms = math.sqrt(sum(map(operator.mul, samples, samples)) / len(samples))
+    if rms == 0:
+        return -math.inf
+    return 20 * math.log10(rms / 32768)
+
 class VoskImporter(GstImporter):
     name = _("VOSK speech recognition")
 
@@ -49,6 +122,10 @@ class VoskImporter(GstImporter):
         self.sample_rate = 16000
         self.model_name = "vosk-model-small-en-gb-0.15"
         self.recognize_words = True
+        self.workers = 1
+        self.threshold = -35
+        self.min_silence_duration = 300
+        self.segment_duration = 30
 
         ## Corresponding optionparser object definition
         self.optionparser.add_option("-m", "--model",
@@ -73,36 +150,118 @@ class VoskImporter(GstImporter):
         self.optionparser.add_option("-w", "--words",
                                      action="store_true", dest="recognize_words", default=self.recognize_words,
                                      help=_("Add timing for single words"))
+        self.optionparser.add_option("-j", "--workers",
+                                     action="store", type="int", dest="workers", default=self.workers,
+                                     help=_("Number of worker processes. If greater than 1, the audio is split at silences and segments are recognized in parallel."))
+        self.optionparser.add_option("-t", "--threshold",
+                                     action="store", type="int", dest="threshold", default=self.threshold,
+                                     help=_("Volume threshold (in dB) for silence detection, in parallel mode."))
+        self.optionparser.add_option("-s", "--silence-duration",
+                                     action="store", type="int", dest="min_silence_duration", default=self.min_silence_duration,
+                                     help=_("Length (in ms) of drop below threshold before silence is detected, in parallel mode."))
+        self.optionparser.add_option("-d", "--segment-duration",
+                                     action="store", type="int", dest="segment_duration", default=self.segment_duration,
+                                     help=_("Minimum duration (in s) of audio segments, in parallel mode. Segments are cut at the first silence after this duration, or at 3 times this duration."))
 
         ## Internal data structures
         self.buffer = []
         self.last_above = None
 
-    def add_result(self, result_json):
-        res = json.loads(result_json)
-        if res.get('result'):
-            self.buffer.append( (res['result'][0]['start'],
-                                 res['result'][-1]['end'],
-                                 'sentence',
-                                 res['text'],
-                                 sum(r['conf'] for r in res['result']) / len(res['result'])) )
-            if self.recognize_words:
-                for r in res.get('result'):
-                    self.buffer.append( (r['start'], r['end'], 'word', r['word'], r['conf']) )
+        # Parallel mode
+        self.executor = None
+        # Buffers of the current segment
+        self.segment = []
+        self.segment_size = 0
+        # Position (in samples) of the current segment
+        self.segment_offset = 0
+        # Duration (in s) of the current silence
+        self.silence = 0
+        self.futures = []
+        self.converted_segments = 0
+        self.finalizing = False
 
+    def add_result(self, result_json):
+        self.buffer.extend(parse_result(result_json, words=self.recognize_words))
 
-    def do_finalize(self):
-        self.add_result(self.recognizer.FinalResult())
+    def convert_items(self, items):
         self.convert( { 'begin': begin * 1000,
                         'end': end * 1000,
                         'type': type_,
                         'content': word }
-                      for begin, end, type_, word, conf in self.buffer )
+                      for begin, end, type_, word, conf in items )
+
+    def do_finalize(self):
+        if self.executor is None:
+            self.add_result(self.recognizer.FinalResult())
+            self.convert_items(self.buffer)
+            return True
+        self.submit_segment(block=False)
+        self.finalizing = True
+        if self.converted_segments < len(self.futures):
+            # end_callback will be called by convert_segment
+            return False
+        self.executor.shutdown(wait=False)
+        return True
+
+    def submit_segment(self, block=True):
+        """Send the current audio segment to a worker process.
+
+        @param block: wait for a worker to be available if too many segments are pending
+        """
+        if not self.segment_size:
+            return
+        data = b"".join(self.segment)
+        offset = self.segment_offset / self.sample_rate
+        self.segment_offset += self.segment_size // 2
+        self.segment = []
+        self.segment_size = 0
+        self.silence = 0
+        # Plugins are loaded under a private module name, which cannot
+        # be imported by worker processes: use the advene.plugins one.
+        worker = importlib.import_module('advene.plugins.vosk').recognize_segment
+        future = self.executor.submit(worker, offset, data, self.sample_rate, self.recognize_words)
+        future.add_done_callback(self.segment_done)
+        self.futures.append(future)
+        # Do not let decoded audio pile up while workers are busy
+        pending = [ f for f in self.futures if not f.done() ]
+        while block and len(pending) >= 2 * self.workers:
+            wait(pending, return_when=FIRST_COMPLETED)
+            pending = [ f for f in pending if not f.done() ]
+
+    def segment_done(self, future):
+        """Handle the result of a segment (from a worker thread).
+        """
+        try:
+            items = future.result()
+        except Exception:
+            logger.error("Error in speech recognition", exc_info=True)
+            items = []
+        # Make sure that conversion happens in the main thread
+        GObject.idle_add(self.convert_segment, items)
+
+    def convert_segment(self, items):
+        self.convert_items(items)
+        self.converted_segments += 1
+        if self.finalizing and self.converted_segments == len(self.futures):
+            self.executor.shutdown(wait=False)
+            self.end_callback()
+        return False
 
     def process_frame(self, frame):
         data = frame['data']
         if len(data) == 0:
             logger.debug("0 length data")
+        elif self.executor is not None:
+            self.segment.append(data)
+            self.segment_size += len(data)
+            if level(data) < self.threshold:
+                self.silence += len(data) / 2 / self.sample_rate
+            else:
+                self.silence = 0
+            duration = self.segment_size / 2 / self.sample_rate
+            if ( (duration >= self.segment_duration and self.silence * 1000 >= self.min_silence_duration)
+                 or duration >= 3 * self.segment_duration ):
+                self.submit_segment()
         elif self.recognizer.AcceptWaveform(data):
             self.add_result(self.recognizer.Result())
         else:
@@ -119,8 +278,17 @@ class VoskImporter(GstImporter):
                              title=_("Sentence"),
                              description=_("Recognized sentence"))
 
+        # This also makes sure that the model is downloaded before
+        # starting worker processes.
         model = Model(model_name=self.model_name)
-        self.recognizer = KaldiRecognizer(model, self.sample_rate)
-        self.recognizer.SetWords(True)
+        if self.workers > 1:
+            # Use the spawn method, since fork is unsafe when the GUI is running
+            self.executor = ProcessPoolExecutor(max_workers=self.workers,
+                                                mp_context=multiprocessing.get_context('spawn'),
+                                                initializer=importlib.import_module('advene.plugins.vosk').init_worker,
+                                                initargs=(self.model_name, ))
+        else:
+            self.recognizer = KaldiRecognizer(model, self.sample_rate)
+            self.recognizer.SetWords(True)
 
         return f"audioconvert ! audiorate ! audioresample ! audio/x-raw,format=S16LE,rate={self.sample_rate},channels=1"
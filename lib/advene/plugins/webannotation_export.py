@@ -19,6 +19,11 @@
 """WebAnnotation JSON-LD export filter.
 
 This filter exports data as WebAnnotation in JSON-LD format.
+
+With the C{lines} option, data is output as JSON-LD lines: each
+collection and annotation is output on its own line as soon as it is
+converted, so that large packages can be exported with bounded
+memory usage.
 """
 
 name="WebAnnotation JSON-LD exporter"
@@ -29,7 +34,8 @@ logger = logging.getLogger(__name__)
 from gettext import gettext as _
 
 import advene.core.config as config
-from advene.util.exporter import FlatJsonExporter
+from advene.model.schema import AnnotationType
+from advene.util.exporter import FlatJsonExporter, CustomJSONEncoder
 
 def register(controller=None):
     controller.register_exporter(WebAnnotationExporter)
@@ -48,17 +54,34 @@ class WebAnnotationExporter(FlatJsonExporter):
         self.optionparser.add_option("-s", "--split",
                                      action="store_true", dest="split", default=self.split,
                                      help=_("Split types in different AnnotationCollections"))
+        self._type_data = {}
+        self.lines_format = False
+        self.optionparser.add_option("-l", "--lines",
+                                     action="store_true", dest="lines_format", default=self.lines_format,
+                                     help=_("Output JSON-LD lines (one record per line), with bounded memory usage"))
 
     def annotation_uri(self, a, media_uri):
         return a.uri
 
+    def type_data(self, at):
+        """Return the title and color of the annotation type.
+
+        They are cached for the duration of the export.
+        """
+        data = self._type_data.get(at)
+        if data is None:
+            data = self._type_data[at] = (self.controller.get_title(at),
+                                          self.controller.get_element_color(at))
+        return data
+
     def annotation_jsonld(self, a, media_uri):
+        type_title, type_color = self.type_data(a.type)
         return {
             "@id": self.annotation_uri(a, media_uri),
             "@type": "Annotation",
             "advene:type": a.type.id,
-            "advene:type_title": self.controller.get_title(a.type),
-            "advene:type_color": self.controller.get_element_color(a.type),
+            "advene:type_title": type_title,
+            "advene:type_color": type_color,
             "advene:color": self.controller.get_element_color(a),
             "created": a.date,
             "creator": {
@@ -84,20 +107,54 @@ class WebAnnotationExporter(FlatJsonExporter):
             }
         }
 
-    def single_data(self, media_uri):
+    def json_context(self):
+        """Return the JSON-LD context of the export.
+
+        It is computed once per export, and shared by the exported
+        records.
+        """
+        return [ "http://www.w3.org/ns/anno.jsonld",
+                 "http://www.w3.org/ns/ldp.jsonld",
+                 {
+                     "advene": "http://www.advene.org/ns/webannotation/",
+                     # Ideally, we should use a random URI
+                     # here (because without more
+                     # information, we cannot know the actual
+                     # URI of this local symbol) but it would
+                     # render the export unstable.
+                     "local": "http://www.advene.org/ns/_local/"
+                 }
+        ]
+
+    def collection_jsonld(self, element):
+        """Return the AnnotationCollection node for a package or an annotation type.
+
+        It does not include the collection items.
+        """
+        if isinstance(element, AnnotationType):
+            return {
+                "id": element.uri,
+                "type": "AnnotationCollection",
+                "label": self.controller.get_title(element),
+                "advene:type": element.id,
+                "advene:type_color": self.controller.get_element_color(element),
+                "created": element.date,
+                "creator": {
+                    "@id": "local:user/%s" % element.author,
+                    "@type": "Person",
+                    "nick": element.author
+                },
+            }
+        else:
+            return {
+                "id": element.uri,
+                "type": "AnnotationCollection",
+                "label": self.controller.get_title(element),
+            }
+
+    def single_data(self, media_uri, context):
         data = {
-            "@context": [ "http://www.w3.org/ns/anno.jsonld",
-                          "http://www.w3.org/ns/ldp.jsonld",
-                          {
-                              "advene": "http://www.advene.org/ns/webannotation/",
-                              # Ideally, we should use a random URI
-                              # here (because without more
-                              # information, we cannot know the actual
-                              # URI of this local symbol) but it would
-                              # render the export unstable.
-                              "local": "http://www.advene.org/ns/_local/"
-                          }
-            ],
+            "@context": context,
             "id": self.source.uri,
             "type": "AnnotationCollection",
             "label": self.controller.get_title(self.source),
@@ -112,20 +169,10 @@ class WebAnnotationExporter(FlatJsonExporter):
         data["totalItems"] = len(data['first']['items'])
         return data
 
-    def split_data(self, media_uri):
+    def split_data(self, media_uri, context):
         def get_collection(at):
-            col = {
-                "id": at.uri,
-                "type": "AnnotationCollection",
-                "label": self.controller.get_title(at),
-                "advene:type": at.id,
-                "advene:type_color": self.controller.get_element_color(at),
-                "created": at.date,
-                "creator": {
-                    "@id": "local:user/%s" % at.author,
-                    "@type": "Person",
-                    "nick": at.author
-                },
+            col = self.collection_jsonld(at)
+            col.update({
                 "first": {
                     "id": "/".join((at.uri, "page1")),
                     "type": "AnnotationPage",
@@ -134,23 +181,12 @@ class WebAnnotationExporter(FlatJsonExporter):
                                for json in ( self.annotation_jsonld(a, media_uri) for a in at.annotations )
                                if json is not None ]
                 },
-            }
+            })
             col["totalItems"] = len(col['first']['items'])
             return col
 
         data = {
-            "@context": [ "http://www.w3.org/ns/anno.jsonld",
-                          "http://www.w3.org/ns/ldp.jsonld",
-                          {
-                              "advene": "http://www.advene.org/ns/webannotation/",
-                              # Ideally, we should use a random URI
-                              # here (because without more
-                              # information, we cannot know the actual
-                              # URI of this local symbol) but it would
-                              # render the export unstable.
-                              "local": "http://www.advene.org/ns/_local/"
-                          }
-            ],
+            "@context": context,
             "id": self.source.uri,
             "type": "ldp:Container",
             "label": self.controller.get_title(self.source),
@@ -158,14 +194,62 @@ class WebAnnotationExporter(FlatJsonExporter):
             }
         return data
 
+    def lines(self, media_uri, context):
+        """Generate the JSON-LD lines records.
+
+        Each collection is output as a record (without its items),
+        followed by the records of its annotations, which reference
+        it through the C{advene:collection} property. The context is
+        serialized only once, and inserted in each record.
+        """
+        encoder = CustomJSONEncoder(skipkeys=True, ensure_ascii=False)
+        prefix = '{"@context": %s, ' % encoder.encode(context)
+
+        def record(data):
+            return prefix + encoder.encode(data)[1:]
+
+        if self.split:
+            collections = ( (at, at.annotations) for at in self.source.annotationTypes )
+        else:
+            collections = [ (self.source, self.source.annotations) ]
+        for element, annotations in collections:
+            yield record(self.collection_jsonld(element))
+            for a in annotations:
+                data = self.annotation_jsonld(a, media_uri)
+                if data is not None:
+                    data["advene:collection"] = element.uri
+                    yield record(data)
+
+    def serialize(self, data, textstream):
+        if not self.lines_format:
+            return super().serialize(data, textstream)
+        for count, line in enumerate(data):
+            textstream.write(line)
+            textstream.write("\n")
+            if self.callback is not None and count % 1000 == 0:
+                self.callback(None, _("%d elements exported") % count)
+
+    def get_filename(self, basename=None, source=None):
+        name = super().get_filename(basename, source)
+        if self.lines_format and name.endswith('.jsonld'):
+            # Use the JSON lines extension
+            name = name[:-len('.jsonld')] + '.jsonl'
+        return name
+
     def export(self, filename=None):
         # Works if source is a package or a type
         package = self.source.ownerPackage
         media_uri = package.getMetaData(config.data.namespace, "media_uri") or self.controller.get_default_media()
-
-        if self.split:
-            data = self.split_data(media_uri)
+        context = self.json_context()
+        self._type_data = {}
+
+        if self.lines_format:
+            # Records are generated while they are written, so that
+            # the whole document is never built.
+            data = self.lines(media_uri, context)
+        elif self.split:
+            data = self.split_data(media_uri, context)
         else:
-            data = self.single_data(media_uri)
+            data = self.single_data(media_uri, context)
 
         return self.output(data, filename)
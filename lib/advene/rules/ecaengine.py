@@ -88,6 +88,9 @@ class ECAEngine:
         self.scheduler=sched.scheduler(time.time, time.sleep)
         self.schedulerthread=MyThread(target=self.scheduler.run)
         self.views_to_notify=[]
+        # Callables invoked with (event_name, parameters) on every
+        # notification, before rules processing.
+        self.listeners=[]
 
     def get_state(self):
         """Return a state of the current rulesets.
@@ -268,6 +271,22 @@ class ECAEngine:
     def unregister_view(self, view):
         self.views_to_notify.remove(view)
 
+    def register_listener(self, listener):
+        """Register a listener for all events.
+
+        The listener is a callable with the signature
+        listener(event_name, parameters). It is called for every
+        notified event, in the notifying thread, so it should return
+        quickly.
+        """
+        self.listeners.append(listener)
+
+    def unregister_listener(self, listener):
+        try:
+            self.listeners.remove(listener)
+        except ValueError:
+            logger.warning("Trying to remove non-existant listener %s", listener)
+
 
     def internal_rule(self, event=None, condition=None, method=None):
         """Declare an internal rule used by the application.
@@ -363,6 +382,12 @@ class ECAEngine:
             del kw['delay']
             logger.debug("Delay specified: %f", delay)
 
+        for listener in self.listeners:
+            try:
+                listener(event_name, kw)
+            except Exception:
+                logger.error("Exception in event listener %s", listener, exc_info=True)
+
         context=self.build_context(event_name, **kw)
         try:
             a=self.ruledict[event_name]
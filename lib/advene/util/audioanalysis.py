@@ -0,0 +1,200 @@
+#
+# Advene: Annotate Digital Videos, Exchange on the NEt
+# Copyright (C) 2025 Olivier Aubert <contact@olivieraubert.net>
+#
+# Advene is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# Advene is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Advene; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+#
+"""Audio analysis engine.
+
+Compute audio features (RMS and peak levels, spectral centroid) over
+fixed-length intervals of raw PCM data, as NumPy arrays.
+
+It is meant to be used from a L{advene.util.gstimporter.GstImporter}
+whose pipeline ends with the caps returned by L{AudioAnalyzer.pipeline}:
+the raw data blocks received by C{process_frame} are passed to
+L{AudioAnalyzer.feed}, and all the intervals contained in a block are
+processed at once, instead of generating a bus message per interval.
+
+It requires numpy.
+"""
+
+import logging
+logger = logging.getLogger(__name__)
+
+import numpy
+
+FEATURES = ('rms', 'peak', 'centroid')
+
+class AudioAnalyzer:
+    """Compute audio features over fixed-length intervals.
+
+    Levels are expressed in dB, like the GStreamer level element. For
+    multi-channel data, the level values of the selected channels are
+    averaged. The spectral centroid (in Hz) is computed on the mean of
+    the selected channels.
+
+    @ivar sample_rate: the sample rate (in Hz)
+    @ivar channels: the number of interleaved channels
+    @ivar interval: the interval duration (in ms)
+    @ivar interval_samples: the number of samples of an interval
+    @ivar channel: the channel selection (both, left or right)
+    @ivar features: the computed features
+    @ivar start: the timestamp (in ms) of the first sample
+    @ivar peaks: if not None, a L{advene.util.waveform.PeakPyramidBuilder} fed with the mono mix of the samples
+    """
+    def __init__(self, sample_rate=22050, channels=2, interval=100, channel='both', features=('rms', 'peak'), peaks=None):
+        self.sample_rate = sample_rate
+        self.channels = channels
+        self.interval = interval
+        self.interval_samples = max(1, int(round(sample_rate * interval / 1000)))
+        self.channel = channel
+        for f in features:
+            if f not in FEATURES:
+                raise ValueError("Unknown audio feature %s" % f)
+        self.features = tuple(features)
+        self.start = None
+        # Samples of the incomplete last interval
+        self._pending = numpy.zeros((0, channels), dtype=numpy.float32)
+        self._values = dict( (f, []) for f in self.features )
+        self._freqs = None
+        self.peaks = peaks
+
+    @staticmethod
+    def pipeline(sample_rate=22050, channels=2):
+        """Return the pipeline elements converting audio to the expected format.
+        """
+        return ("audioconvert ! audioresample ! audio/x-raw,format=F32LE,layout=interleaved,rate=%d,channels=%d"
+                % (sample_rate, channels))
+
+    @property
+    def count(self):
+        """Number of processed intervals.
+        """
+        return sum(len(v) for v in self._values[self.features[0]])
+
+    def select(self, blocks):
+        """Return the selected channels of blocks.
+        """
+        if self.channels > 1:
+            if self.channel == 'left':
+                return blocks[:, :, :1]
+            elif self.channel == 'right':
+                return blocks[:, :, 1:2]
+        return blocks
+
+    def process_blocks(self, blocks):
+        """Compute the features of an array of intervals.
+
+        @param blocks: a (intervals, interval_samples, channels) array
+        """
+        blocks = self.select(blocks)
+        with numpy.errstate(divide='ignore', invalid='ignore'):
+            if 'rms' in self._values:
+                power = numpy.mean(numpy.square(blocks, dtype=numpy.float64), axis=1)
+                self._values['rms'].append(numpy.mean(10 * numpy.log10(power), axis=1).astype(numpy.float32))
+            if 'peak' in self._values:
+                peak = numpy.max(numpy.abs(blocks), axis=1).astype(numpy.float64)
+                self._values['peak'].append(numpy.mean(20 * numpy.log10(peak), axis=1).astype(numpy.float32))
+            if 'centroid' in self._values:
+                if self._freqs is None or len(self._freqs) != blocks.shape[1] // 2 + 1:
+                    self._freqs = numpy.fft.rfftfreq(blocks.shape[1], 1.0 / self.sample_rate)
+                spectrum = numpy.abs(numpy.fft.rfft(numpy.mean(blocks, axis=2), axis=1))
+                centroid = (spectrum @ self._freqs) / numpy.sum(spectrum, axis=1)
+                self._values['centroid'].append(numpy.nan_to_num(centroid).astype(numpy.float32))
+
+    def feed(self, data, timestamp=None):
+        """Process a block of raw data.
+
+        @param data: F32LE interleaved samples
+        @param timestamp: the timestamp (in ms) of the block. Only the first one is used, further positions are computed from the number of samples.
+        """
+        if self.start is None:
+            self.start = timestamp or 0
+        samples = numpy.frombuffer(data, dtype=numpy.float32)
+        samples = samples[:len(samples) - len(samples) % self.channels].reshape(-1, self.channels)
+        if self.peaks is not None:
+            self.peaks.feed(samples.mean(axis=1), timestamp)
+        if len(self._pending):
+            samples = numpy.concatenate((self._pending, samples))
+        n = len(samples) // self.interval_samples
+        if n:
+            self.process_blocks(samples[:n * self.interval_samples].reshape(n, self.interval_samples, self.channels))
+        # Copy, so that the data buffer can be released
+        self._pending = samples[n * self.interval_samples:].copy()
+
+    def flush(self):
+        """Process the last incomplete interval.
+        """
+        if len(self._pending):
+            self.process_blocks(self._pending.reshape(1, len(self._pending), self.channels))
+            self._pending = self._pending[:0]
+
+    def values(self, feature):
+        """Return the values of a feature, as a numpy array.
+        """
+        v = self._values[feature]
+        if len(v) > 1:
+            # Consolidate the arrays
+            v[:] = [ numpy.concatenate(v) ]
+        return v[0] if v else numpy.zeros(0, dtype=numpy.float32)
+
+    def time(self, index):
+        """Return the timestamp (in ms) of the interval with the given index.
+        """
+        return (self.start or 0) + index * self.interval_samples * 1000 / self.sample_rate
+
+def fill_invalid(values, initial):
+    """Replace infinite or NaN values with the previous valid value.
+
+    @param initial: the value used for leading invalid values
+    """
+    values = numpy.asarray(values, dtype=numpy.float64)
+    valid = numpy.isfinite(values)
+    if valid.all():
+        return values
+    # Index of the last valid value for each position (0 is the initial value)
+    index = numpy.maximum.accumulate(numpy.where(valid, numpy.arange(1, len(values) + 1), 0))
+    return numpy.concatenate(([ initial ], values))[index]
+
+def normalize(values, scale=100.0):
+    """Normalize values between 0 and scale.
+
+    Constant values are normalized to 0.
+    """
+    values = numpy.asarray(values, dtype=numpy.float64)
+    if not len(values):
+        return values
+    m = values.min()
+    span = values.max() - m
+    if span == 0:
+        return numpy.zeros_like(values)
+    return (values - m) * (scale / span)
+
+def segments(mask, min_gap=0):
+    """Return the segments where mask is True.
+
+    @param mask: a boolean array
+    @param min_gap: gaps shorter than this number of items are merged
+    @return: a list of (begin, end) index tuples (end excluded)
+    """
+    mask = numpy.asarray(mask, dtype=bool)
+    edges = numpy.flatnonzero(numpy.diff(numpy.concatenate(([ False ], mask, [ False ])).astype(numpy.int8)))
+    begins, ends = edges[0::2], edges[1::2]
+    if min_gap > 0 and len(begins) > 1:
+        # Keep the segment boundaries around gaps that are long enough
+        keep = (begins[1:] - ends[:-1]) >= min_gap
+        begins = numpy.concatenate((begins[:1], begins[1:][keep]))
+        ends = numpy.concatenate((ends[:-1][keep], ends[-1:]))
+    return list(zip(begins.tolist(), ends.tolist()))
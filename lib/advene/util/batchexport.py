@@ -0,0 +1,312 @@
+#
+# Advene: Annotate Digital Videos, Exchange on the NEt
+# Copyright (C) 2025 Olivier Aubert <contact@olivieraubert.net>
+#
+# Advene is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# Advene is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Advene; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+#
+"""Batch export.
+
+Export a set of packages with a set of exporters. Each package is a
+job, which runs all the exporters on it, so that a package is loaded
+only once. Jobs are run in worker processes. Each worker initializes
+a controller (and its plugins) once, and reuses it for all the jobs
+it runs.
+
+The output files are laid out as::
+
+  OUTPUT_DIR/EXPORTER_ID/PACKAGE_ALIAS.EXTENSION
+
+It can be used from the command line::
+
+  advene_export batch [-j WORKERS] [-e EXPORTER]... [-o key=value]... -d OUTPUT_DIR package...
+
+or::
+
+  python3 -m advene.util.batchexport [options] package...
+"""
+
+import logging
+logger = logging.getLogger(__name__)
+
+from gettext import gettext as _
+
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import multiprocessing
+import os
+import sys
+import time
+
+if __name__ == '__main__':
+    # Do not let the config module parse our options
+    saved_args = sys.argv[1:]
+    sys.argv = [ sys.argv[0] ]
+
+import advene.core.config as config
+from advene.core.corpus import alias_from_uri, parse_package_list
+import advene.util.helper as helper
+
+# Controller of the current worker process, initialized by init_worker
+_controller = None
+
+def init_controller():
+    """Return an initialized controller, with plugins and template exporters.
+    """
+    import advene.core.controller as controller
+    c = controller.AdveneController()
+    c.init_plugins()
+    controller.init_templateexporters()
+    return c
+
+def init_worker(paths=None):
+    """Initialize the controller of a worker process.
+
+    @param paths: the config.data.path dict of the parent process
+    """
+    global _controller
+    if paths:
+        config.data.path.update(paths)
+    _controller = init_controller()
+
+def resolve_exporters(controller, names):
+    """Return the exporter ids matching the given names.
+
+    A name is either an exporter id (see
+    L{advene.util.exporter.get_exporter}) or an unambiguous prefix
+    of an exporter id.
+
+    @raise ValueError: if a name does not match exactly one exporter
+    """
+    ids = [ f.get_id() for f in controller.get_export_filters() ]
+    result = []
+    for name in names:
+        if name in ids:
+            result.append(name)
+            continue
+        candidates = [ i for i in ids if i.startswith(name) ]
+        if len(candidates) == 1:
+            result.append(candidates[0])
+        elif candidates:
+            raise ValueError(_("Too many possibilities for %(name)s: %(ids)s") % {
+                'name': name,
+                'ids': ", ".join(candidates) })
+        else:
+            raise ValueError(_("No matching exporter for %s") % name)
+    return result
+
+def list_jobs(packages):
+    """Return the list of (uri, alias) tuples for the given packages.
+
+    Package lists (.apl) are expanded. Aliases are made unique, since
+    they are used as output filenames.
+    """
+    result = []
+    for p in packages:
+        if p.lower().endswith('.apl'):
+            result.extend((u, a) for (u, a, d) in parse_package_list(helper.path2uri(p)))
+        else:
+            result.append((p, alias_from_uri(p)))
+    aliases = set()
+    jobs = []
+    for uri, alias in result:
+        name = alias
+        n = 1
+        while name in aliases:
+            n += 1
+            name = "%s_%d" % (alias, n)
+        aliases.add(name)
+        jobs.append((uri, name))
+    return jobs
+
+def load_package(controller, uri, alias):
+    """Make sure that the package is loaded in the controller.
+
+    The previously loaded package is unloaded.
+    """
+    uri = helper.path2uri(uri)
+    previous = controller.package
+    if previous is not None and controller.packages.get(alias) is previous and previous.uri == uri:
+        return previous
+    controller.load_package(uri, alias=alias)
+    if controller.packages.get(alias) is None or controller.package is previous:
+        raise Exception(_("Cannot load package %s") % uri)
+    if previous is not None and previous in controller.aliases:
+        controller.remove_package(previous)
+    return controller.package
+
+def export_package(uri, alias, exporters, outputdir, options=None):
+    """Export a package with the given exporters.
+
+    This is executed in worker processes. The package is loaded once,
+    and its loading time is accounted to the first exporter.
+
+    @return: the list of export results (see L{export_job}), in the order of the exporters
+    """
+    if _controller is None:
+        init_worker()
+    c = _controller
+    results = []
+    t0 = time.time()
+    try:
+        load_package(c, uri, alias)
+        error = None
+    except Exception as e:
+        logger.debug("Error when loading %s", uri, exc_info=True)
+        error = str(e) or e.__class__.__name__
+    for exporter_id in exporters:
+        if error is None:
+            r = export_job(c, uri, alias, exporter_id, outputdir, options, start=t0)
+        else:
+            r = { 'uri': uri,
+                  'alias': alias,
+                  'exporter': exporter_id,
+                  'filename': None,
+                  'error': error,
+                  'duration': time.time() - t0 }
+        results.append(r)
+        t0 = time.time()
+    return results
+
+def export_job(controller, uri, alias, exporter_id, outputdir, options=None, start=None):
+    """Export the loaded package with the given exporter.
+
+    @param start: the start time of the job (default: now)
+    @return: a dict with the job parameters, the output filename, the elapsed time and the error message (if any)
+    """
+    c = controller
+    result = { 'uri': uri,
+               'alias': alias,
+               'exporter': exporter_id,
+               'filename': None,
+               'error': None }
+    t0 = start or time.time()
+    try:
+        exporter_class = c.get_export_filters(ident=exporter_id)
+        if exporter_class is None:
+            raise Exception(_("No matching exporter for %s") % exporter_id)
+        e = exporter_class(controller=c)
+        e.process_options(list(options or []))
+        e.set_source(c.package)
+        dirname = os.path.join(outputdir, exporter_id)
+        os.makedirs(dirname, exist_ok=True)
+        filename = e.get_filename(os.path.join(dirname, alias))
+        e.export(filename)
+        result['filename'] = filename
+    except Exception as e:
+        logger.debug("Error when exporting %s with %s", uri, exporter_id, exc_info=True)
+        result['error'] = str(e) or e.__class__.__name__
+    result['duration'] = time.time() - t0
+    return result
+
+def batch_export(packages, exporters, outputdir, options=None, workers=None, callback=None):
+    """Export packages with the given exporters.
+
+    There is one job per package, running all the exporters, so
+    that each package is loaded only once.
+
+    @param packages: a list of (uri, alias) tuples
+    @param exporters: a list of exporter ids
+    @param outputdir: the output directory
+    @param options: a list of exporter options (as --key=value strings)
+    @param workers: the number of worker processes (default: number of CPUs)
+    @param callback: a method with signature (progress, message). If it returns False, the export is canceled.
+    @return: the list of export results, ordered by package then exporter
+    """
+    if not packages or not exporters:
+        return []
+    os.makedirs(outputdir, exist_ok=True)
+    results = {}
+    # Use the spawn method, since fork is unsafe when the GUI is running
+    with ProcessPoolExecutor(max_workers=workers,
+                             mp_context=multiprocessing.get_context('spawn'),
+                             initializer=init_worker,
+                             initargs=(dict(config.data.path), )) as executor:
+        futures = dict( (executor.submit(export_package, uri, alias, exporters, outputdir, options), i)
+                        for (i, (uri, alias)) in enumerate(packages) )
+        for n, future in enumerate(as_completed(futures)):
+            package_results = results[futures[future]] = future.result()
+            for r in package_results:
+                if r['error']:
+                    logger.error("%s (%s): %s", r['alias'], r['exporter'], r['error'])
+                else:
+                    logger.info("%s (%s): %s in %.2fs", r['alias'], r['exporter'], r['filename'], r['duration'])
+            if callback is not None and callback((n + 1) / len(packages), _("Exported %s") % package_results[0]['alias']) is False:
+                for f in futures:
+                    f.cancel()
+                break
+    return [ r for i in sorted(results) for r in results[i] ]
+
+def report(results, elapsed=None):
+    """Return a textual report of the export results.
+    """
+    lines = []
+    errors = [ r for r in results if r['error'] ]
+    for r in results:
+        lines.append("%-8s %7.2fs  %-20s %-30s %s" % ("FAILED" if r['error'] else "OK",
+                                                       r['duration'],
+                                                       r['alias'],
+                                                       r['exporter'],
+                                                       r['error'] or r['filename']))
+    total = sum(r['duration'] for r in results)
+    lines.append(_("%(count)d exports, %(errors)d failed, %(total).2fs cumulated export time") % {
+        'count': len(results),
+        'errors': len(errors),
+        'total': total })
+    if elapsed is not None:
+        lines.append(_("Elapsed time: %.2fs") % elapsed)
+    return "\n".join(lines)
+
+def main(args=None):
+    import argparse
+
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description="Batch export of Advene packages")
+    parser.add_argument('-j', '--workers', type=int, default=None,
+                        help="Number of worker processes (default: number of CPUs)")
+    parser.add_argument('-e', '--exporter', dest='exporters', action='append', default=[],
+                        help="Exporter id (or unambiguous prefix). Can be specified multiple times.")
+    parser.add_argument('-o', '--option', dest='options', action='append', default=[],
+                        metavar="OPTION-STRING",
+                        help="Exporter options, as a key=value item.")
+    parser.add_argument('-d', '--output-dir', dest='outputdir', default='.',
+                        help="Output directory")
+    parser.add_argument('-l', '--list', action='store_true',
+                        help="List available exporters")
+    parser.add_argument('packages', nargs='*',
+                        help="Packages or package lists (.apl)")
+    args = parser.parse_args(args)
+
+    # Used to validate exporter names and to list exporters
+    c = init_controller()
+    if args.list or not args.exporters or not args.packages:
+        logger.error("Available exporters:\n  * %s",
+                     "\n  * ".join(f.get_id() for f in c.get_export_filters()))
+        sys.exit(0 if args.list else 1)
+
+    try:
+        exporters = resolve_exporters(c, args.exporters)
+    except ValueError as e:
+        logger.error(str(e))
+        sys.exit(1)
+    option_list = [ (f"--{k}={v}" if v else f"--{k}")
+                    for (k, v) in (i.split('=', 1) if '=' in i else (i, "")
+                                   for i in args.options) ]
+    t0 = time.time()
+    results = batch_export(list_jobs(args.packages), exporters, args.outputdir,
+                           options=option_list, workers=args.workers)
+    print(report(results, time.time() - t0))
+    sys.exit(1 if any(r['error'] for r in results) else 0)
+
+if __name__ == '__main__':
+    main(saved_args)
@@ -0,0 +1,415 @@
+#
+# Advene: Annotate Digital Videos, Exchange on the NEt
+# Copyright (C) 2025 Olivier Aubert <contact@olivieraubert.net>
+#
+# Advene is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# Advene is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Advene; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+#
+"""Persistent package catalog.
+
+The catalog stores metadata about package files (title, media,
+checksum, element counts, annotation statistics per annotation type)
+in a SQLite database, so that packages can be browsed and searched
+without parsing them.
+
+It is updated incrementally: a package file is parsed only if its
+size or modification time changed since it was indexed, and its
+content checksum differs from the indexed one.
+
+The default catalog is stored in the settings directory. The
+C{scripts/indexer} script is a command-line interface to it.
+"""
+
+import logging
+logger = logging.getLogger(__name__)
+
+import collections
+import hashlib
+import json
+import os
+import re
+import sqlite3
+import time
+
+import advene.core.config as config
+from advene.model.constants import dcNS
+from advene.model.package import Package
+import advene.util.helper as helper
+
+# Version of the database schema. The database is rebuilt when it changes.
+SCHEMA_VERSION = 1
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS package (
+    path TEXT PRIMARY KEY,
+    size INTEGER,
+    mtime REAL,
+    checksum TEXT,
+    indexed REAL,
+    error TEXT,
+    uri TEXT,
+    title TEXT,
+    description TEXT,
+    media TEXT,
+    duration INTEGER,
+    schema_count INTEGER,
+    annotation_count INTEGER,
+    annotationtype_count INTEGER,
+    relation_count INTEGER,
+    relationtype_count INTEGER,
+    query_count INTEGER,
+    view_count INTEGER,
+    meta TEXT,
+    stats TEXT
+);
+CREATE TABLE IF NOT EXISTS annotationtype (
+    path TEXT REFERENCES package(path) ON DELETE CASCADE,
+    id TEXT,
+    title TEXT,
+    schema TEXT,
+    schema_id TEXT,
+    annotation_count INTEGER,
+    duration INTEGER,
+    meta TEXT,
+    stats TEXT,
+    completions TEXT,
+    PRIMARY KEY (path, id)
+);
+CREATE INDEX IF NOT EXISTS annotationtype_title ON annotationtype(title);
+CREATE INDEX IF NOT EXISTS package_media ON package(media);
+"""
+
+# Package file extensions
+PACKAGE_EXTENSIONS = ('.azp', '.xml')
+
+def file_checksum(path, blocksize=1 << 20):
+    """Return the SHA1 checksum of the file content.
+    """
+    h = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(blocksize), b''):
+            h.update(block)
+    return h.hexdigest()
+
+def meta_dict(element):
+    return dict( ("%s#%s" % (ns, n), v) for (ns, n, v) in element.listMetaData() )
+
+def parse_completions(meta):
+    """Return the completions defined in the annotation type metadata.
+    """
+    comp = meta.get('%s#completions' % config.data.namespace, '')
+    if ',' in comp:
+        # Comma-separated list
+        return re.split(r'\s*,\s*', comp)
+    else:
+        # Consider a space-separated list
+        return comp.split()
+
+def package_info(p):
+    """Return the catalog data for a loaded package.
+
+    Annotations are grouped by type in a single pass, so that the
+    per-type statistics do not iterate over all annotations for
+    each type.
+
+    @return: a (package_data, annotation_types_data) tuple of dicts
+    """
+    annotations = p.annotations
+    by_type = collections.defaultdict(list)
+    for a in annotations:
+        by_type[a.type.id].append(a)
+    duration = p.getMetaData(config.data.namespace, "duration")
+    try:
+        duration = int(float(duration))
+    except (TypeError, ValueError):
+        duration = None
+    data = {
+        'uri': p.uri,
+        'title': p.title,
+        'description': p.getMetaData(dcNS, 'description') or "",
+        'media': p.getMedia() or "",
+        'duration': duration,
+        'schema_count': len(p.schemas),
+        'annotation_count': len(annotations),
+        'annotationtype_count': len(p.annotationTypes),
+        'relation_count': len(p.relations),
+        'relationtype_count': len(p.relationTypes),
+        'query_count': len(p.queries),
+        'view_count': len(p.views),
+        'meta': meta_dict(p),
+        'stats': helper.get_annotations_statistics(annotations, format='raw'),
+    }
+    types = []
+    for at in p.annotationTypes:
+        at_annotations = by_type.get(at.id, [])
+        meta = meta_dict(at)
+        types.append({
+            'id': at.id,
+            'title': at.title,
+            'schema': at.schema.title,
+            'schema_id': at.schema.id,
+            'annotation_count': len(at_annotations),
+            'duration': sum(a.fragment.duration for a in at_annotations),
+            'meta': meta,
+            'stats': helper.get_annotations_statistics(at_annotations, format='raw'),
+            'completions': parse_completions(meta),
+        })
+    return data, types
+
+class PackageCatalog:
+    """Persistent catalog of package files.
+
+    @ivar filename: the database filename
+    @ivar db: the sqlite3 connection
+    """
+    def __init__(self, filename=None):
+        if filename is None:
+            filename = config.data.advenefile('catalog.sqlite', 'settings')
+        self.filename = str(filename)
+        self.db = sqlite3.connect(self.filename)
+        self.db.row_factory = sqlite3.Row
+        self.db.execute("PRAGMA foreign_keys = ON")
+        self.create_schema()
+
+    def create_schema(self):
+        version = self.db.execute("PRAGMA user_version").fetchone()[0]
+        if version != SCHEMA_VERSION:
+            if version:
+                logger.info("Rebuilding package catalog %s", self.filename)
+            self.db.executescript("DROP TABLE IF EXISTS annotationtype; DROP TABLE IF EXISTS package;")
+        self.db.executescript(SCHEMA)
+        self.db.execute("PRAGMA user_version = %d" % SCHEMA_VERSION)
+        self.db.commit()
+
+    def close(self):
+        self.db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def update(self, path, force=False):
+        """Update the catalog information for a package file.
+
+        The package is parsed only if it was modified since the last
+        indexing.
+
+        @param path: the package filename
+        @param force: parse the package even if it was not modified
+        @return: True if the package was (re-)indexed
+        """
+        path = os.path.abspath(path)
+        st = os.stat(path)
+        row = self.db.execute("SELECT size, mtime, checksum FROM package WHERE path = ?",
+                              (path, )).fetchone()
+        if not force and row is not None and row['size'] == st.st_size and row['mtime'] == st.st_mtime:
+            return False
+        checksum = file_checksum(path)
+        if not force and row is not None and row['checksum'] == checksum:
+            # Only the file metadata changed
+            with self.db:
+                self.db.execute("UPDATE package SET size = ?, mtime = ? WHERE path = ?",
+                                (st.st_size, st.st_mtime, path))
+            return False
+
+        logger.info("Indexing %s", path)
+        try:
+            p = Package(uri=helper.path2uri(path))
+            try:
+                data, types = package_info(p)
+            finally:
+                p.close()
+            error = None
+        except Exception as e:
+            logger.error("Cannot parse %s", path, exc_info=True)
+            data, types = {}, []
+            error = str(e)
+
+        with self.db:
+            self.db.execute("DELETE FROM annotationtype WHERE path = ?", (path, ))
+            self.db.execute("DELETE FROM package WHERE path = ?", (path, ))
+            self.db.execute("""INSERT INTO package (path, size, mtime, checksum, indexed, error,
+                            uri, title, description, media, duration,
+                            schema_count, annotation_count, annotationtype_count,
+                            relation_count, relationtype_count, query_count, view_count,
+                            meta, stats)
+                            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""",
+                            (path, st.st_size, st.st_mtime, checksum, time.time(), error,
+                             data.get('uri'), data.get('title'), data.get('description'),
+                             data.get('media'), data.get('duration'),
+                             data.get('schema_count'), data.get('annotation_count'),
+                             data.get('annotationtype_count'), data.get('relation_count'),
+                             data.get('relationtype_count'), data.get('query_count'),
+                             data.get('view_count'),
+                             json.dumps(data.get('meta', {})), json.dumps(data.get('stats', {}))))
+            self.db.executemany("""INSERT INTO annotationtype (path, id, title, schema, schema_id,
+                                annotation_count, duration, meta, stats, completions)
+                                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""",
+                                [ (path, t['id'], t['title'], t['schema'], t['schema_id'],
+                                   t['annotation_count'], t['duration'],
+                                   json.dumps(t['meta']), json.dumps(t['stats']),
+                                   json.dumps(t['completions']))
+                                  for t in types ])
+        return True
+
+    def update_paths(self, paths, force=False, callback=None):
+        """Update the catalog for the given files or directories.
+
+        Directories are recursively scanned for package files.
+
+        @param callback: a method with signature (path, indexed). If it returns False, the update is canceled.
+        @return: the list of package filenames
+        """
+        filenames = []
+        for d in paths:
+            if os.path.isdir(d):
+                for root, dirs, files in os.walk(d):
+                    for name in sorted(files):
+                        if name.lower().endswith(PACKAGE_EXTENSIONS):
+                            filenames.append(os.path.join(root, name))
+            else:
+                filenames.append(d)
+        for fname in filenames:
+            indexed = self.update(fname, force=force)
+            if callback is not None and callback(fname, indexed) is False:
+                break
+        return [ os.path.abspath(f) for f in filenames ]
+
+    def remove(self, path):
+        """Remove a package file from the catalog.
+        """
+        with self.db:
+            self.db.execute("DELETE FROM package WHERE path = ?", (os.path.abspath(path), ))
+
+    def prune(self):
+        """Remove the packages whose file does not exist anymore.
+
+        @return: the list of removed filenames
+        """
+        missing = [ row['path']
+                    for row in self.db.execute("SELECT path FROM package")
+                    if not os.path.exists(row['path']) ]
+        with self.db:
+            self.db.executemany("DELETE FROM package WHERE path = ?",
+                                [ (p, ) for p in missing ])
+        return missing
+
+    def _package_record(self, row, annotationtypes=True):
+        record = dict(row)
+        record['meta'] = json.loads(record['meta'] or '{}')
+        record['stats'] = json.loads(record['stats'] or '{}')
+        if annotationtypes:
+            record['annotationtypes'] = self.annotation_types(path=record['path'])
+        return record
+
+    def _annotation_type_record(self, row):
+        record = dict(row)
+        for k in ('meta', 'stats', 'completions'):
+            record[k] = json.loads(record[k] or 'null')
+        return record
+
+    def get(self, path):
+        """Return the catalog record for the given package file, or None.
+        """
+        row = self.db.execute("SELECT * FROM package WHERE path = ?",
+                              (os.path.abspath(path), )).fetchone()
+        if row is None:
+            return None
+        return self._package_record(row)
+
+    def get_statistics(self, path):
+        """Return the element counts of a package file.
+
+        The package is indexed if necessary. The returned dict has
+        the same keys as the data from a statistics.xml file.
+        """
+        self.update(path)
+        record = self.get(path)
+        if record is None or record['error']:
+            return None
+        return {
+            'title': record['title'],
+            'description': record['description'],
+            'schema': record['schema_count'],
+            'annotation': record['annotation_count'],
+            'annotation_type': record['annotationtype_count'],
+            'relation': record['relation_count'],
+            'relation_type': record['relationtype_count'],
+            'query': record['query_count'],
+            'view': record['view_count'],
+        }
+
+    def packages(self, title=None, media=None, annotation_type=None, annotationtypes=False):
+        """Search packages.
+
+        Parameters are case-insensitive substrings.
+
+        @param title: package title
+        @param media: media filename or URI
+        @param annotation_type: title of an annotation type defined by the package
+        @param annotationtypes: include the annotation type records in the results
+        @return: a list of package records
+        """
+        clauses = [ "error IS NULL" ]
+        params = []
+        if title:
+            clauses.append("title LIKE ?")
+            params.append("%%%s%%" % title)
+        if media:
+            clauses.append("media LIKE ?")
+            params.append("%%%s%%" % media)
+        if annotation_type:
+            clauses.append("path IN (SELECT path FROM annotationtype WHERE title LIKE ?)")
+            params.append("%%%s%%" % annotation_type)
+        rows = self.db.execute("SELECT * FROM package WHERE %s ORDER BY path" % " AND ".join(clauses),
+                               params).fetchall()
+        return [ self._package_record(row, annotationtypes) for row in rows ]
+
+    def annotation_types(self, title=None, path=None):
+        """Search annotation types.
+
+        @param title: case-insensitive substring of the annotation type title
+        @param path: the package filename
+        @return: a list of annotation type records
+        """
+        clauses = [ "1" ]
+        params = []
+        if title:
+            clauses.append("title LIKE ?")
+            params.append("%%%s%%" % title)
+        if path:
+            clauses.append("path = ?")
+            params.append(os.path.abspath(path))
+        rows = self.db.execute("SELECT * FROM annotationtype WHERE %s ORDER BY path, rowid" % " AND ".join(clauses),
+                               params).fetchall()
+        return [ self._annotation_type_record(row) for row in rows ]
+
+    def errors(self):
+        """Return the (path, error) of packages which could not be parsed.
+        """
+        return [ (row['path'], row['error'])
+                 for row in self.db.execute("SELECT path, error FROM package WHERE error IS NOT NULL ORDER BY path") ]
+
+    def summary(self):
+        """Return global counts about the catalog.
+        """
+        row = self.db.execute("""SELECT COUNT(*) AS packages,
+                              SUM(annotation_count) AS annotations,
+                              SUM(annotationtype_count) AS annotation_types
+                              FROM package WHERE error IS NULL""").fetchone()
+        res = dict(row)
+        res['errors'] = self.db.execute("SELECT COUNT(*) FROM package WHERE error IS NOT NULL").fetchone()[0]
+        return res
@@ -28,14 +28,18 @@ logger = logging.getLogger(__name__)
 
 from gettext import gettext as _
 
+import gzip
 import io
 import json
 import optparse
 import os
+import re
 import sys
+import xml.etree.ElementTree as ET
 
 import advene.core.config as config
 
+from advene.model.constants import adveneNS, dcNS
 from advene.model.package import Package
 from advene.model.content import KeywordList
 
@@ -241,24 +245,108 @@ class GenericExporter:
         """
         return "Generic export"
 
+class EntityUnescapingStream:
+    """Binary stream wrapper converting HTML entities to their values.
+
+    It converts the C{&lt;}, C{&gt;} and C{&amp;} entities written
+    to it, and writes the result to the given stream. Entities split
+    across successive writes are handled.
+    """
+    entity_re = re.compile(rb'&(lt|gt|amp);')
+    entity_values = { b'lt': b'<', b'gt': b'>', b'amp': b'&' }
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.pending = b''
+
+    def unescape(self, data):
+        return self.entity_re.sub(lambda m: self.entity_values[m.group(1)], data)
+
+    def write(self, data):
+        data = self.pending + data
+        # Keep a possibly incomplete trailing entity for the next write
+        i = data.rfind(b'&', max(0, len(data) - 4))
+        if i != -1 and b';' not in data[i:]:
+            self.pending = data[i:]
+            data = data[:i]
+        else:
+            self.pending = b''
+        self.stream.write(self.unescape(data))
+
+    def flush(self):
+        if self.pending:
+            self.stream.write(self.pending)
+            self.pending = b''
+
 class TemplateExporter(GenericExporter):
     """Template exporter.
 
     This exporter uses a TAL template as processing method.
+
+    The template is either given as a view (L{templateview}), or as
+    the id of a view from the exporters package (L{template_id}),
+    which is loaded on first use. Compiled templates are cached per
+    exporter class.
     """
     # This will be overwritten
     name = _("Template exporter")
     # This is supposed to be a view
     templateview = None
+    # Alternatively, id and viewable class of a view from exporters.xml
+    template_id = None
+    template_class = '*'
 
     @classmethod
     def get_name(cls):
+        if cls.templateview is None:
+            return cls.name
         return cls.templateview.title or cls.name
 
+    @classmethod
+    def get_templateview(cls):
+        """Return the template view, loading it if necessary.
+        """
+        if cls.templateview is None and cls.template_id is not None:
+            cls.templateview = get_exporters_package().get_element_by_id(cls.template_id)
+        return cls.templateview
+
+    @classmethod
+    def get_template_class(cls):
+        if cls.templateview is None:
+            return cls.template_class
+        return cls.templateview.matchFilter['class']
+
+    @classmethod
+    def is_textual(cls):
+        mimetype = cls.get_templateview().content.mimetype
+        return mimetype is None or mimetype.startswith('text/')
+
+    @classmethod
+    def get_template(cls):
+        """Return the compiled template.
+
+        The compiled template is cached, and compiled again only if
+        the template view content was modified.
+        """
+        data = cls.get_templateview().content.data
+        cached = cls.__dict__.get('_compiled_template')
+        if cached is not None and cached[0] == data:
+            return cached[1]
+        if cls.is_textual():
+            compiler = simpleTAL.HTMLTemplateCompiler ()
+            compiler.parseTemplate(io.StringIO(data), 'utf-8')
+        else:
+            compiler = simpleTAL.XMLTemplateCompiler ()
+            compiler.parseTemplate(io.StringIO(data))
+        template = compiler.getTemplate()
+        cls._compiled_template = (data, template)
+        return template
+
     @classmethod
     def is_valid_for(cls, expr):
-        is_valid_for_package = cls.templateview.matchFilter['class'] in ('package', '*')
-        is_valid_for_annotationtype = cls.templateview.matchFilter['class'] in ('annotation-type', '*')
+        view_class = cls.get_template_class()
+        is_valid_for_package = view_class in ('package', '*')
+        is_valid_for_annotationtype = view_class in ('annotation-type', '*')
         if expr == 'annotation-container':
             return is_valid_for_package or is_valid_for_annotationtype
         if expr == 'package':
@@ -284,26 +372,23 @@ class TemplateExporter(GenericExporter):
                 logger.error(_("Cannot export to %(filename)s"), exc_info=True)
                 raise
 
-        if self.templateview.content.mimetype is None or self.templateview.content.mimetype.startswith('text/'):
-            compiler = simpleTAL.HTMLTemplateCompiler ()
-            compiler.parseTemplate(self.templateview.content.stream, 'utf-8')
-            if self.templateview.content.mimetype == 'text/plain':
+        template = self.get_template()
+        if self.is_textual():
+            if self.get_templateview().content.mimetype == 'text/plain':
                 # Convert HTML entities to their values
-                output = io.BytesIO()
+                output = EntityUnescapingStream(stream)
             else:
                 output = stream
             try:
-                compiler.getTemplate().expand(context=ctx, outputFile=output, outputEncoding='utf-8')
+                template.expand(context=ctx, outputFile=output, outputEncoding='utf-8')
             except simpleTALES.ContextContentException:
                 logger.error(_("Error when exporting text template"), exc_info=True)
                 raise
-            if self.templateview.content.mimetype == 'text/plain':
-                stream.write(output.getvalue().replace(b'&lt;', b'<').replace(b'&gt;', b'>').replace(b'&amp;', b'&'))
+            finally:
+                output.flush()
         else:
-            compiler = simpleTAL.XMLTemplateCompiler ()
-            compiler.parseTemplate(self.templateview.content.stream)
             try:
-                compiler.getTemplate().expand(context=ctx, outputFile=stream, outputEncoding='utf-8', suppressXMLDeclaration=True)
+                template.expand(context=ctx, outputFile=stream, outputEncoding='utf-8', suppressXMLDeclaration=True)
             except simpleTALES.ContextContentException:
                 logger.error(_("Error when exporting XML template"), exc_info=True)
         if filename is None:
@@ -345,65 +430,184 @@ class FlatJsonExporter(GenericExporter):
     def serialize(self, data, textstream):
         json.dump(data, textstream, skipkeys=True, ensure_ascii=False, sort_keys=True, indent=4, cls=CustomJSONEncoder)
 
+    def get_media_uri(self):
+        package = self.source.ownerPackage
+        return package.getMetaData(config.data.namespace, "media_uri") or self.controller.get_default_media()
+
+    def flat_json_annotation(self, a, media_uri):
+        return {
+            "id": a.id,
+            "title": self.controller.get_title(a),
+            "creator": a.author,
+            "type": a.type.id,
+            "type_title": self.controller.get_title(a.type),
+            "type_color": self.controller.get_element_color(a.type),
+            "media": media_uri,
+            "begin": a.fragment.begin,
+            "end": a.fragment.end,
+            "color": self.controller.get_element_color(a),
+            "content_type": a.content.mimetype,
+            "content": a.content.data,
+            "parsed": a.content.parsed()
+        }
+
+    def flat_json_relation(self, r, media_uri, members=None):
+        """Return the flat representation of a relation.
+
+        members is the list of member representations. By default,
+        the whole annotations are dumped: it is more verbose but
+        avoids to have to do the id lookup when interpreting the file.
+        """
+        if members is None:
+            members = [ self.flat_json_annotation(a, media_uri)
+                        for a in r.members ]
+        return {
+            "id": r.id,
+            "title": self.controller.get_title(r),
+            "creator": r.author,
+            "type": r.type.id,
+            "type_title": self.controller.get_title(r.type),
+            "type_color": self.controller.get_element_color(r.type),
+            "media": media_uri,
+            "color": self.controller.get_element_color(r),
+            "content_type": r.content.mimetype,
+            "content": r.content.data,
+            "parsed": r.content.parsed(),
+            "members": members
+        }
+
     def export(self, filename=None):
         # Works if source is a package or a type
-        package = self.source.ownerPackage
-        media_uri = package.getMetaData(config.data.namespace, "media_uri") or self.controller.get_default_media()
-
-        def flat_json_annotation(a):
-            return {
-                "id": a.id,
-                "title": self.controller.get_title(a),
-                "creator": a.author,
-                "type": a.type.id,
-                "type_title": self.controller.get_title(a.type),
-                "type_color": self.controller.get_element_color(a.type),
-                "media": media_uri,
-                "begin": a.fragment.begin,
-                "end": a.fragment.end,
-                "color": self.controller.get_element_color(a),
-                "content_type": a.content.mimetype,
-                "content": a.content.data,
-                "parsed": a.content.parsed()
-            }
-
-        def flat_json_relation(r):
-            return {
-                "id": r.id,
-                "title": self.controller.get_title(r),
-                "creator": r.author,
-                "type": r.type.id,
-                "type_title": self.controller.get_title(r.type),
-                "type_color": self.controller.get_element_color(r.type),
-                "media": media_uri,
-                "color": self.controller.get_element_color(r),
-                "content_type": r.content.mimetype,
-                "content": r.content.data,
-                "parsed": r.content.parsed(),
-                # Dump the whole annotation, it is more verbose but
-                # avoids to have to do the id lookup when interpreting
-                # the file
-                "members":  [ flat_json_annotation(a)
-                              for a in r.members ]
-            }
-
-        data = { "annotations": [ flat_json_annotation(a)
-                                  for a in self.source.annotations ],
-                 "relations": [ flat_json_relation(r)
+        media_uri = self.get_media_uri()
+
+        annotations = list(self.source.annotations)
+        # Batch-evaluate titles and colors, so that they are cached
+        self.controller.representation.get_titles(annotations)
+        self.controller.representation.get_colors(annotations)
+
+        data = { "annotations": [ self.flat_json_annotation(a, media_uri)
+                                  for a in annotations ],
+                 "relations": [ self.flat_json_relation(r, media_uri)
                                 for r in self.source.relations ] }
 
         return self.output(data, filename)
 
+@register_exporter
+class FlatJsonLinesExporter(FlatJsonExporter):
+    """Flat JSON Lines exporter.
+
+    This is a streaming variant of the Flat JSON exporter, suitable
+    for very large packages: each element is output as a JSON object
+    on its own line, as soon as it is converted. Relation members are
+    referenced by their id.
+
+    The first line is a header record. Each record has a C{record}
+    key, whose value is C{header}, C{annotation} or C{relation}.
+    All annotations are output before relations.
+
+    The output is gzip-compressed if the C{gzip} option is set, or if
+    the filename ends with C{.gz}.
+    """
+    name = _("Flat JSON Lines exporter")
+    extension = 'jsonl'
+    mimetype = "application/x-ndjson"
+    FORMAT = "advene-flatjson-lines"
+    VERSION = 1
+
+    def __init__(self, controller=None, source=None, callback=None):
+        super().__init__(controller=controller, source=source, callback=callback)
+        self.gzip = False
+        self.optionparser.add_option("-z", "--gzip",
+                                     action="store_true", dest="gzip", default=self.gzip,
+                                     help=_("Compress the output with gzip"))
+
+    def get_filename(self, basename=None, source=None):
+        name = super().get_filename(basename, source)
+        if self.gzip:
+            name = name + '.gz'
+        return name
+
+    def records(self):
+        """Generate the records (as dicts) for the source elements.
+        """
+        media_uri = self.get_media_uri()
+        package = self.source.ownerPackage
+        yield { "record": "header",
+                "format": self.FORMAT,
+                "version": self.VERSION,
+                "title": package.title,
+                "media": media_uri }
+        # Do not build lists of elements: iterate over them.
+        for a in self.source.annotations:
+            data = self.flat_json_annotation(a, media_uri)
+            data["record"] = "annotation"
+            yield data
+        for r in self.source.relations:
+            data = self.flat_json_relation(r, media_uri,
+                                           members=[ a.id for a in r.members ])
+            data["record"] = "relation"
+            yield data
+
+    def serialize(self, data, textstream):
+        encoder = CustomJSONEncoder(skipkeys=True, ensure_ascii=False)
+        for count, record in enumerate(data):
+            textstream.write(encoder.encode(record))
+            textstream.write("\n")
+            if self.callback is not None and count % 1000 == 0:
+                self.callback(None, _("%d elements exported") % count)
+
+    def export(self, filename=None):
+        if filename is None:
+            # Return the records iterator
+            return self.records()
+        elif isinstance(filename, str) and filename != '-' and (self.gzip or filename.endswith('.gz')):
+            with gzip.open(filename, 'wt', encoding='utf-8') as fd:
+                self.serialize(self.records(), fd)
+            return ""
+        elif isinstance(filename, io.BufferedIOBase):
+            fd = io.TextIOWrapper(filename, encoding='utf-8', write_through=True)
+            try:
+                self.serialize(self.records(), fd)
+            finally:
+                # Do not close the caller stream
+                fd.detach()
+            return ""
+        return self.output(self.records(), filename)
+
+_exporters_package = None
+
+def get_exporters_package():
+    """Return the package holding the exporter templates.
+
+    It is loaded on first use.
+    """
+    global _exporters_package
+    if _exporters_package is None:
+        _exporters_package = Package(uri=config.data.advenefile('exporters.xml', as_uri=True))
+    return _exporters_package
+
 def init_templateexporters():
-    exporter_package = Package(uri=config.data.advenefile('exporters.xml', as_uri=True))
-    for v in exporter_package.views:
-        if v.id == 'index':
+    """Register the template exporters defined in exporters.xml.
+
+    The file is only scanned for the view ids, titles, extensions
+    and mimetypes. The views themselves are loaded on first use of
+    an exporter.
+    """
+    ns = '{%s}' % adveneNS
+    tree = ET.parse(config.data.advenefile('exporters.xml'))
+    for v in tree.getroot().iterfind('%sviews/%sview' % (ns, ns)):
+        view_id = v.attrib['id']
+        if view_id == 'index':
             continue
-        klass = type("{}Exporter".format(v.id), (TemplateExporter,), {
-            'name': v.title,
-            'templateview': v,
-            'extension': v.getMetaData(config.data.namespace, 'extension') or v.id,
-            'mimetype': v.content.mimetype
+        title = (v.attrib.get('{%s}title' % dcNS)
+                 or v.findtext('%smeta/{%s}title' % (ns, dcNS)))
+        content = v.find('%scontent' % ns)
+        klass = type("{}Exporter".format(view_id), (TemplateExporter,), {
+            'name': title or TemplateExporter.name,
+            'template_id': view_id,
+            'template_class': v.attrib.get('viewable-class', '*'),
+            'extension': v.findtext('%smeta/{%s}extension' % (ns, config.data.namespace)) or view_id,
+            'mimetype': content.attrib.get('mime-type') if content is not None else None
         })
         register_exporter(klass)
 
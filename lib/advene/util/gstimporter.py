@@ -52,7 +52,11 @@ class GstImporter(GenericImporter):
     postprocessing/cleanup. Since the `process_frame` should not take
     too much time to execute, it is a good idea to buffer annotation
     data, and call the `.convert` method only in the `do_finalize`
-    method.
+    method. If `do_finalize` starts some asynchronous processing, it
+    can return False: the importer must then call `self.end_callback`
+    itself when the processing is done. `do_finalize` is also called
+    when the user interrupts the import: the `reached_end` attribute
+    tells whether the whole media was processed.
 
     You can see examples of usage in the `plugins.soundenveloppe`
     plugin (for audio, using Gstreamer message metadata) and
@@ -63,6 +67,8 @@ class GstImporter(GenericImporter):
     def __init__(self, *p, **kw):
         super(GstImporter, self).__init__(*p, **kw)
         self.is_finalized = False
+        # Set when the end of the media has been reached
+        self.reached_end = False
 
     @staticmethod
     def can_handle(fname):
@@ -83,13 +89,21 @@ class GstImporter(GenericImporter):
         GObject.idle_add(lambda: self.pipeline.set_state(Gst.State.NULL) and False)
         logger.debug("Doing finalize")
         def wrapper():
-            if hasattr(self, 'do_finalize'):
-                self.do_finalize()
+            if hasattr(self, 'do_finalize') and self.do_finalize() is False:
+                # do_finalize will call end_callback itself
+                return False
             self.end_callback()
             return False
         # Make sure finalize is called in the context of the main thread
         GObject.idle_add(wrapper)
 
+    def end_reached(self):
+        """Finalize the import once the end of the media has been reached.
+        """
+        if not self.is_finalized:
+            self.reached_end = True
+        self.finalize()
+
     def get_current_position(self):
         """Return the current pipeline position in ms
 
@@ -131,15 +145,16 @@ class GstImporter(GenericImporter):
         s = message.get_structure()
         if message.type == Gst.MessageType.EOS:
             logger.debug("MSG EOS - finalize")
-            self.finalize()
+            self.end_reached()
         elif s:
             logger.debug("MSG %s: %s", bus.get_name(), s.to_string())
             if s.get_name() == 'progress' and self.progress is not None:
                 progress = s['percent-double'] / 100
-                if not self.progress(progress, self.progress_message(progress, message)):
-                    self.finalize()
+                proceed = self.progress(progress, self.progress_message(progress, message))
                 if s['current'] == s['total']:
                     # End of file. Use this information instead of the EOS signal, which is not always sent.
+                    self.end_reached()
+                elif not proceed:
                     self.finalize()
             else:
                 self.do_process_message(s, bus)
@@ -442,21 +442,21 @@ def get_statistics(fname):
 
         z.close()
 
-    if not st:
-        # If we are here, it is that we could not get the statistics.xml.
-        # Generate it (it can take some time)
-        try:
-            p = Package(uri=fname)
-        except Exception:
-            raise _("Error:\n%s")
-        st = p.generate_statistics()
-        p.close()
-
-    # We have the statistics in XML format. Render it.
-    s = io.StringIO(st)
-    h = advene.model.package.StatisticsHandler()
-    data = h.parse_file(s)
-    s.close()
+    if st:
+        # We have the statistics in XML format. Render it.
+        s = io.StringIO(st)
+        h = advene.model.package.StatisticsHandler()
+        data = h.parse_file(s)
+        s.close()
+    else:
+        # If we are here, it is that we could not get the
+        # statistics.xml. Use the package catalog, which parses the
+        # package only if it was modified since it was indexed.
+        from advene.util.catalog import PackageCatalog
+        with PackageCatalog() as catalog:
+            data = catalog.get_statistics(fname)
+        if data is None:
+            raise AdveneException(_("Cannot read %s") % fname)
 
     m = _("""Package %(title)s:
 %(schema)s
@@ -67,6 +67,7 @@ import logging
 import logging.config
 logger = logging.getLogger(__name__)
 
+import contextlib
 import json
 import os
 import optparse
@@ -294,6 +295,15 @@ class GenericImporter:
         else:
             logger.warning(" ".join(p))
 
+    def modifying_model(self):
+        """Return a context manager for package modifications.
+
+        See L{advene.core.controller.AdveneController.modifying_model}.
+        """
+        if self.controller is None:
+            return contextlib.nullcontext()
+        return self.controller.modifying_model()
+
     def update_statistics(self, elementtype):
         self.statistics[elementtype] = self.statistics.get(elementtype, 0) + 1
 
@@ -349,7 +359,8 @@ class GenericImporter:
             # The package does not have a _color_palette
             pass
         at.setMetaData(config.data.namespace, 'item_color', 'here/tag_color')
-        schema.annotationTypes.append(at)
+        with self.modifying_model():
+            schema.annotationTypes.append(at)
         self.update_statistics('annotation-type')
         return at
 
@@ -363,7 +374,8 @@ class GenericImporter:
         schema.title=title or "Generated schema"
         if description:
             schema.setMetaData(config.data.namespace_prefix['dc'], "description", description)
-        self.package.schemas.append(schema)
+        with self.modifying_model():
+            self.package.schemas.append(schema)
         self.update_statistics('schema')
         return schema
 
@@ -388,7 +400,8 @@ class GenericImporter:
         a.date=timestamp
         a.title=title
         a.content.data = data
-        self.package.annotations.append(a)
+        with self.modifying_model():
+            self.package.annotations.append(a)
         self.update_statistics('annotation')
         return a
 
@@ -534,7 +547,7 @@ class GenericImporter:
                 self.controller.notify('AnnotationCreate', annotation=a)
             try:
                 if hasattr(source, 'send'):
-                    d = source.send(None)
+                    d = source.send(a if d.get('send') else None)
                 else:
                     d = next(source)
             except StopIteration:
@@ -0,0 +1,288 @@
+#
+# Advene: Annotate Digital Videos, Exchange on the NEt
+# Copyright (C) 2025 Olivier Aubert <contact@olivieraubert.net>
+#
+# Advene is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# Advene is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Advene; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+#
+"""Keyframe index.
+
+An accurate seek has to decode all the frames between the previous
+keyframe and the target position. When the target is in the same
+group of pictures (GOP) as the current frame, and after it, stepping
+forward from the current frame is cheaper: only the frames between
+the current position and the target are decoded.
+
+The keyframe index holds the timestamps of the keyframes of the
+first video stream of a media, and its frame count. It is built once
+per media by a demux-only scan (no decoding), in a background
+thread, and cached in the C{keyframes} folder of the settings
+directory. Media without video stream are cached as an index
+without frames, so that they are not scanned again, while media
+whose scan failed are scanned again next time. It is used by the
+gstreamer player (frame stepping) and
+by the snapshotter, whose timestamp queue is ordered, so that
+snapshots requested in the same GOP are taken by stepping through it.
+"""
+
+import logging
+logger = logging.getLogger(__name__)
+
+from bisect import bisect_right
+import json
+import os
+from pathlib import Path
+import threading
+
+try:
+    import gi
+    gi.require_version('Gst', '1.0')
+    from gi.repository import Gst
+except (ImportError, ValueError):
+    Gst = None
+
+import advene.core.config as config
+from advene.util.mediainfo import media_key
+
+# Format version of the cache files
+VERSION = 1
+
+# Tolerance (in ms) used when converting a time difference into a
+# number of frames, since positions are rounded to the ms.
+TOLERANCE = 1
+
+class KeyframeIndex:
+    """Keyframe index of a video stream.
+
+    @ivar keyframes: the sorted keyframe timestamps (in ms)
+    @ivar frames: the number of frames
+    @ivar duration: the stream duration (in ms)
+    @ivar framerate: the (numerator, denominator) framerate, or None if unknown
+    """
+    def __init__(self, keyframes, frames, duration, framerate=None):
+        self.keyframes = sorted(keyframes)
+        self.frames = frames
+        self.duration = duration
+        self.framerate = tuple(framerate) if framerate else None
+
+    @property
+    def frame_duration(self):
+        """Duration of a frame (in ms), or None if unknown.
+        """
+        if self.framerate and self.framerate[0] and self.framerate[1]:
+            return 1000 * self.framerate[1] / self.framerate[0]
+        return None
+
+    def gop(self, t):
+        """Return the index of the GOP containing the given time (in ms).
+
+        It is -1 before the first keyframe.
+        """
+        return bisect_right(self.keyframes, t) - 1
+
+    def keyframe(self, t):
+        """Return the timestamp of the keyframe at or before t, or None.
+        """
+        i = self.gop(t)
+        if i < 0:
+            return None
+        return self.keyframes[i]
+
+    def frame_steps(self, current, target):
+        """Return the number of frames to step from current to target.
+
+        @param current: the current position (in ms)
+        @param target: the target position (in ms)
+        @return: a positive number of frames, or None if an accurate seek is cheaper (or stepping is not possible)
+        """
+        fd = self.frame_duration
+        if fd is None or current is None or target <= current:
+            return None
+        gop = self.gop(current)
+        if gop < 0 or gop != self.gop(target):
+            return None
+        n = int((target - current + TOLERANCE) // fd)
+        return n or None
+
+    def groups(self, timestamps):
+        """Group timestamps by GOP.
+
+        @return: a list of (keyframe, sorted timestamps) tuples, ordered by keyframe
+        """
+        groups = {}
+        for t in timestamps:
+            groups.setdefault(self.gop(t), []).append(t)
+        return [ (self.keyframes[g] if g >= 0 else None, sorted(ts))
+                 for g, ts in sorted(groups.items()) ]
+
+    def save(self, filename):
+        filename = Path(filename)
+        filename.parent.mkdir(parents=True, exist_ok=True)
+        tmp = filename.with_name(filename.name + '.tmp')
+        with open(tmp, 'w', encoding='utf-8') as f:
+            json.dump({ 'version': VERSION,
+                        'keyframes': self.keyframes,
+                        'frames': self.frames,
+                        'duration': self.duration,
+                        'framerate': self.framerate }, f)
+        os.replace(tmp, filename)
+
+    @classmethod
+    def load(cls, filename):
+        """Load an index.
+
+        @return: the index, or None if it is not available
+        """
+        try:
+            with open(filename, encoding='utf-8') as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if data.get('version') != VERSION:
+            return None
+        return cls(data['keyframes'], data['frames'], data['duration'], data.get('framerate'))
+
+def cache_filename(mediafile):
+    """Return the cache filename for a media file, or None.
+    """
+    key = media_key(mediafile)
+    if key is None:
+        return None
+    return Path(config.data.advenefile(('keyframes', key + '.json'), 'settings'))
+
+def build_index(uri):
+    """Build the keyframe index of a media, by demuxing it.
+
+    This method is synchronous: it returns once the whole media has
+    been read.
+
+    @param uri: the media URI
+    @return: the index (without frames if the media has no video stream), or None if it cannot be built
+    """
+    if Gst is None:
+        return None
+    if not Gst.is_initialized():
+        Gst.init(None)
+    pipeline = Gst.Pipeline()
+    src = Gst.ElementFactory.make('urisourcebin')
+    parser = Gst.ElementFactory.make('parsebin')
+    if src is None or parser is None:
+        logger.warning("Cannot build keyframe index: missing urisourcebin or parsebin element")
+        return None
+    src.set_property('uri', uri)
+    pipeline.add(src)
+    pipeline.add(parser)
+    src.connect('pad-added', lambda element, pad: pad.link(parser.get_static_pad('sink')))
+    state = { 'keyframes': [], 'frames': 0, 'last': 0, 'framerate': None, 'video': False }
+    lock = threading.Lock()
+
+    def handoff(sink, buf, pad):
+        if buf.pts == Gst.CLOCK_TIME_NONE:
+            return
+        pts = buf.pts / Gst.MSECOND
+        state['frames'] += 1
+        state['last'] = max(state['last'], pts)
+        if not buf.has_flags(Gst.BufferFlags.DELTA_UNIT):
+            state['keyframes'].append(pts)
+
+    def pad_added(element, pad):
+        caps = pad.get_current_caps() or pad.query_caps(None)
+        s = caps.get_structure(0) if caps.get_size() else None
+        sink = Gst.ElementFactory.make('fakesink')
+        sink.set_property('sync', False)
+        with lock:
+            if s is not None and s.get_name().startswith('video/') and not state['video']:
+                state['video'] = True
+                ok, num, denom = s.get_fraction('framerate')
+                if ok and num:
+                    state['framerate'] = (num, denom)
+                sink.set_property('signal-handoffs', True)
+                sink.connect('handoff', handoff)
+        pipeline.add(sink)
+        sink.sync_state_with_parent()
+        pad.link(sink.get_static_pad('sink'))
+
+    parser.connect('pad-added', pad_added)
+    pipeline.set_state(Gst.State.PLAYING)
+    message = pipeline.get_bus().timed_pop_filtered(Gst.CLOCK_TIME_NONE,
+                                                    Gst.MessageType.EOS | Gst.MessageType.ERROR)
+    pipeline.set_state(Gst.State.NULL)
+    if message is None or message.type == Gst.MessageType.ERROR:
+        if message is not None:
+            logger.warning("Cannot build keyframe index for %s: %s", uri, message.parse_error()[0].message)
+        return None
+    if not state['frames']:
+        logger.debug("No video stream in %s", uri)
+        return KeyframeIndex([], 0, 0)
+    index = KeyframeIndex(state['keyframes'], state['frames'], state['last'], state['framerate'])
+    if index.frame_duration:
+        index.duration += index.frame_duration
+    return index
+
+# Callbacks of the indexes being built, by cache filename
+_pending = {}
+_pending_lock = threading.Lock()
+
+def get_index(uri, build=False, callback=None):
+    """Return the cached keyframe index of a local media.
+
+    If it is not available and C{build} is True, it is built in a
+    background thread, and C{callback} is called with the index (or
+    None) when it is done. Only one build is done at a time for a
+    given media, and media without video stream are not scanned
+    again.
+
+    @param uri: the media URI
+    @return: the index, or None if it is not (yet) available
+    """
+    filename = cache_filename(uri)
+    if filename is None:
+        return None
+    index = KeyframeIndex.load(filename)
+    if index is not None:
+        # An index without frames is a negative entry
+        return index if index.frames else None
+    if not build or Gst is None:
+        return None
+
+    with _pending_lock:
+        if filename in _pending:
+            if callback is not None:
+                _pending[filename].append(callback)
+            return None
+        _pending[filename] = [ callback ] if callback is not None else []
+
+    def run():
+        try:
+            index = build_index(uri)
+            if index is not None:
+                # Also save the negative entry of a media without
+                # video stream. Errors are not cached.
+                index.save(filename)
+                if index.frames:
+                    logger.info("Keyframe index of %s: %d keyframes, %d frames", uri, len(index.keyframes), index.frames)
+                else:
+                    index = None
+        except Exception:
+            logger.error("Cannot build keyframe index for %s", uri, exc_info=True)
+            index = None
+        with _pending_lock:
+            callbacks = _pending.pop(filename, [])
+        for cb in callbacks:
+            cb(index)
+
+    t = threading.Thread(target=run, name="keyframe-index")
+    t.daemon = True
+    t.start()
+    return None
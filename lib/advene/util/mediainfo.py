@@ -0,0 +1,146 @@
+#
+# Advene: Annotate Digital Videos, Exchange on the NEt
+# Copyright (C) 2025 Olivier Aubert <contact@olivieraubert.net>
+#
+# Advene is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# Advene is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Advene; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+#
+"""Persistent media information cache.
+
+Information about media files (stream information found by the
+player, checksums...) is stored in the C{mediainfo} folder of the
+settings directory, as a .json file per media. Entries are keyed by
+the file path, size and modification time, so that a modified media
+file is considered as a new one.
+
+Only local files are cached.
+"""
+
+import logging
+logger = logging.getLogger(__name__)
+
+from hashlib import sha1
+import json
+import os
+from pathlib import Path
+
+import advene.core.config as config
+from advene.util.tools import uri2path, mediafile_checksum
+
+# Format version of the cache files
+VERSION = 1
+
+def media_path(mediafile):
+    """Return the local path of a media path or file URI.
+
+    @return: the path, or None for non-local URIs
+    """
+    if mediafile and '://' in str(mediafile):
+        if not str(mediafile).startswith('file:'):
+            return None
+        return uri2path(str(mediafile))
+    return mediafile
+
+def media_key(mediafile):
+    """Return the cache key for a media file.
+
+    It depends on the file path, size and modification time.
+
+    @param mediafile: a media path or file URI
+    @return: the key, or None if the file is not accessible
+    """
+    mediafile = media_path(mediafile)
+    try:
+        st = os.stat(mediafile)
+    except (OSError, TypeError, ValueError):
+        return None
+    key = "%s:%d:%d" % (os.path.abspath(mediafile), st.st_size, st.st_mtime_ns)
+    return sha1(key.encode('utf-8')).hexdigest()
+
+def cache_filename(key):
+    return Path(config.data.advenefile(('mediainfo', key + '.json'), 'settings'))
+
+def get(mediafile):
+    """Return the cached information about a media file.
+
+    @param mediafile: a media path or file URI
+    @return: a dict (empty if nothing is known)
+    """
+    key = media_key(mediafile)
+    if key is None:
+        return {}
+    try:
+        with open(cache_filename(key), encoding='utf-8') as f:
+            data = json.load(f)
+    except FileNotFoundError:
+        return {}
+    except (OSError, ValueError):
+        logger.warning("Cannot read media information cache for %s", mediafile, exc_info=True)
+        return {}
+    if data.get('version') != VERSION:
+        return {}
+    return data.get('info', {})
+
+def update(mediafile, **info):
+    """Store information about a media file.
+
+    The given values are merged with the already cached ones.
+
+    @param mediafile: a media path or file URI
+    @return: True if the information was stored
+    """
+    key = media_key(mediafile)
+    if key is None:
+        return False
+    data = get(mediafile)
+    data.update(info)
+    filename = cache_filename(key)
+    try:
+        filename.parent.mkdir(parents=True, exist_ok=True)
+        # Write to a temporary file, so that readers never see partial data
+        tmp = filename.with_name(filename.name + '.tmp')
+        with open(tmp, 'w', encoding='utf-8') as f:
+            json.dump({ 'version': VERSION,
+                        'path': os.path.abspath(media_path(mediafile)),
+                        'info': data }, f)
+        os.replace(tmp, filename)
+    except (OSError, TypeError, ValueError):
+        logger.warning("Cannot store media information for %s", mediafile, exc_info=True)
+        return False
+    return True
+
+def cached(mediafile, name, compute):
+    """Return a cached information, computing and storing it if needed.
+
+    @param mediafile: a media path or file URI
+    @param name: the information name
+    @param compute: a function returning the value, or None if it cannot be computed. None values are not cached.
+    """
+    value = get(mediafile).get(name)
+    if value is None:
+        value = compute()
+        if value is not None:
+            update(mediafile, **{ name: value })
+    return value
+
+def checksum(mediafile, callback=None):
+    """Return the SHA256 checksum of a media file.
+
+    It is computed by L{advene.util.tools.mediafile_checksum} only
+    if it is not already cached.
+    """
+    if not media_path(mediafile):
+        return None
+    return cached(mediafile, 'checksum',
+                  lambda: mediafile_checksum(media_path(mediafile), callback))
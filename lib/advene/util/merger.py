@@ -27,6 +27,7 @@ from gettext import gettext as _
 
 import argparse
 import filecmp
+import hashlib
 import itertools
 import os
 import shutil
@@ -68,10 +69,112 @@ DEFAULT_EXCLUDE_RULES = {
     'update_content': 'except_default_workspace'
 }
 
+def element_digest(el):
+    """Return a digest of the significant attributes of an element.
+
+    Two elements with the same id and the same digest are considered
+    identical by the merger.
+    """
+    h = hashlib.sha1()
+    def update(v):
+        if not isinstance(v, bytes):
+            v = str(v).encode('utf-8', 'surrogateescape')
+        h.update(v)
+        h.update(b'\0')
+    update(type(el).__name__)
+    update(el.id)
+    update(el.author)
+    update(el.date)
+    if hasattr(el, 'type'):
+        update(el.type.id)
+    if isinstance(el, Annotation):
+        update(el.fragment.begin)
+        update(el.fragment.end)
+    elif isinstance(el, Relation):
+        update(" ".join(a.id for a in el.members))
+    elif isinstance(el, (View, Query)):
+        update(el.title)
+    if isinstance(el, View):
+        update(sorted(el.matchFilter.items()))
+    if el.content is not None:
+        update(el.content.mimetype)
+        update(el.content.data or "")
+    if hasattr(el, 'tags'):
+        update(",".join(el.tags))
+    for (namespace, name, value) in sorted(el.listMetaData()):
+        update(namespace)
+        update(name)
+        update(value)
+    return h.digest()
+
+class PackageIndex:
+    """Index of the elements of a package.
+
+    Elements are indexed by id, with the same precedence as
+    L{Package.get_element_by_id}. The index must be kept up-to-date
+    (through L{add} and L{remove}) when elements are created or
+    deleted.
+
+    Element digests are cached, and must be invalidated (through
+    L{invalidate}) when elements are modified.
+
+    @ivar package: the indexed package
+    @ivar elements: the elements, indexed by id
+    @ivar digests: the cached digests, indexed by element
+    """
+    def __init__(self, package):
+        self.package = package
+        self.elements = {}
+        self.digests = {}
+        for elements in (package.schemas, package.views,
+                         package.annotationTypes, package.relationTypes,
+                         package.annotations, package.queries,
+                         package.relations):
+            for el in elements:
+                self.elements.setdefault(el.id, el)
+
+    def get(self, id_, cls=None):
+        """Return the element with the given id.
+
+        If cls is specified, then None is returned if the element is
+        not an instance of cls.
+        """
+        el = self.elements.get(id_)
+        if cls is not None and not isinstance(el, cls):
+            return None
+        return el
+
+    def add(self, el):
+        self.elements.setdefault(el.id, el)
+
+    def remove(self, el):
+        if self.elements.get(el.id) is el:
+            del self.elements[el.id]
+        self.invalidate(el)
+
+    def invalidate(self, el):
+        """Invalidate the cached digest of the element.
+        """
+        self.digests.pop(el, None)
+
+    def digest(self, el):
+        """Return the (cached) digest of the element.
+        """
+        try:
+            return self.digests[el]
+        except KeyError:
+            d = self.digests[el] = element_digest(el)
+            return d
+
+    def values(self, cls):
+        """Return the indexed elements which are instances of cls.
+        """
+        return [ el for el in self.elements.values() if isinstance(el, cls) ]
+
 class Differ:
     """Returns a structure diff of two packages.
     """
-    def __init__(self, source=None, destination=None, controller=None):
+    def __init__(self, source=None, destination=None, controller=None, destination_index=None):
         self.source = source
         self.destination = destination
         self.controller = controller
@@ -79,6 +182,37 @@ class Differ:
         # key is the id in the source package, the value the (new) id
         # in the destination package.
         self.translated_ids = {}
+        # The destination index can be shared between successive
+        # differs on the same destination package.
+        if destination_index is None and destination is not None:
+            destination_index = PackageIndex(destination)
+        self.destination_index = destination_index
+        # Digests of source elements, indexed by element
+        self.digests = {}
+
+    def digest(self, el):
+        """Return the (cached) digest of a source element.
+        """
+        try:
+            return self.digests[el]
+        except KeyError:
+            d = self.digests[el] = element_digest(el)
+            return d
+
+    def signatures(self, index, cls):
+        """Return the set of (id, digest) of the cls elements of index.
+        """
+        return set( (el.id, index.digest(el)) for el in index.values(cls) )
+
+    def candidates(self, elements, cls):
+        """Return the source elements which may differ from the destination.
+
+        Elements with the same (id, digest) in the destination are
+        left out, so that only the remaining ones have to be compared
+        attribute by attribute.
+        """
+        unchanged = self.signatures(self.destination_index, cls)
+        return [ el for el in elements if (el.id, self.digest(el)) not in unchanged ]
 
     def diff(self):
         """Iterator returning a changelist for all elements.
@@ -158,7 +292,7 @@ class Differ:
 
     def diff_schemas(self):
         for s in self.source.schemas:
-            d=self.destination.get_element_by_id(s.id)
+            d=self.destination_index.get(s.id)
             if d is None:
                 yield ('new', s, None,
                        lambda s, d: self.copy_schema(s),
@@ -179,7 +313,7 @@ class Differ:
 
     def diff_annotation_types(self):
         for s in self.source.annotationTypes:
-            d=self.destination.get_element_by_id(s.id)
+            d=self.destination_index.get(s.id)
             if d is None:
                 yield ('new', s, None,
                        lambda s, d: self.copy_annotation_type(s),
@@ -203,7 +337,7 @@ class Differ:
 
     def diff_relation_types(self):
         for s in self.source.relationTypes:
-            d=self.destination.get_element_by_id(s.id)
+            d=self.destination_index.get(s.id)
             if d is None:
                 yield ('new', s, None,
                        lambda s, d: self.copy_relation_type(s),
@@ -230,98 +364,110 @@ class Differ:
                        lambda e: str(e))
 
     def diff_annotations(self):
-        for s in self.source.annotations:
-            d=self.destination.get_element_by_id(s.id)
+        for s in self.candidates(self.source.annotations, Annotation):
+            d=self.destination_index.get(s.id)
             if d is None:
                 yield ('new', s, None,
                        lambda s, d: self.copy_annotation(s),
                        lambda e: str(e))
             elif isinstance(d, type(s)):
-                # check type and author/date. If different, it is very
-                # likely that it is in fact a new annotation, with
-                # duplicate id.
-                if s.type.id != d.type.id:
-                    yield ('new_annotation', s, d,
-                           lambda s, d: self.copy_annotation(s, True),
-                           lambda e: str(e))
-                    continue
-                if s.author != d.author and s.date != d.date:
-                    # New annotation.
-                    yield ('new_annotation', s, d,
-                           lambda s, d: self.copy_annotation(s, True),
-                           lambda e: str(e))
-                    continue
-                # Present. Check if it was modified
-                if s.fragment.begin != d.fragment.begin:
-                    yield ('update_begin', s, d,
-                           lambda s, d: d.fragment.setBegin(s.fragment.begin),
-                           lambda e: e.fragment.begin)
-                if s.fragment.end != d.fragment.end:
-                    yield ('update_end', s, d,
-                           lambda s, d: d.fragment.setEnd(s.fragment.end),
-                           lambda e: e.fragment.end)
-                if s.content.data != d.content.data:
-                    yield ('update_content', s, d,
-                           lambda s, d: d.content.setData(s.content.data),
-                           lambda e: e.content.data)
-                if s.tags != d.tags:
-                    yield ('update_tags', s, d,
-                           lambda s, d: d.setTags( s.tags ),
-                           lambda e: e.tags)
-                for c in self.diff_meta(s, d):
+                for c in self.compare_annotations(s, d):
                     yield c
             else:
                 yield ('new', s, None,
                        lambda s, d: self.copy_annotation(s, True),
                        lambda e: str(e))
 
+    def compare_annotations(self, s, d):
+        """Compare two annotations with the same id.
+        """
+        # check type and author/date. If different, it is very
+        # likely that it is in fact a new annotation, with
+        # duplicate id.
+        if s.type.id != d.type.id:
+            yield ('new_annotation', s, d,
+                   lambda s, d: self.copy_annotation(s, True),
+                   lambda e: str(e))
+            return
+        if s.author != d.author and s.date != d.date:
+            # New annotation.
+            yield ('new_annotation', s, d,
+                   lambda s, d: self.copy_annotation(s, True),
+                   lambda e: str(e))
+            return
+        # Present. Check if it was modified
+        if s.fragment.begin != d.fragment.begin:
+            yield ('update_begin', s, d,
+                   lambda s, d: d.fragment.setBegin(s.fragment.begin),
+                   lambda e: e.fragment.begin)
+        if s.fragment.end != d.fragment.end:
+            yield ('update_end', s, d,
+                   lambda s, d: d.fragment.setEnd(s.fragment.end),
+                   lambda e: e.fragment.end)
+        if s.content.data != d.content.data:
+            yield ('update_content', s, d,
+                   lambda s, d: d.content.setData(s.content.data),
+                   lambda e: e.content.data)
+        if s.tags != d.tags:
+            yield ('update_tags', s, d,
+                   lambda s, d: d.setTags( s.tags ),
+                   lambda e: e.tags)
+        for c in self.diff_meta(s, d):
+            yield c
+
     def diff_relations(self):
-        for s in self.source.relations:
-            d=self.destination.get_element_by_id(s.id)
+        for s in self.candidates(self.source.relations, Relation):
+            d=self.destination_index.get(s.id)
             if d is None:
                 yield ('new', s, None,
                        lambda s, d: self.copy_relation(s),
                        lambda e: str(e))
             elif isinstance(d, type(s)):
-                # check author/date. If different, it is very
-                # likely that it is in fact a new relation, with
-                # duplicate id.
-                if s.type.id != d.type.id:
-                    yield ('new_relation', s, d,
-                           lambda s, d: self.copy_relation(s, True),
-                           lambda e: str(e))
-                    continue
-                if s.author != d.author and s.date != d.date:
-                    # New relation.
-                    yield ('new_relation', s, d,
-                           lambda s, d: self.copy_relation(s, True),
-                           lambda e: str(e))
-                    continue
-                # Present. Check if it was modified
-                if s.content.data != d.content.data:
-                    yield ('update_content', s, d,
-                           lambda s, d: d.content.setData(s.content.data),
-                           lambda e: e.content.data)
-                sm=[ a.id for a in s.members ]
-                dm=[ a.id for a in d.members ]
-                if sm != dm:
-                    yield ('update_members', s, d,
-                           self.update_members,
-                           lambda e: e.members)
-                if s.tags != d.tags:
-                    yield ('update_tags', s, d,
-                           lambda s, d: d.setTags( s.tags ),
-                           lambda e: e.tags)
-                for c in self.diff_meta(s, d):
+                for c in self.compare_relations(s, d):
                     yield c
             else:
                 yield ('new', s, None,
                        lambda s, d: self.copy_relation(s, True),
                        lambda e: str(e))
 
+    def compare_relations(self, s, d):
+        """Compare two relations with the same id.
+        """
+        # check author/date. If different, it is very
+        # likely that it is in fact a new relation, with
+        # duplicate id.
+        if s.type.id != d.type.id:
+            yield ('new_relation', s, d,
+                   lambda s, d: self.copy_relation(s, True),
+                   lambda e: str(e))
+            return
+        if s.author != d.author and s.date != d.date:
+            # New relation.
+            yield ('new_relation', s, d,
+                   lambda s, d: self.copy_relation(s, True),
+                   lambda e: str(e))
+            return
+        # Present. Check if it was modified
+        if s.content.data != d.content.data:
+            yield ('update_content', s, d,
+                   lambda s, d: d.content.setData(s.content.data),
+                   lambda e: e.content.data)
+        sm=[ a.id for a in s.members ]
+        dm=[ a.id for a in d.members ]
+        if sm != dm:
+            yield ('update_members', s, d,
+                   self.update_members,
+                   lambda e: e.members)
+        if s.tags != d.tags:
+            yield ('update_tags', s, d,
+                   lambda s, d: d.setTags( s.tags ),
+                   lambda e: e.tags)
+        for c in self.diff_meta(s, d):
+            yield c
+
     def diff_views(self):
         for s in self.source.views:
-            d=self.destination.get_element_by_id(s.id)
+            d=self.destination_index.get(s.id)
             if d is None:
                 yield ('new', s, None,
                        lambda s, d: self.copy_view(s),
@@ -354,7 +500,7 @@ class Differ:
 
     def diff_queries(self):
         for s in self.source.queries:
-            d=self.destination.get_element_by_id(s.id)
+            d=self.destination_index.get(s.id)
             if d is None:
                 yield ('new', s, None,
                        lambda s, d: self.copy_query(s),
@@ -418,7 +564,7 @@ class Differ:
         return
 
     def copy_schema(self, s, generate_id=False):
-        if generate_id or self.destination.get_element_by_id(s.id):
+        if generate_id or self.destination_index.get(s.id):
             id_=self.destination._idgenerator.get_id(Schema)
         else:
             id_ = s.id
@@ -432,10 +578,11 @@ class Differ:
         for (namespace, name, value) in s.listMetaData():
             el.setMetaData(namespace, name, value)
         self.destination.schemas.append(el)
+        self.destination_index.add(el)
         return el
 
     def copy_annotation_type(self, s, generate_id=False):
-        if generate_id or self.destination.get_element_by_id(s.id):
+        if generate_id or self.destination_index.get(s.id):
             id_=self.destination._idgenerator.get_id(AnnotationType)
         else:
             id_ = s.id
@@ -443,7 +590,7 @@ class Differ:
         self.translated_ids[s.id]=id_
 
         # Find parent, and create it if necessary
-        sch=helper.get_id(self.destination.schemas, s.schema.id)
+        sch=self.destination_index.get(s.schema.id, Schema)
         if not sch:
             # Create it
             sch=helper.get_id(self.source.schemas, s.schema.id)
@@ -456,10 +603,11 @@ class Differ:
         for (namespace, name, value) in s.listMetaData():
             el.setMetaData(namespace, name, value)
         sch.annotationTypes.append(el)
+        self.destination_index.add(el)
         return el
 
     def copy_relation_type(self, s, generate_id=False):
-        if generate_id or self.destination.get_element_by_id(s.id):
+        if generate_id or self.destination_index.get(s.id):
             id_=self.destination._idgenerator.get_id(RelationType)
         else:
             id_ = s.id
@@ -467,7 +615,7 @@ class Differ:
         self.translated_ids[s.id]=id_
 
         # Find parent, and create it if necessary
-        sch=helper.get_id(self.destination.schemas, s.schema.id)
+        sch=self.destination_index.get(s.schema.id, Schema)
         if not sch:
             # Create it
             sch=helper.get_id(self.source.schemas, s.schema.id)
@@ -488,13 +636,14 @@ class Differ:
             if not m.startswith('#'):
                 logger.error("Cannot handle non-fragment membertypes %s", m)
                 continue
-            at=helper.get_id(self.destination.annotationTypes, m[1:])
+            at=self.destination_index.get(m[1:], AnnotationType)
             if not at:
                 # The annotation type does not exist. Create it.
                 at=helper.get_id(self.source.annotationTypes, m[1:])
                 at=self.copy_annotation_type(at)
         # Now we can set member types
         el.setHackedMemberTypes(s.getHackedMemberTypes())
+        self.destination_index.add(el)
         return el
 
     def update_members(self, s, d):
@@ -506,7 +655,7 @@ class Differ:
             # Handle translated ids
             if i in self.translated_ids:
                 i=self.translated_ids[i]
-            a=helper.get_id(self.destination.annotations, i)
+            a=self.destination_index.get(i, Annotation)
             if a is None:
                 raise "Error: missing annotation %s" % i
             d.members.append(a)
@@ -520,7 +669,7 @@ class Differ:
 
         Try to keep track of the occurences of its id, to fix them later on.
         """
-        if generate_id or self.destination.get_element_by_id(s.id):
+        if generate_id or self.destination_index.get(s.id):
             id_ = self.destination._idgenerator.get_id(Annotation)
         else:
             id_ = s.id
@@ -528,7 +677,7 @@ class Differ:
         self.translated_ids[s.id]=id_
 
         # Find parent, and create it if necessary
-        at=helper.get_id(self.destination.annotationTypes, self.translated_ids.get(s.type.id, s.type.id))
+        at=self.destination_index.get(self.translated_ids.get(s.type.id, s.type.id), AnnotationType)
         if not at:
             # The annotation type does not exist. Create it.
             at=self.copy_annotation_type(helper.get_id(self.source.annotationTypes,
@@ -545,17 +694,18 @@ class Differ:
         for (namespace, name, value) in s.listMetaData():
             el.setMetaData(namespace, name, value)
         self.destination.annotations.append(el)
+        self.destination_index.add(el)
         return el
 
     def copy_relation(self, s, generate_id=False):
-        if generate_id or self.destination.get_element_by_id(s.id):
+        if generate_id or self.destination_index.get(s.id):
             id_=self.destination._idgenerator.get_id(Relation)
         else:
             id_ = s.id
         self.destination._idgenerator.add(id_)
         self.translated_ids[s.id]=id_
 
-        rt=helper.get_id(self.destination.relationTypes, self.translated_ids.get(s.type.id, s.type.id))
+        rt=self.destination_index.get(self.translated_ids.get(s.type.id, s.type.id), RelationType)
         if not rt:
             # The annotation type does not exist. Create it.
             rt=self.copy_relation_type(helper.get_id(self.source.relationTypes,
@@ -568,7 +718,7 @@ class Differ:
             if i in self.translated_ids:
                 i=self.translated_ids[i]
 
-            a=helper.get_id(self.destination.annotations, i)
+            a=self.destination_index.get(i, Annotation)
             if not a:
                 a=self.copy_annotation(sa)
             members.append(a)
@@ -584,10 +734,11 @@ class Differ:
         for (namespace, name, value) in s.listMetaData():
             el.setMetaData(namespace, name, value)
         #el.title=s.title or ''
+        self.destination_index.add(el)
         return el
 
     def copy_query(self, s, generate_id=False):
-        if generate_id or self.destination.get_element_by_id(s.id):
+        if generate_id or self.destination_index.get(s.id):
             id_=self.destination._idgenerator.get_id(Query)
         else:
             id_ = s.id
@@ -604,10 +755,11 @@ class Differ:
         for (namespace, name, value) in s.listMetaData():
             el.setMetaData(namespace, name, value)
         self.destination.queries.append(el)
+        self.destination_index.add(el)
         return el
 
     def copy_view(self, s, generate_id=False):
-        if generate_id or self.destination.get_element_by_id(s.id):
+        if generate_id or self.destination_index.get(s.id):
             id_=self.destination._idgenerator.get_id(View)
         else:
             id_ = s.id
@@ -630,6 +782,7 @@ class Differ:
         for (namespace, name, value) in s.listMetaData():
             el.setMetaData(namespace, name, value)
         self.destination.views.append(el)
+        self.destination_index.add(el)
         return el
 
     def create_resource(self, s, d):
@@ -652,11 +805,156 @@ class Differ:
                 return
         shutil.copyfile(source_name, destination_name)
 
-def merge_package(refname, to_be_merged, outputname=None, debug=False, dry_run=False, include=None, exclude=None, callback=None):
+def comparable_value(value):
+    """Return a representation of value suitable for comparison across packages.
+
+    Elements are represented by their id.
+    """
+    if value is None or isinstance(value, (str, bytes, int, float, dict)):
+        return value
+    if hasattr(value, 'id'):
+        return value.id
+    try:
+        return tuple(comparable_value(v) for v in value)
+    except TypeError:
+        return value
+
+class ThreeWayDiffer(Differ):
+    """Returns a structure diff of two packages against a common ancestor.
+
+    Only the changes made in the source package since the ancestor
+    are considered, so that modifications done in the destination
+    package are preserved. Changes made on both sides with different
+    values are returned with a C{conflict_} prefix, for instance
+    C{conflict_update_content}. Their action applies the source
+    version.
+
+    Elements (annotations, relations, views, queries) deleted from
+    the source package are deleted from the destination package,
+    unless they were modified there.
+
+    @ivar ancestor: the common ancestor package
+    @ivar ancestor_index: the L{PackageIndex} of the ancestor package
+    """
+    def __init__(self, source=None, destination=None, ancestor=None, controller=None, destination_index=None):
+        super().__init__(source, destination, controller, destination_index)
+        self.ancestor = ancestor
+        self.ancestor_index = PackageIndex(ancestor)
+
+    def diff(self):
+        return itertools.chain(self.filter_changes(super().diff()),
+                               self.diff_deletions())
+
+    def candidates(self, elements, cls):
+        """Return the source elements which may differ from the destination.
+
+        Elements which are identical in the ancestor (i.e. not
+        modified in the source) are also left out.
+        """
+        unchanged = (self.signatures(self.destination_index, cls)
+                     | self.signatures(self.ancestor_index, cls))
+        return [ el for el in elements if (el.id, self.digest(el)) not in unchanged ]
+
+    def ancestor_element(self, s):
+        """Return the ancestor version of the source element s.
+        """
+        if s is self.source:
+            return self.ancestor
+        return self.ancestor_index.get(s.id, type(s))
+
+    def filter_changes(self, changes):
+        """Filter a two-way changelist against the ancestor.
+        """
+        for change in changes:
+            name, s, d, action, value = change
+            if isinstance(s, str):
+                # Resources
+                yield change
+                continue
+            b = self.ancestor_element(s)
+            if b is None:
+                # Element created in the source (or created with the
+                # same id on both sides): keep the two-way behaviour.
+                yield change
+            elif name in ('new', 'new_annotation', 'new_relation'):
+                if d is None and b is not None:
+                    # Deleted in the destination.
+                    if self.digest(s) != self.ancestor_index.digest(b):
+                        yield ('conflict_%s' % name, s, d, action, value)
+                else:
+                    yield change
+            else:
+                sv = comparable_value(value(s))
+                bv = comparable_value(value(b))
+                if sv == bv:
+                    # Not modified in the source.
+                    continue
+                if comparable_value(value(d)) == bv:
+                    yield change
+                else:
+                    yield ('conflict_%s' % name, s, d, action, value)
+
+    def diff_deletions(self):
+        """Iterator returning the deletions of elements.
+
+        Relations are deleted before annotations.
+        """
+        for cls, elements in ( (Relation, self.source.relations),
+                               (Annotation, self.source.annotations),
+                               (View, self.source.views),
+                               (Query, self.source.queries) ):
+            deleted = (set(b.id for b in self.ancestor_index.values(cls))
+                       - set(e.id for e in elements))
+            for b in self.ancestor_index.values(cls):
+                if b.id not in deleted:
+                    continue
+                d = self.destination_index.get(b.id, cls)
+                if d is None:
+                    # Deleted on both sides
+                    continue
+                if self.destination_index.digest(d) == self.ancestor_index.digest(b):
+                    name = 'delete'
+                else:
+                    name = 'conflict_delete'
+                yield (name, None, d,
+                       lambda s, d: self.delete_element(d),
+                       lambda e: str(e))
+
+    def delete_element(self, d):
+        """Delete the element from the destination package.
+        """
+        if isinstance(d, Annotation) and d.relations:
+            # Relations added in the destination
+            logger.warning(_("Cannot delete annotation %s: it is used in relations"), d.id)
+            return
+        if self.controller is not None:
+            self.controller.delete_element(d)
+        elif isinstance(d, Annotation):
+            self.destination.annotations.remove(d)
+        elif isinstance(d, Relation):
+            for a in d.members:
+                if d in a.relations:
+                    a.relations.remove(d)
+            self.destination.relations.remove(d)
+        elif isinstance(d, View):
+            self.destination.views.remove(d)
+        elif isinstance(d, Query):
+            self.destination.queries.remove(d)
+        self.destination_index.remove(d)
+        self.destination._idgenerator.remove(d.id)
+
+def merge_package(refname, to_be_merged, outputname=None, debug=False, dry_run=False, include=None, exclude=None, callback=None, ancestor=None, conflicts='destination'):
     """Merge packages to_be_merged into refname, producing outputname.
 
     refname can be either a package or a package URI/path.
 
+    If ancestor (a package or a package URI/path) is specified, then
+    a three-way merge is done: only the changes made in the merged
+    packages since the ancestor are applied, and elements deleted
+    from them are deleted. conflicts specifies which version is kept
+    when an element was modified on both sides: 'destination' (the
+    default) or 'source'.
+
     If include is specified, then it is a list of the only action names that should be merged.
 
     If exclude is specified, then it is a dict of the action names
@@ -700,30 +998,50 @@ def merge_package(refname, to_be_merged, outputname=None, debug=False, dry_run=F
     else:
         dest = Package(uri=refname)
 
+    if ancestor is not None and not isinstance(ancestor, Package):
+        ancestor = Package(uri=ancestor)
+
+    # The id generator and the destination index are kept
+    # up-to-date by the differs, so they are shared by all sources.
+    dest._idgenerator = Generator(dest)
+    index = PackageIndex(dest)
+
     todo = []
     incr = 1. / len(to_be_merged)
     progress = 0
     for sourcename in to_be_merged:
         if callback(progress, _("Processing %s") % sourcename) is False:
             break
-        # Reset id generator
-        dest._idgenerator = Generator(dest)
-        source = Package(uri=sourcename)
-        differ = Differ(source, dest)
+        if isinstance(sourcename, Package):
+            source = sourcename
+        else:
+            source = Package(uri=sourcename)
+        if ancestor is None:
+            differ = Differ(source, dest, destination_index=index)
+        else:
+            differ = ThreeWayDiffer(source, dest, ancestor, destination_index=index)
         diff = differ.diff()
         if debug:
             breakpoint()
         for name, s, d, action, value in diff:
-            if include and name not in include:
+            conflict = name.startswith('conflict_')
+            # Include/exclude rules apply to conflicts as well
+            action_name = name[9:] if conflict else name
+            if include and action_name not in include:
                 continue
-            if name in exclude and filters[exclude[name]](d):
+            if action_name in exclude and filters[exclude[action_name]](d):
                 continue
-            if callback(progress, "%s %s : %s -> %s" % (name, getattr(s, 'id', str(s)),
+            if callback(progress, "%s %s : %s -> %s" % (name, getattr(s or d, 'id', str(s)),
                                                         str(value(d or ""))[:100].replace('\n', '\\n'), str(value(s or ""))[:100].replace('\n', '\\n'))) is False:
                 break
+            if conflict and conflicts != 'source':
+                # Keep the destination version
+                continue
             todo.append((source, name, s, d, action))
             if not dry_run:
                 action(s, d)
+                if d is not None:
+                    index.invalidate(d)
         progress += incr
     if outputname is not None and not dry_run:
         dest.save(outputname)
@@ -738,6 +1056,10 @@ if __name__ == "__main__":
     parser.add_argument('-o', '--output-package', default="/tmp/merged.xml")
     parser.add_argument('--include', action="store", default="")
     parser.add_argument('--exclude', action="store", default="")
+    parser.add_argument('-a', '--ancestor', action="store", default=None,
+                        help="Common ancestor package, for a three-way merge")
+    parser.add_argument('--conflicts', choices=('destination', 'source'), default='destination',
+                        help="Version to keep for elements modified on both sides (three-way merge)")
     parser.add_argument('reference_package')
     parser.add_argument('other_packages', nargs='*', default='/tmp/merged.xml')
     args = parser.parse_args(saved_args)
@@ -749,4 +1071,4 @@ if __name__ == "__main__":
         exclude = dict( (arg.split('=', 1) if '=' in arg else (arg, 'all'))
                         for arg in args.exclude.split(':'))
 
-    merge_package(args.reference_package, args.other_packages, args.output_package, debug=args.debug, dry_run=args.dry_run, include=include, exclude=exclude)
+    merge_package(args.reference_package, args.other_packages, args.output_package, debug=args.debug, dry_run=args.dry_run, include=include, exclude=exclude, ancestor=args.ancestor, conflicts=args.conflicts)
@@ -100,6 +100,15 @@ class Snapshotter:
         self.thread_running=False
         self.should_clear = False
 
+        # Optional advene.util.keyframeindex.KeyframeIndex of the
+        # media. If set, snapshots located after the current frame in
+        # the same GOP are taken by stepping frames instead of seeking.
+        self.keyframes = None
+        # pts (in ms) of the last captured frame
+        self.position = None
+        # Requested timestamp, when stepping
+        self.step_target = None
+
         # Pipeline building
         self.videobin = Gst.Bin()
         self.videobin.set_name('videosink')
@@ -151,6 +160,8 @@ class Snapshotter:
 
     def set_uri(self, uri):
         logger.debug("set_uri %s", uri)
+        self.keyframes = None
+        self.position = None
         if uri:
             self.player.set_state(Gst.State.NULL)
             self.player.set_property('uri', uri)
@@ -207,6 +218,14 @@ class Snapshotter:
     def snapshot(self, t):
         """Set movie time to a specific time.
         """
+        keyframes = self.keyframes
+        n = keyframes.frame_steps(self.position, t) if keyframes is not None else None
+        if n:
+            logger.debug("Stepping %d frames to %d", n, t)
+            self.step_target = t
+            if self.player.send_event(Gst.Event.new_step(Gst.Format.BUFFERS, n, 1.0, True, False)):
+                return True
+            self.step_target = None
         p = int(t * Gst.MSECOND)
         logger.debug("Seeking to %d", t)
         self.player.set_state(Gst.State.PAUSED)
@@ -269,13 +288,16 @@ class Snapshotter:
                 logger.warning("Error in converting buffer")
                 res = None
             else:
-                pos = element.query_position(Gst.Format.TIME)[1]
+                pos = element.query_position(Gst.Format.TIME)[1] / Gst.MSECOND
+                if self.step_target is not None:
+                    # Report the requested timestamp, like for an accurate seek
+                    pos = self.step_target
                 data = bytes(mapinfo.data)
                 if data[:8] == b'\x89PNG\r\n\x1a\n'and data[12:16] == b'IHDR':
                     w, h = struct.unpack('>LL', data[16:24])
                     self.notify({
                         "data": data,
-                        'date': pos / Gst.MSECOND,
+                        'date': pos,
                         "pts": buf.pts / Gst.MSECOND,
                         'media': self.get_uri(),
                         'type': 'PNG',
@@ -284,6 +306,8 @@ class Snapshotter:
                     })
                 else:
                     logger.error("Invalid PNG data in snapshot output %s", data)
+        self.step_target = None
+        self.position = buf.pts / Gst.MSECOND if buf.pts != Gst.CLOCK_TIME_NONE else None
         # We are ready to process the next snapshot
         self.snapshot_ready.set()
         return True
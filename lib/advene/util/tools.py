@@ -23,8 +23,10 @@ import logging
 logger = logging.getLogger(__name__)
 
 import codecs
+import contextlib
 import datetime
 import functools
+import itertools
 import json
 from pathlib import Path
 try:
@@ -36,6 +38,7 @@ import re
 import shutil
 import subprocess
 import sys
+import threading
 import urllib.request
 from urllib.parse import urlparse, unquote
 from urllib.request import urlopen
@@ -378,6 +381,74 @@ class CircularList(list):
         self._index = (self._index - 1) % len(self)
         return self.current()
 
+class RWLock:
+    """Readers-writer lock.
+
+    Any number of readers can hold the lock at the same time, while a
+    writer has exclusive access. Waiting writers have priority over
+    new readers, so that they do not starve. The writer lock is
+    reentrant, and its owner thread can also acquire the reader
+    lock.
+
+    Usage:
+    with lock.reader():
+        ...
+    with lock.writer():
+        ...
+    """
+    def __init__(self):
+        self._cond = threading.Condition(threading.Lock())
+        self._readers = 0
+        self._writer = None
+        self._writer_depth = 0
+        self._pending_writers = 0
+
+    @contextlib.contextmanager
+    def reader(self):
+        me = threading.get_ident()
+        with self._cond:
+            if self._writer != me:
+                while self._writer is not None or self._pending_writers:
+                    self._cond.wait()
+                self._readers += 1
+        try:
+            yield self
+        finally:
+            if self._writer != me:
+                with self._cond:
+                    self._readers -= 1
+                    if not self._readers:
+                        self._cond.notify_all()
+
+    @contextlib.contextmanager
+    def writer(self):
+        me = threading.get_ident()
+        with self._cond:
+            if self._writer != me:
+                self._pending_writers += 1
+                while self._writer is not None or self._readers:
+                    self._cond.wait()
+                self._pending_writers -= 1
+                self._writer = me
+            self._writer_depth += 1
+        try:
+            yield self
+        finally:
+            with self._cond:
+                self._writer_depth -= 1
+                if not self._writer_depth:
+                    self._writer = None
+                    self._cond.notify_all()
+
+# Package revisions are taken from a process-wide counter, so that
+# a reloaded package never reuses the revision of a previous one.
+_revisions = itertools.count(1)
+
+def next_revision():
+    """Return a new package revision number.
+    """
+    return next(_revisions)
+
 # Element-tree indent function.
 # in-place prettyprint formatter
 def indent(elem, level=0):
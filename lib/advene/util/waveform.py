@@ -0,0 +1,242 @@
+#
+# Advene: Annotate Digital Videos, Exchange on the NEt
+# Copyright (C) 2025 Olivier Aubert <contact@olivieraubert.net>
+#
+# Advene is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# Advene is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Advene; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+#
+"""Waveform peak pyramid.
+
+A peak pyramid stores the min/max sample values of an audio track over
+buckets of C{base} samples (level 0), then over buckets of
+C{base * 2**n} samples (level n), until a single bucket covers the
+whole track. Any time range can then be displayed at any width by
+reading about C{width} buckets from the appropriate level.
+
+Pyramids are cached per media in the C{waveforms} folder of the
+settings directory, as a .npy file (memory-mapped when loaded) and a
+.json metadata file. They are built by the sound enveloppe importer
+(see L{advene.plugins.soundenveloppe}).
+
+It requires numpy.
+"""
+
+import logging
+logger = logging.getLogger(__name__)
+
+import json
+import math
+import os
+from pathlib import Path
+
+import numpy
+
+import advene.core.config as config
+from advene.util.mediainfo import media_key
+
+# Format version of the cache files
+VERSION = 1
+
+# Scale factor of the stored int16 values
+SCALE = 32767
+
+# Minimum number of buckets per pixel used for envelope queries
+PIXEL_BUCKETS = 4
+
+def cache_filename(mediafile):
+    """Return the cache filename (without extension) for a media file, or None.
+    """
+    key = media_key(mediafile)
+    if key is None:
+        return None
+    return Path(config.data.advenefile('waveforms', 'settings')) / key
+
+class PeakPyramid:
+    """Multi-resolution min/max envelope of an audio track.
+
+    @ivar data: a (buckets, 2) int16 array holding all levels
+    @ivar sample_rate: the sample rate (in Hz)
+    @ivar base: the number of samples of level 0 buckets
+    @ivar offsets: the offset of each level in data
+    @ivar counts: the number of buckets of each level
+    @ivar samples: the total number of samples
+    @ivar start: the timestamp (in ms) of the first sample
+    """
+    def __init__(self, data, sample_rate, base, offsets, counts, samples, start=0):
+        self.data = data
+        self.sample_rate = sample_rate
+        self.base = base
+        self.offsets = offsets
+        self.counts = counts
+        self.samples = samples
+        self.start = start
+
+    @property
+    def duration(self):
+        """Duration in ms.
+        """
+        return self.samples * 1000 / self.sample_rate
+
+    def level(self, index):
+        """Return the (min, max) buckets of a level.
+        """
+        return self.data[self.offsets[index]:self.offsets[index] + self.counts[index]]
+
+    def envelope(self, begin, end, width):
+        """Return the envelope of the [begin, end] range, at the given width.
+
+        Only the buckets of the level whose bucket size is about a
+        quarter of the pixel size are read, so that the cost is
+        proportional to the width. A pixel value covers all the
+        buckets overlapping the pixel.
+
+        @param begin: the begin time (in ms)
+        @param end: the end time (in ms)
+        @param width: the number of values (pixels)
+        @return: a tuple of (mins, maxs) float32 arrays of size width, with values in [-1, 1]
+        """
+        width = int(width)
+        mins = numpy.zeros(width, dtype=numpy.float32)
+        maxs = numpy.zeros(width, dtype=numpy.float32)
+        if width <= 0 or end <= begin or not self.counts:
+            return mins, maxs
+        first = (begin - self.start) * self.sample_rate / 1000
+        samples_per_pixel = (end - begin) * self.sample_rate / 1000 / width
+        level = int(math.floor(math.log2(max(samples_per_pixel / PIXEL_BUCKETS / self.base, 1))))
+        level = min(level, len(self.counts) - 1)
+        bucket = self.base * 2 ** level
+        buckets = self.level(level)
+        n = len(buckets)
+
+        positions = (first + numpy.arange(width + 1) * samples_per_pixel) / bucket
+        # First and last bucket of each pixel. A bucket overlapping
+        # two pixels is used for both.
+        starts = numpy.floor(positions[:-1]).astype(numpy.int64)
+        lasts = numpy.maximum(numpy.ceil(positions[1:]).astype(numpy.int64) - 1, starts)
+        valid = (starts >= 0) & (starts < n)
+        if not valid.any():
+            return mins, maxs
+        starts, lasts = starts[valid], lasts[valid]
+        lo = int(starts[0])
+        hi = int(min(lasts[-1] + 1, n))
+        data = numpy.asarray(buckets[lo:hi])
+        indices = starts - lo
+        lasts = (lasts - lo).clip(max=len(data) - 1)
+        mins[valid] = numpy.minimum(numpy.minimum.reduceat(data[:, 0], indices), data[lasts, 0]) / SCALE
+        maxs[valid] = numpy.maximum(numpy.maximum.reduceat(data[:, 1], indices), data[lasts, 1]) / SCALE
+        return mins, maxs
+
+    def save(self, filename):
+        """Save the pyramid.
+
+        @param filename: the filename, without extension
+        """
+        filename = Path(filename)
+        filename.parent.mkdir(parents=True, exist_ok=True)
+        # Write to temporary files, so that readers never see partial data
+        tmp = filename.with_name(filename.name + '.tmp.npy')
+        numpy.save(tmp, numpy.asarray(self.data, dtype=numpy.int16))
+        meta = filename.with_name(filename.name + '.tmp.json')
+        with open(meta, 'w', encoding='utf-8') as f:
+            json.dump({ 'version': VERSION,
+                        'sample_rate': self.sample_rate,
+                        'base': self.base,
+                        'offsets': self.offsets,
+                        'counts': self.counts,
+                        'samples': self.samples,
+                        'start': self.start }, f)
+        os.replace(tmp, filename.with_suffix('.npy'))
+        os.replace(meta, filename.with_suffix('.json'))
+
+    @classmethod
+    def load(cls, filename):
+        """Load a pyramid, memory-mapping its data.
+
+        @param filename: the filename, without extension
+        @return: the pyramid, or None if it is not available
+        """
+        filename = Path(filename)
+        try:
+            with open(filename.with_suffix('.json'), encoding='utf-8') as f:
+                meta = json.load(f)
+            if meta.get('version') != VERSION:
+                return None
+            data = numpy.load(filename.with_suffix('.npy'), mmap_mode='r')
+        except (OSError, ValueError):
+            return None
+        return cls(data, meta['sample_rate'], meta['base'], meta['offsets'], meta['counts'],
+                   meta['samples'], meta.get('start', 0))
+
+def get_pyramid(mediafile):
+    """Return the cached pyramid for a media file, or None.
+    """
+    filename = cache_filename(mediafile)
+    if filename is None:
+        return None
+    return PeakPyramid.load(filename)
+
+class PeakPyramidBuilder:
+    """Build a peak pyramid from audio samples.
+
+    Samples are reduced to level 0 buckets as they are fed, so that
+    memory usage is proportional to the number of buckets.
+    """
+    def __init__(self, sample_rate, base=64):
+        self.sample_rate = sample_rate
+        self.base = base
+        self.start = None
+        self.samples = 0
+        self._pending = numpy.zeros(0, dtype=numpy.float32)
+        self._buckets = []
+
+    def feed(self, samples, timestamp=None):
+        """Process mono samples.
+
+        @param samples: a 1-D array of float samples, in [-1, 1]
+        @param timestamp: the timestamp (in ms) of the samples. Only the first one is used.
+        """
+        if self.start is None:
+            self.start = timestamp or 0
+        self.samples += len(samples)
+        if len(self._pending):
+            samples = numpy.concatenate((self._pending, samples))
+        n = len(samples) // self.base
+        if n:
+            self.add_buckets(samples[:n * self.base].reshape(n, self.base))
+        self._pending = numpy.array(samples[n * self.base:], dtype=numpy.float32)
+
+    def add_buckets(self, blocks):
+        values = numpy.empty((len(blocks), 2), dtype=numpy.int16)
+        values[:, 0] = (numpy.clip(blocks.min(axis=1), -1, 1) * SCALE).round()
+        values[:, 1] = (numpy.clip(blocks.max(axis=1), -1, 1) * SCALE).round()
+        self._buckets.append(values)
+
+    def finish(self):
+        """Return the pyramid.
+        """
+        if len(self._pending):
+            self.add_buckets(self._pending.reshape(1, -1))
+            self._pending = self._pending[:0]
+        level = numpy.concatenate(self._buckets) if self._buckets else numpy.zeros((0, 2), dtype=numpy.int16)
+        levels = [ level ]
+        while len(level) > 1:
+            if len(level) % 2:
+                level = numpy.concatenate((level, level[-1:]))
+            pairs = level.reshape(-1, 2, 2)
+            level = numpy.stack((pairs[:, :, 0].min(axis=1), pairs[:, :, 1].max(axis=1)), axis=1)
+            levels.append(level)
+        counts = [ len(l) for l in levels ]
+        offsets = [ int(o) for o in numpy.cumsum([ 0 ] + counts[:-1]) ]
+        return PeakPyramid(numpy.concatenate(levels), self.sample_rate, self.base,
+                           offsets, counts, self.samples, self.start or 0)
@@ -23,10 +23,14 @@ logger = logging.getLogger(__name__)
 
 from gettext import gettext as _
 
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
+import json
 import os
 from pathlib import Path
 import time
 import re
+import threading
 import urllib.request, urllib.parse, urllib.error
 import mimetypes
 import shutil
@@ -43,6 +47,103 @@ tales_re              = re.compile(r'(\w+)/(.+)')
 player_re             = re.compile(r'/media/play(/|\?position=)(?P<begin>\d+)(/(?P<end>\d+))?')
 overlay_re            = re.compile(r'/media/overlay/([^/]+)/([\w\d]+)(/.+)?')
 
+# Name of the manifest file, stored in the output directory
+MANIFEST_NAME = '.advene-website.json'
+
+def parse_links(content):
+    """Split content into text and link segments, in a single pass.
+
+    Return a (segments, links) tuple. segments is a list where text
+    parts are strings and links are (attribute name, link) tuples, so
+    that the content can be rebuilt once links are translated. links
+    is the list of (attribute name, link) tuples.
+    """
+    segments = []
+    links = []
+    pos = 0
+    for m in href_re.finditer(content):
+        segments.append(content[pos:m.start()])
+        link = (m.group('name'), m.group('link'))
+        segments.append(link)
+        links.append(link)
+        pos = m.end()
+    segments.append(content[pos:])
+    return segments, links
+
+class ExportManifest:
+    """Manifest of the files generated by a website export.
+
+    It records the hash of each generated file (relative to the
+    output directory). On re-export, all pages are rendered again,
+    but files whose content did not change are not rewritten, and
+    files which are no longer generated are removed.
+
+    Its methods can be called from multiple threads.
+
+    @ivar written: the number of written files
+    @ivar skipped: the number of unchanged (not rewritten) files
+    """
+    def __init__(self, directory, full=False):
+        self.directory = Path(directory)
+        self.path = self.directory / MANIFEST_NAME
+        self.full = full
+        self.files = {}
+        self.written = 0
+        self.skipped = 0
+        self.lock = threading.Lock()
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                self.previous = json.load(f).get('files', {})
+        except (OSError, ValueError, AttributeError):
+            self.previous = {}
+
+    def write(self, name, data):
+        """Write data to the given file, unless it is unchanged.
+
+        @param name: the filename, relative to the output directory
+        @param data: the data
+        @type data: bytes
+        @return: True if the file was written
+        """
+        digest = hashlib.sha1(data).hexdigest()
+        path = self.directory / name
+        with self.lock:
+            if name in self.files:
+                # Already generated during this export
+                return False
+            self.files[name] = digest
+            unchanged = (not self.full
+                         and self.previous.get(name) == digest
+                         and path.exists())
+            if unchanged:
+                self.skipped += 1
+            else:
+                self.written += 1
+        if unchanged:
+            return False
+        d = path.parent
+        if not d.is_dir():
+            d.mkdir(parents=True, exist_ok=True)
+        with open(path, 'wb') as f:
+            f.write(data)
+        return True
+
+    def remove_stale_files(self):
+        """Remove the files generated by the previous export which were not generated this time.
+        """
+        for name in set(self.previous).difference(self.files):
+            path = self.directory / name
+            try:
+                path.unlink()
+                logger.debug("Removed stale file %s", path)
+            except OSError:
+                pass
+
+    def save(self):
+        with open(self.path, 'w', encoding='utf-8') as f:
+            json.dump({ 'version': 1,
+                        'files': self.files }, f, indent=1, sort_keys=True)
+
 @register_exporter
 class WebsiteExporter(GenericExporter):
     """Export a set of static views to a directory.
@@ -69,6 +170,8 @@ class WebsiteExporter(GenericExporter):
         self.video_url = (self.controller.package and self.controller.package.getMetaData(config.data.namespace, "media_uri")) or ""
         self.depth = 3
         self.views = ""
+        self.full = False
+        self.workers = min(4, os.cpu_count() or 1)
 
         self.optionparser.add_option("-u", "--video-url",
                                      type="string",
@@ -91,6 +194,19 @@ class WebsiteExporter(GenericExporter):
                                      default=self.views,
                                      help=_("Comma-separated list of views to export - leave blank for all views"))
 
+        self.optionparser.add_option("-f", "--full",
+                                     action="store_true",
+                                     dest="full",
+                                     default=self.full,
+                                     help=_("Rewrite all files, even if they did not change since the last export"))
+
+        self.optionparser.add_option("-w", "--workers",
+                                     action="store",
+                                     type="int",
+                                     dest="workers",
+                                     default=self.workers,
+                                     help=_("Number of pages rendered in parallel"))
+
     def find_video_player(self, video_url):
         p=None
         # FIXME: module introspection here to get classes
@@ -114,6 +230,9 @@ class WebsiteExporter(GenericExporter):
 
     def get_contents(self, url):
         """Return the contents of the given view.
+
+        It is called from worker threads, so the view is rendered
+        while holding the model reader lock.
         """
         # Handle fragments
         m = fragment_re.search(url)
@@ -134,38 +253,45 @@ class WebsiteExporter(GenericExporter):
             # No match. Do not try to retrieve
             return None
 
-        # Generate the view
-        ctx = self.controller.build_context()
-        try:
-            content = ctx.evaluateValue('here/%s' % address)
-        except Exception:
-            logger.error("Exception when evaluating %s", address, exc_info=True)
-            content = None
-
-        if not isinstance(content, str):
-            # Not a string. Could be an Advene element
+        with self.controller.model_lock.reader():
+            # Generate the view
+            ctx = self.controller.build_context()
             try:
-                c = content.view(context=self.controller.build_context(here=content))
-                content = c
-            except AttributeError:
-                # Apparently not. Fallback on explicit string conversion.
-                content = str(content)
+                content = ctx.evaluateValue('here/%s' % address)
+            except Exception:
+                logger.error("Exception when evaluating %s", address, exc_info=True)
+                content = None
+
+            if not isinstance(content, str):
+                # Not a string. Could be an Advene element
+                try:
+                    c = content.view(context=self.controller.build_context(here=content))
+                    content = c
+                except AttributeError:
+                    # Apparently not. Fallback on explicit string conversion.
+                    content = str(content)
         return content
 
-    def translate_links(self, content, baseurl=None, max_depth_exceeded=False):
+    def translate_links(self, content, baseurl=None, max_depth_exceeded=False, links=None):
         """Translate links from the given content.
 
         This method updates self.url_translation.
 
+        links is the list of (attribute name, link) tuples from
+        content, as returned by parse_links. It is computed if not
+        given.
+
         It returns a list of URLs that should be processed in the next stage (depth+1).
         """
+        if links is None:
+            links = parse_links(content)[1]
         res = set()
         used_snapshots = set()
         used_overlays = set()
         used_resources = set()
 
         # Convert all links
-        for (attname, url) in href_re.findall(content):
+        for (attname, url) in links:
             if url in self.url_translation:
                 # Translation already done.
                 continue
@@ -309,13 +435,18 @@ class WebsiteExporter(GenericExporter):
             res=set()
         return res, used_snapshots, used_overlays, used_resources
 
-    def fix_links(self, content):
+    def fix_links(self, content, segments=None):
         """Transform contents in order to fix links.
+
+        segments is the split content, as returned by
+        parse_links. It is computed if not given.
         """
         # Avoid messing with JSON data
-        content = content.strip()
-        if content.startswith('{') or content.startswith('[') or content.startswith('"'):
-            return content
+        stripped = content.strip()
+        if stripped.startswith('{') or stripped.startswith('[') or stripped.startswith('"'):
+            return stripped
+        if segments is None:
+            segments = parse_links(content)[0]
         # Replace /media/play links (most frequent)
 
         def translation(name, link):
@@ -354,31 +485,45 @@ class WebsiteExporter(GenericExporter):
             return f'{extra_string} {name}="{translated_link}"'
 
         # Replace all links
-        content = href_re.sub(lambda m: translation(m.group('name'), m.group('link')), content)
+        content = "".join(segment if isinstance(segment, str) else translation(*segment)
+                          for segment in segments).strip()
 
         # Inject additional js/html code
         content = self.video_player.transform_document(content)
 
         return content
 
-    def write_data(self, url, content, used_snapshots, used_overlays, used_resources):
-        """Write the converted content as well as associated data.
+    def write_page(self, url, content, used_snapshots, used_resources):
+        """Write the converted content, snapshots and resources.
+
+        Unchanged files are not rewritten. This method can be called
+        from worker threads.
         """
         # Write the content.
         output = self.url_translation[url]
-        with open(self.output / output, 'w', encoding='utf-8') as f:
-            f.write(content)
-
-        if not self.imgdir.is_dir():
-            self.imgdir.mkdir(parents=True)
+        self.manifest.write(output, content.encode('utf-8'))
 
         # Copy snapshots
         for t in used_snapshots:
             # FIXME: not robust wrt. multiple packages/videos
-            with open(self.imgdir / f'{t}.png', 'wb') as f:
-                f.write(bytes(self.controller.package.imagecache[t]))
+            self.manifest.write(f'imagecache/{t}.png', bytes(self.controller.package.imagecache[t]))
 
-        # Copy overlays
+        # Copy resources
+        for path in used_resources:
+            r = self.controller.package.resources
+            for element in path.split('/'):
+                r = r[element]
+
+            data = r.data
+            if isinstance(data, str):
+                data = data.encode('utf-8')
+            self.manifest.write(f'resources/{path}', data)
+
+    def write_overlays(self, used_overlays):
+        """Write the overlayed snapshots.
+
+        It uses the GUI, so it must be called from the main thread.
+        """
         for (ident, tales) in used_overlays:
             # FIXME: not robust wrt. multiple packages/videos
             a = self.controller.package.get_element_by_id(ident)
@@ -392,29 +537,11 @@ class WebsiteExporter(GenericExporter):
                 data = ctx.evaluateValue('here' + tales)
             else:
                 data = a.content.data
-            with open(os.path.join(self.imgdir, 'overlay_%s.png' % name), 'wb') as f:
-                try:
-                    f.write(self.controller.gui.overlay(self.controller.package.imagecache[a.fragment.begin], data))
-                except TypeError:
-                    logger.exception("Error when trying to export overlayed thumbnail")
-
-        # Copy resources
-        for path in used_resources:
-            dest = self.output / 'resources' / path
-
-            d = dest.parent
-            if not d.is_dir():
-                d.mkdir(parents=True)
-
-            r = self.controller.package.resources
-            for element in path.split('/'):
-                r = r[element]
-
-            data = r.data
-            if isinstance(data, str):
-                data = data.encode('utf-8')
-            with open(dest, 'wb') as output:
-                output.write(data)
+            try:
+                self.manifest.write(f'imagecache/overlay_{name}.png',
+                                    self.controller.gui.overlay(self.controller.package.imagecache[a.fragment.begin], data))
+            except TypeError:
+                logger.exception("Error when trying to export overlayed thumbnail")
 
     def check_requirements(self):
         self.output = Path(self.output)
@@ -460,6 +587,7 @@ class WebsiteExporter(GenericExporter):
 
         self.video_player = self.find_video_player(self.video_url)
         self.url_translation = {}
+        self.manifest = ExportManifest(self.output, full=self.full)
 
     def export(self, filename=None):
         # The filename parameter is the output dir
@@ -504,35 +632,53 @@ class WebsiteExporter(GenericExporter):
 
         links_to_be_processed = list(view_url.values())
 
-        while depth <= self.depth:
-            max_depth_exceeded = (depth == self.depth)
-            step = main_step / (len(links_to_be_processed) or 1)
-            if not self.callback(progress, _("Depth %d") % depth):
-                return
-            links = set()
-            for url in links_to_be_processed:
-                if not self.callback(progress, _("Depth %(depth)d: processing %(url)s") % locals()):
+        with ThreadPoolExecutor(max_workers=max(1, self.workers),
+                                thread_name_prefix="website-export") as executor:
+            while depth <= self.depth:
+                max_depth_exceeded = (depth == self.depth)
+                step = main_step / (len(links_to_be_processed) or 1)
+                if not self.callback(progress, _("Depth %d") % depth):
                     return
-                progress += step
-                content = self.get_contents(url)
-
-                (new_links,
-                 used_snapshots,
-                 used_overlays,
-                 used_resources) = self.translate_links(content,
-                                                        url,
-                                                        max_depth_exceeded)
-                links.update(new_links)
-
-                # Write contents
-                self.write_data(url,
-                                self.fix_links(content),
-                                used_snapshots,
-                                used_overlays,
-                                used_resources)
-
-            links_to_be_processed = links
-            depth += 1
+                links = set()
+                pages = []
+                # Pages of the same depth are independent: render
+                # them in parallel. Link translation updates
+                # self.url_translation, so it is done sequentially.
+                for url, content in zip(links_to_be_processed,
+                                        executor.map(self.get_contents, links_to_be_processed)):
+                    if not self.callback(progress, _("Depth %(depth)d: processing %(url)s") % locals()):
+                        return
+                    progress += step
+                    if content is None:
+                        continue
+                    segments, page_links = parse_links(content)
+                    (new_links,
+                     used_snapshots,
+                     used_overlays,
+                     used_resources) = self.translate_links(content,
+                                                            url,
+                                                            max_depth_exceeded,
+                                                            links=page_links)
+                    links.update(new_links)
+                    pages.append( (url, content, segments, used_snapshots, used_resources) )
+                    self.write_overlays(used_overlays)
+
+                # Fix links and write contents
+                def write(page):
+                    url, content, segments, used_snapshots, used_resources = page
+                    self.write_page(url,
+                                    self.fix_links(content, segments),
+                                    used_snapshots,
+                                    used_resources)
+                for _res in executor.map(write, pages):
+                    pass
+
+                links_to_be_processed = list(links)
+                depth += 1
+
+        self.manifest.remove_stale_files()
+        self.manifest.save()
+        logger.info("Website export: %d files written, %d unchanged files", self.manifest.written, self.manifest.skipped)
 
         if not self.callback(0.95, _("Finalizing")):
             return
@@ -1,33 +1,44 @@
-#!/usr/bin/python
+#!/usr/bin/python3
 
 import logging
 logger = logging.getLogger(__name__)
 
-import BaseHTTPServer
+import http.server
 import itertools
 import json
 import random
-import urlparse
+import urllib.parse
 
 CONCEPT_LIST = [ "dog", "cat", "bird", "tree", "human" ]
 
 HOST_NAME = 'localhost'
 PORT_NUMBER = 9000
 
-class RESTHandler(BaseHTTPServer.BaseHTTPRequestHandler):
-    def do_HEAD(s):
-        s.send_response(200)
+MAXIMUM_BATCH_SIZE = 500
+
+class RESTHandler(http.server.BaseHTTPRequestHandler):
+    # Use persistent connections
+    protocol_version = 'HTTP/1.1'
+
+    def send_json(s, data, status=200):
+        body = json.dumps(data).encode()
+        s.send_response(status)
         s.send_header("Content-type", "application/json")
+        s.send_header("Content-Length", str(len(body)))
         s.end_headers()
+        s.wfile.write(body)
 
-    def do_GET(s):
+    def do_HEAD(s):
         s.send_response(200)
         s.send_header("Content-type", "application/json")
+        s.send_header("Content-Length", "0")
         s.end_headers()
-        json.dump({"status": 200, "message": "OK", "data": {
+
+    def do_GET(s):
+        s.send_json({"status": 200, "message": "OK", "data": {
             "capabilities": {
                 "minimum_batch_size": 1, # # of frames
-                "maximum_batch_size": 500, # # of frames
+                "maximum_batch_size": MAXIMUM_BATCH_SIZE, # # of frames
                 "available_models": [ {
                     "id": "standard", # id of the model
                     "label": "Standard detection", # user-readable label for the model
@@ -39,7 +50,7 @@ class RESTHandler(BaseHTTPServer.BaseHTTPRequestHandler):
                 }
                 ]
             }
-        }}, s.wfile)
+        }})
 
     def do_POST(s):
         length = int(s.headers['Content-Length'])
@@ -47,11 +58,15 @@ class RESTHandler(BaseHTTPServer.BaseHTTPRequestHandler):
         if s.headers['Content-type'] == 'application/json':
             post_data = json.loads(body)
         else:
-            post_data = urlparse.parse_qs(body)
+            post_data = urllib.parse.parse_qs(body)
         logger.info("Got a POST request [%d annotations, %d bytes]", len(post_data['annotations']), length)
-        s.send_response(200)
-        s.send_header("Content-type", "application/json")
-        s.end_headers()
+        frames = sum(len(a['frames']) for a in post_data['annotations'])
+        if frames > MAXIMUM_BATCH_SIZE:
+            s.send_json({
+                "status": 413,
+                "message": "Too many frames (%d > %d)" % (frames, MAXIMUM_BATCH_SIZE)
+            })
+            return
 
         for a in post_data['annotations']:
             logger.debug("Extracting for %s", a['annotationid'])
@@ -76,20 +91,20 @@ class RESTHandler(BaseHTTPServer.BaseHTTPRequestHandler):
                     })
             a['concepts'] = concepts
 
-        json.dump({
+        s.send_json({
             "status": 200,
             "message": "OK",
             "data": {
                 'media_filename': post_data.get('media_filename', ''),
                 'media_uri': post_data.get('media_uri', ''),
                 'model': post_data.get('model', ''),
-                'concepts': list(itertools.chain(c for a in post_data['annotations'] for c in a['concepts']))
+                'concepts': list(itertools.chain.from_iterable(a['concepts'] for a in post_data['annotations']))
             }
-        }, s.wfile)
+        })
 
 if __name__ == '__main__':
     logging.basicConfig(level=logging.DEBUG)
-    server_class = BaseHTTPServer.HTTPServer
+    server_class = http.server.ThreadingHTTPServer
     httpd = server_class((HOST_NAME, PORT_NUMBER), RESTHandler)
     logger.info("Starting dummy REST server on %s:%d", HOST_NAME, PORT_NUMBER)
     try:
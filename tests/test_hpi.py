@@ -0,0 +1,207 @@
+#
+# Advene: Annotate Digital Videos, Exchange on the NEt
+# Copyright (C) 2025 Olivier Aubert <contact@olivieraubert.net>
+#
+# Advene is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# Advene is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Advene; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+#
+"""Tests of the HPI plugin VCD client, against scripts/dummy_server.py.
+"""
+from collections import Counter
+import http.server
+import importlib.util
+import io
+import json
+from pathlib import Path
+import sys
+import tempfile
+import threading
+import unittest
+
+ROOT = Path(__file__).resolve().parents[1]
+sys.path.insert(0, str(ROOT / 'lib'))
+# advene.core.config parses the command line
+sys.argv = sys.argv[:1]
+
+import requests
+
+import advene.core.config as config
+from advene.plugins.hpi import VCDClient, VCDError, FRAMES_PER_ANNOTATION
+
+def load_dummy_server():
+    spec = importlib.util.spec_from_file_location('dummy_server', ROOT / 'scripts' / 'dummy_server.py')
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+dummy_server = load_dummy_server()
+
+class FlakyHandler(dummy_server.RESTHandler):
+    """Dummy server handler failing the first POST requests.
+    """
+    failures = 0
+    requests = []
+
+    def log_message(self, *args):
+        pass
+
+    def do_POST(self):
+        if FlakyHandler.failures > 0:
+            FlakyHandler.failures -= 1
+            self.rfile.read(int(self.headers['Content-Length']))
+            self.send_json({ "status": 503, "message": "Unavailable" }, status=503)
+            return
+        FlakyHandler.requests.append(int(self.headers['Content-Length']))
+        super().do_POST()
+
+class Annotation:
+    """Minimal annotation, for build_request.
+    """
+    def __init__(self, i):
+        self.id = "a%d" % i
+        self.begin = i * 1000
+        self.end = i * 1000 + 500
+
+def build_request(annotations):
+    return {
+        "model": "standard",
+        "annotations": [
+            { "annotationid": a.id,
+              "begin": a.begin,
+              "end": a.end,
+              "frames": [ { "screenshot": "", "timecode": t }
+                          for t in (a.begin, (a.begin + a.end) // 2, a.end) ] }
+            for a in annotations
+        ]
+    }
+
+class VCDTestCase(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.server = http.server.ThreadingHTTPServer(('localhost', 0), FlakyHandler)
+        cls.url = "http://localhost:%d/" % cls.server.server_address[1]
+        cls.thread = threading.Thread(target=cls.server.serve_forever, daemon=True)
+        cls.thread.start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def setUp(self):
+        FlakyHandler.failures = 0
+        FlakyHandler.requests = []
+        self.client = VCDClient(self.url, inflight=2, backoff=0.01)
+
+    def tearDown(self):
+        self.client.close()
+
+    def test_capabilities(self):
+        caps = self.client.get_capabilities()
+        self.assertEqual(caps['maximum_batch_size'], dummy_server.MAXIMUM_BATCH_SIZE)
+        self.assertEqual(self.client.maximum_batch_size, dummy_server.MAXIMUM_BATCH_SIZE)
+        self.assertEqual(self.client.clamp(10000), dummy_server.MAXIMUM_BATCH_SIZE)
+        self.assertEqual(self.client.clamp(1), FRAMES_PER_ANNOTATION)
+
+    def test_batching(self):
+        self.client.get_capabilities()
+        annotations = [ Annotation(i) for i in range(200) ]
+        ids = []
+        concepts = Counter()
+        for batch, output in self.client.process(annotations, build_request):
+            self.assertLessEqual(len(batch) * FRAMES_PER_ANNOTATION, dummy_server.MAXIMUM_BATCH_SIZE)
+            ids.extend(a.id for a in batch)
+            concepts.update(c['annotationid'] for c in output['data']['concepts'])
+        # Results are returned in order, exactly once
+        self.assertEqual(ids, [ a.id for a in annotations ])
+        self.assertEqual(set(concepts.values()), { 3 })
+        self.assertGreater(len(FlakyHandler.requests), 1)
+
+    def test_too_large(self):
+        # Ignore the advertised limits
+        with self.assertRaises(VCDError) as cm:
+            self.client.post(build_request([ Annotation(i) for i in range(200) ]))
+        self.assertIn("Too many frames", str(cm.exception))
+
+    def test_retry(self):
+        FlakyHandler.failures = 2
+        output, duration = self.client.post(build_request([ Annotation(0) ]))
+        self.assertEqual(output['status'], 200)
+        self.assertEqual(FlakyHandler.failures, 0)
+
+        FlakyHandler.failures = 10
+        self.client.retries = 2
+        with self.assertRaises(requests.exceptions.HTTPError):
+            self.client.post(build_request([ Annotation(0) ]))
+        # Initial request + 2 retries
+        self.assertEqual(FlakyHandler.failures, 7)
+
+    def test_resume(self):
+        try:
+            import advene.core.controller as controller
+            from advene.model.fragment import MillisecondFragment
+            from advene.plugins.hpi import HPIImporter
+            from PIL import Image
+        except ImportError as e:
+            self.skipTest("Missing dependency: %s" % e)
+        settings = tempfile.TemporaryDirectory()
+        self.addCleanup(settings.cleanup)
+        config.data.path['settings'] = Path(settings.name)
+
+        c = controller.AdveneController()
+        c.load_package(str(ROOT / 'share' / 'ada-template.azp'))
+        p = c.package
+        buf = io.BytesIO()
+        Image.new('RGB', (32, 24), 'red').save(buf, 'PNG')
+        png = buf.getvalue()
+        class ImageCache:
+            def get(self, t):
+                return png
+        p.imagecache = ImageCache()
+        at = p.annotationTypes[0]
+        count = 40
+        for i in range(count):
+            a = p.createAnnotation(ident="h%d" % i, type=at, author="test", date="2025-01-01",
+                                   fragment=MillisecondFragment(begin=i * 1000, end=i * 1000 + 500))
+            p.annotations.append(a)
+
+        def run(cancel):
+            def callback(value, label=None):
+                # Cancel after the first processed batch
+                return not (cancel and .1 < value < 1)
+            importer = HPIImporter(controller=c, package=p, source_type=at, callback=callback)
+            importer.process_options([ '-u', self.url, '-n', '1' ])
+            importer.package = p
+            importer.process_file(self.url)
+
+        def concepts():
+            result = Counter()
+            for a in p.annotations:
+                if a.type.id.startswith('concept_'):
+                    result[json.loads(a.content.data)['annotationid']] += 1
+            return result
+
+        run(cancel=True)
+        interrupted = concepts()
+        self.assertTrue(0 < len(interrupted) < count)
+        # A converted concept whose annotation was deleted since then
+        # is converted again.
+        deleted = next(a for a in p.annotations if a.type.id.startswith('concept_'))
+        p.annotations.remove(deleted)
+        run(cancel=False)
+        # Each source annotation has its 3 concepts, without duplicates
+        self.assertEqual(concepts(), Counter(dict( ("h%d" % i, 3) for i in range(count) )))
+
+if __name__ == '__main__':
+    unittest.main()
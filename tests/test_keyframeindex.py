@@ -0,0 +1,106 @@
+#
+# Advene: Annotate Digital Videos, Exchange on the NEt
+# Copyright (C) 2025 Olivier Aubert <contact@olivieraubert.net>
+#
+# Advene is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# Advene is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Advene; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+#
+"""Tests of the keyframe index lookups, which do not need GStreamer.
+"""
+from pathlib import Path
+import sys
+import tempfile
+import unittest
+
+ROOT = Path(__file__).resolve().parents[1]
+sys.path.insert(0, str(ROOT / 'lib'))
+# advene.core.config parses the command line
+sys.argv = sys.argv[:1]
+
+from advene.util.keyframeindex import KeyframeIndex
+
+# 25 fps, with a keyframe every second (25 frames), starting at 0
+FRAME = 40
+
+def make_index(framerate=(25, 1)):
+    return KeyframeIndex([ 2000, 0, 1000 ], 75, 3000, framerate)
+
+class TestGop(unittest.TestCase):
+    def test_gop(self):
+        index = make_index()
+        self.assertEqual(index.keyframes, [ 0, 1000, 2000 ])
+        self.assertEqual(index.gop(0), 0)
+        self.assertEqual(index.gop(999), 0)
+        self.assertEqual(index.gop(1000), 1)
+        self.assertEqual(index.gop(5000), 2)
+
+    def test_before_first_keyframe(self):
+        index = KeyframeIndex([ 500, 1500 ], 50, 2000, (25, 1))
+        self.assertEqual(index.gop(100), -1)
+        self.assertIsNone(index.keyframe(100))
+        self.assertEqual(index.keyframe(1499), 500)
+
+class TestFrameSteps(unittest.TestCase):
+    def test_same_gop(self):
+        index = make_index()
+        self.assertEqual(index.frame_duration, FRAME)
+        self.assertEqual(index.frame_steps(0, 10 * FRAME), 10)
+        self.assertEqual(index.frame_steps(1000, 1000 + FRAME), 1)
+
+    def test_rounded_positions(self):
+        # NTSC frame duration is not an integer number of ms
+        index = KeyframeIndex([ 0, 1001 ], 48, 2002, (24000, 1001))
+        self.assertEqual(index.frame_steps(0, 83), 2)
+        self.assertEqual(index.frame_steps(42, 125), 2)
+
+    def test_seek(self):
+        index = make_index()
+        # Backwards, same position or less than a frame
+        self.assertIsNone(index.frame_steps(400, 200))
+        self.assertIsNone(index.frame_steps(400, 400))
+        self.assertIsNone(index.frame_steps(400, 420))
+        # Other GOP
+        self.assertIsNone(index.frame_steps(960, 1000))
+        # Unknown position
+        self.assertIsNone(index.frame_steps(None, 400))
+
+    def test_unknown_framerate(self):
+        index = make_index(framerate=None)
+        self.assertIsNone(index.frame_duration)
+        self.assertIsNone(index.frame_steps(0, 400))
+
+class TestGroups(unittest.TestCase):
+    def test_groups(self):
+        index = KeyframeIndex([ 500, 1500 ], 50, 2000, (25, 1))
+        self.assertEqual(index.groups([ 1600, 100, 520, 1500, 900 ]),
+                         [ (None, [ 100 ]),
+                           (500, [ 520, 900 ]),
+                           (1500, [ 1500, 1600 ]) ])
+        self.assertEqual(index.groups([]), [])
+
+class TestCache(unittest.TestCase):
+    def test_save_load(self):
+        index = make_index()
+        with tempfile.TemporaryDirectory() as d:
+            filename = Path(d) / 'keyframes' / 'media.json'
+            index.save(filename)
+            loaded = KeyframeIndex.load(filename)
+            self.assertIsNone(KeyframeIndex.load(Path(d) / 'missing.json'))
+        self.assertEqual(loaded.keyframes, index.keyframes)
+        self.assertEqual(loaded.frames, index.frames)
+        self.assertEqual(loaded.duration, index.duration)
+        self.assertEqual(loaded.framerate, index.framerate)
+
+if __name__ == '__main__':
+    unittest.main()